@@ -5,4 +5,6 @@ A minimal script to launch leo.
 """
 
 import leo.core.runLeo
-leo.core.runLeo.run()
+if __name__ == '__main__':
+    # The guard allows multiprocessing to import this script.
+    leo.core.runLeo.run()
@@ -362,9 +362,9 @@ def expandOnlyAncestorsOfNode(self, event=None, p=None):
     if p: c.selectPosition(p) # 2013/12/25
     root = c.p
     if trace: g.trace(root.h)
-    for p in c.all_unique_positions():
-        p.v.expandedPositions = []
-        p.v.contract()
+    for v in c.all_unique_nodes():
+        v.expandedPositions = []
+        v.contract()
     for p in root.parents():
         if trace: g.trace('call p.expand', p.h, p._childIndex)
         p.expand()
@@ -1151,7 +1151,7 @@ def unmarkAll(self, event=None):
             p.v.setDirty()
             u.afterMark(p, undoType, bunch)
             changed = True
-    dirtyVnodeList = [p.v for p in c.all_unique_positions() if p.v.isDirty()]
+    dirtyVnodeList = [v for v in c.all_unique_nodes() if v.isDirty()]
     if changed:
         g.doHook("clear-all-marks", c=c, p=p)
         c.setChanged(True)
@@ -71,6 +71,37 @@ class ControlCommandsClass(BaseEditCommandsClass):
         that enables the plugin.
         '''
         g.app.pluginsController.printPluginsInfo(self.c)
+    #@+node:agent.20261019000000.37: *3* plugin hook profiling...
+    @cmd('clear-hook-profile')
+    def clearHookProfile(self, event=None):
+        '''Clear the latencies recorded for plugin handlers.'''
+        g.app.pluginsController.clearHookProfile()
+
+    @cmd('print-hook-profile')
+    def printHookProfile(self, event=None):
+        '''
+        Print the count, total, mean, percentile and maximum latencies of
+        each plugin handler for each tag, most expensive first.
+        '''
+        g.app.pluginsController.printHookProfile(self.c)
+
+    @cmd('toggle-hook-profiling')
+    def toggleHookProfiling(self, event=None):
+        '''Start or stop recording the latencies of plugin handlers.'''
+        pc = g.app.pluginsController
+        pc.hook_profiling = not pc.hook_profiling
+        g.es('hook profiling: %s' % ('on' if pc.hook_profiling else 'off'))
+
+    @cmd('write-hook-profile')
+    def writeHookProfile(self, event=None):
+        '''Write the latencies of plugin handlers to ~/.leo/hook-profile.json.'''
+        fn = g.os_path_finalize_join(
+            g.app.homeLeoDir or g.app.loadDir, 'hook-profile.json')
+        try:
+            g.app.pluginsController.writeHookProfile(fn)
+            g.es('wrote: %s' % fn)
+        except IOError:
+            g.error('can not write', fn)
     #@+node:ekr.20150514063305.93: *3* setSilentMode
     @cmd('set-silent-mode')
     def setSilentMode(self, event=None):
@@ -11,14 +11,17 @@ try:
 except ImportError:
     import __builtin__ as builtins # Python 2.
 # import glob
+import hashlib
 import importlib
 import io
 import os
 import optparse
+import pickle
+import re
 import subprocess
 import string
 import sys
-# import time
+import time
 import traceback
 import zipfile
 import platform
@@ -38,45 +41,161 @@ class IdleTimeManager(object):
 
     Any code can call g.app.idleTimeManager.add_callback(callback) to cause
     the callback to be called at idle time forever.
+
+    Code that may take a long time should instead call
+    g.app.idleTimeManager.add_task(name, task, priority). task is a
+    function returning a generator that yields after each unit of work.
+    At each idle time, the manager resumes tasks, highest priority first,
+    until the time budget for that idle time is spent. Unfinished tasks
+    resume at the next idle time. When a task's generator is exhausted, the
+    manager calls task() again at the next idle time.
     '''
 
+    budget = 0.05
+        # Seconds of work per idle time. Set by @int idle_time_budget.
+
     def __init__(self):
         '''Ctor for IdleTimeManager class.'''
-        self.callback_list = []
+        self.tasks = []
+            # A list of IdleTask instances.
         self.timer = None
 
     #@+others
+    #@+node:agent.20261019000000.20: *3* class IdleTask
+    class IdleTask(object):
+        '''A class to hold data about a resumable idle-time task.'''
+
+        def __init__(self, name, task, priority, order):
+            '''Ctor for the IdleTask class.'''
+            self.name = name
+            self.task = task
+                # A function returning a generator.
+            self.priority = priority
+            self.order = order
+            self.gen = None
+                # The generator of the unfinished pass, or None.
+            self.waiting = 0
+                # The number of idle times since the task last ran.
+            # Statistics.
+            self.max_time = 0.0
+            self.passes = 0
+            self.steps = 0
+            self.time = 0.0
+
+        def __repr__(self):
+            return 'IdleTask: %s priority: %s' % (self.name, self.priority)
+
+        __str__ = __repr__
     #@+node:ekr.20161026125611.1: *3* itm.add_callback
-    def add_callback(self, callback):
+    def add_callback(self, callback, name=None, priority=0):
         '''Add a callback to be called at every idle time.'''
-        self.callback_list.append(callback)
+
+        def task(callback=callback):
+            callback()
+            yield
+
+        if not name:
+            obj = getattr(callback, '__self__', None)
+            name = getattr(callback, '__name__', repr(callback))
+            if obj is not None:
+                name = '%s.%s' % (obj.__class__.__name__, name)
+        return self.add_task(name, task, priority)
+    #@+node:agent.20261019000000.19: *3* itm.add_task
+    def add_task(self, name, task, priority=0):
+        '''
+        Add a resumable task to be run at every idle time.
+
+        task is a function returning a generator. The generator should
+        yield after each unit of work. Tasks with higher priorities run
+        first. Return the IdleTask instance.
+        '''
+        idle_task = self.IdleTask(name, task, priority, len(self.tasks))
+        self.tasks.append(idle_task)
+        return idle_task
     #@+node:ekr.20161026124810.1: *3* itm.on_idle
     on_idle_count = 0
 
     def on_idle(self, timer):
-        '''IdleTimeManager: Run all idle-time callbacks.'''
+        '''IdleTimeManager: Run idle-time tasks within the time budget.'''
         if not g.app: return
         if g.app.killed: return
         self.on_idle_count += 1
-        # Handle the registered callbacks.
-        for callback in self.callback_list:
+        self.run_tasks(self.budget)
+    #@+node:agent.20261019000000.21: *3* itm.run_tasks & helper
+    def run_tasks(self, budget):
+        '''
+        Resume tasks, highest priority first, until budget seconds have
+        elapsed. Tasks that have waited longest go first, so that all tasks
+        eventually run even when the budget is too small.
+        '''
+        t_end = time.time() + budget
+        tasks = sorted(self.tasks,
+            key=lambda z: (-z.waiting, -z.priority, z.order))
+        for i, task in enumerate(tasks):
+            if g.app.killed:
+                return
+            # Always run at least one task.
+            if i > 0 and time.time() >= t_end:
+                task.waiting += 1
+            else:
+                task.waiting = 0
+                self.run_task(task, t_end)
+    #@+node:agent.20261019000000.22: *4* itm.run_task
+    def run_task(self, task, t_end):
+        '''
+        Resume the task until its pass is complete or until time t_end.
+        Run at least one unit of work.
+        '''
+        while True:
+            t1 = time.time()
             try:
-                callback()
+                if task.gen is None:
+                    task.gen = task.task()
+                next(task.gen)
+                done = False
+            except StopIteration:
+                done = True
             except Exception:
                 g.es_exception()
-                g.es_print('removing callback: %s' % callback)
-                self.callback_list.remove(callback)
-        # Handle idle-time hooks.
-        g.app.pluginsController.on_idle()
+                g.es_print('removing idle task: %s' % task.name)
+                if task in self.tasks:
+                    self.tasks.remove(task)
+                return
+            t2 = time.time()
+            task.max_time = max(task.max_time, t2 - t1)
+            task.steps += 1
+            task.time += t2 - t1
+            if done:
+                # Start the next pass at the next idle time.
+                task.gen = None
+                task.passes += 1
+                return
+            if t2 >= t_end or g.app.killed:
+                return
     #@+node:ekr.20161028034808.1: *3* itm.start
     def start (self):
         '''Start the idle-time timer.'''
+        budget = g.app.config.getInt('idle_time_budget')
+        if budget and budget > 0:
+            self.budget = budget / 1000.0
+        self.add_task('idle-hooks', g.app.pluginsController.idle_task)
         self.timer = g.IdleTime(
             self.on_idle,
             delay=500,
             tag='IdleTimeManager.on_idle')
         if self.timer:
             self.timer.start()
+    #@+node:agent.20261019000000.23: *3* itm.print_stats
+    def print_stats(self):
+        '''Print the accumulated time of all idle-time tasks.'''
+        g.es_print('idle time: %s ticks, budget: %s msec.' % (
+            self.on_idle_count, int(self.budget * 1000)))
+        g.es_print('%8s %6s %6s %8s %8s  %s' % (
+            'priority', 'passes', 'steps', 'total', 'max', 'task'))
+        for task in sorted(self.tasks, key=lambda z: -z.time):
+            g.es_print('%8s %6s %6s %8.3f %8.3f  %s' % (
+                task.priority, task.passes, task.steps,
+                task.time, task.max_time, task.name))
     #@-others
 #@+node:ekr.20120209051836.10241: ** class LeoApp
 class LeoApp(object):
@@ -1995,7 +2114,8 @@ class LoadManager(object):
             # Get the settings from the globals settings dicts.
             d1 = lm.globalSettingsDict.copy(settingsName)
             d2 = lm.globalBindingsDict.copy(shortcutsName)
-        return PreviousSettings(d1, d2)
+            c = None
+        return PreviousSettings(d1, d2, preReadCommander=c)
     #@+node:ekr.20120214132927.10723: *4* LM.mergeShortcutsDicts & helpers
     def mergeShortcutsDicts(self, c, old_d, new_d, localFlag):
         '''
@@ -2181,7 +2301,7 @@ class LoadManager(object):
         c.openDirectory = frame.openDirectory = g.os_path_dirname(fn)
         g.app.gui = oldGui
         return c if ok else None
-    #@+node:ekr.20120213081706.10382: *4* LM.readGlobalSettingsFiles
+    #@+node:ekr.20120213081706.10382: *4* LM.readGlobalSettingsFiles & helpers
     def readGlobalSettingsFiles(self):
         '''Read leoSettings.leo and myLeoSettings.leo using a null gui.'''
         trace = 'themes' in g.app.debug
@@ -2189,6 +2309,12 @@ class LoadManager(object):
         # Open the standard settings files with a nullGui.
         # Important: their commanders do not exist outside this method!
         paths = [lm.computeLeoSettingsPath(), lm.computeMyLeoSettingsPath()]
+        key = lm.computeSettingsSnapshotKey(paths)
+        if key and lm.readSettingsSnapshot(key):
+            return
+        unit_d = g.app.config.unitTestDict
+        unit_lengths = dict((z, len(unit_d.get(z, [])))
+            for z in lm.settingsSnapshotUnitTestKeys)
         old_commanders = g.app.commanders()
         commanders = [lm.openSettingsFile(path) for path in paths]
         commanders = [z for z in commanders if z]
@@ -2205,7 +2331,7 @@ class LoadManager(object):
         lm.globalBindingsDict = bindings_d
         # Add settings from --theme or @string theme-name files.
         # This must be done *after* reading myLeoSettigns.leo.
-        theme_path = lm.computeThemeFilePath()
+        theme_path, theme_c = lm.computeThemeFilePath(), None
         if theme_path:
             theme_c = lm.openSettingsFile(theme_path)
             if theme_c:
@@ -2228,11 +2354,228 @@ class LoadManager(object):
                         print(' g.app.theme_name: %s' % g.app.theme_name)
                         print('g.app.theme_color: %s' % g.app.theme_color)
                         print('')
+            else:
+                theme_path = None
+        if key:
+            # The names that doButtons and doCommands added for unit tests.
+            unit_names = dict((z, unit_d.get(z, [])[n:])
+                for z, n in unit_lengths.items())
+            lm.writeSettingsSnapshot(key, theme_path,
+                commanders + [theme_c] if theme_c else commanders, unit_names)
         # Clear the cache entries for the commanders.
         # This allows this method to be called outside the startup logic.
         for c in commanders:
             if c not in old_commanders:
                 g.app.forgetOpenFile(c.fileName())
+    #@+node:agent.20261018170000.6: *5* LM.computeSettingsEnvironment
+    def computeSettingsEnvironment(self, names):
+        '''
+        Return a sorted tuple of (name, value) for the given environment
+        variables, as used by @ifenv nodes.
+        '''
+        return tuple(sorted((name, os.getenv(name)) for name in names))
+    #@+node:agent.20261018170000.1: *5* LM.computeSettingsFileStamp
+    def computeSettingsFileStamp(self, path):
+        '''
+        Return (stamp, s), where s is the contents of the file at the given
+        path and stamp is the tuple (path, mtime, size, md5 hash of s).
+        Return (None, None) if the file can not be read.
+        '''
+        try:
+            with open(path, 'rb') as f:
+                s = f.read()
+            mtime = os.path.getmtime(path)
+        except Exception:
+            return None, None
+        return (path, mtime, len(s), hashlib.md5(s).hexdigest()), s
+    #@+node:agent.20261018170000.2: *5* LM.computeSettingsSnapshotKey
+    settingsSnapshotVersion = 3
+        # Change this whenever the format of the settings snapshot changes.
+
+    theme_name_pattern = re.compile(br'@string\s+theme[-_]?name', re.IGNORECASE)
+
+    def computeSettingsSnapshotKey(self, paths):
+        '''
+        Return the key of the settings snapshot for the given settings files:
+        a tuple describing everything that contributes to the global
+        settings dicts, except the theme file.
+
+        Return None if the snapshot must not be used.
+        '''
+        lm = self
+        if not g.enableDB or g.app.unitTesting or g.app.trace_setting:
+            return None
+        if lm.options.get('script'):
+            # NullGui.runMainLoop runs --script scripts in the last
+            # commander created, the commander for a settings file.
+            return None
+        import leo.core.leoVersion as leoVersion
+        stamps, env_names = [], set()
+        for path in paths:
+            if path:
+                stamp, s = lm.computeSettingsFileStamp(path)
+                if not stamp:
+                    return None
+                stamps.append(stamp)
+                env_names.update(lm.findIfEnvNames(s))
+        # lm.computeThemeFilePath may use @string theme-name in lm.files[0].
+        fn = lm.files[0] if lm.files else None
+        if fn and g.os_path_exists(fn):
+            stamp, s = lm.computeSettingsFileStamp(fn)
+            if not stamp:
+                return None
+            if lm.isZippedFile(fn):
+                theFile = lm.openZipFile(fn)
+                if not theFile:
+                    return None
+                s = g.toEncodedString(theFile.read(), 'utf-8')
+                stamps.append(stamp)
+                env_names.update(lm.findIfEnvNames(s))
+            elif lm.theme_name_pattern.search(s):
+                stamps.append(stamp)
+                env_names.update(lm.findIfEnvNames(s))
+        return (
+            lm.settingsSnapshotVersion,
+            leoVersion.version,
+            tuple(sys.version_info[: 2]),
+            lm.options.get('theme_path'),
+            tuple(stamps),
+            # @ifplatform, @ifhostname and @ifenv nodes depend on these.
+            sys.platform,
+            lm.computeMachineName(),
+            lm.computeSettingsEnvironment(env_names),
+        )
+    #@+node:agent.20261018170000.3: *5* LM.computeSettingsSnapshotPath
+    def computeSettingsSnapshotPath(self):
+        '''Return the path to the settings snapshot.'''
+        return g.os_path_finalize_join(g.app.homeLeoDir, 'db', 'settings-snapshot')
+    #@+node:agent.20261018170000.7: *5* LM.findIfEnvNames
+    ifenv_pattern = re.compile(br'@ifenv\s+([^,<\s]+)')
+
+    def findIfEnvNames(self, s):
+        '''
+        Return the set of environment variables named in @ifenv nodes in s,
+        the contents of a settings file.
+        '''
+        return set(g.toUnicode(z) for z in self.ifenv_pattern.findall(s))
+    #@+node:agent.20261018170000.4: *5* LM.readSettingsSnapshot
+    settingsSnapshotConfigIvars = (
+        'buttonsFileName',
+        'context_menus',
+        'enabledPluginsFileName',
+        'enabledPluginsString',
+        'menusFileName',
+        'menusList',
+        'modeCommandsDict',
+    )
+        # The g.app.config ivars set by reading settings files.
+
+    settingsSnapshotUnitTestKeys = (
+        'config.doButtons-file-names',
+        'config.doCommands-file-names',
+    )
+        # The g.app.config.unitTestDict keys set by reading settings files.
+
+    def readSettingsSnapshot(self, key):
+        '''
+        Set the global settings dicts from the settings snapshot.
+        Return False if the snapshot does not exist or does not match key.
+        '''
+        lm = self
+        path = lm.computeSettingsSnapshotPath()
+        if not g.os_path_exists(path):
+            return False
+        try:
+            with open(path, 'rb') as f:
+                d = pickle.load(f)
+            if d.get('key') != key:
+                return False
+        except Exception:
+            return False # A corrupt or incompatible snapshot.
+        env_names = set()
+        for path, external in d.get('externals'):
+            stamp, s = lm.computeSettingsFileStamp(path)
+            if stamp != external:
+                return False
+            if s:
+                env_names.update(lm.findIfEnvNames(s))
+        if lm.computeSettingsEnvironment(env_names) != d.get('externals_env'):
+            return False
+        theme = d.get('theme')
+        if theme:
+            stamp, s = lm.computeSettingsFileStamp(theme[0])
+            if stamp != theme:
+                return False
+            theme_env = lm.computeSettingsEnvironment(lm.findIfEnvNames(s))
+            if theme_env != d.get('theme_env'):
+                return False
+            g.app.theme_directory = g.os_path_dirname(theme[0])
+        lm.globalSettingsDict = d.get('settings')
+        lm.globalBindingsDict = d.get('bindings')
+        for ivar, val in d.get('config').items():
+            setattr(g.app.config, ivar, val)
+        unit_d = g.app.config.unitTestDict
+        for key, aList in d.get('unitTestDict').items():
+            unit_d[key] = unit_d.get(key, []) + aList
+        return True
+    #@+node:agent.20261018170000.5: *5* LM.writeSettingsSnapshot
+    def writeSettingsSnapshot(self, key, theme_path, commanders, unit_d):
+        '''
+        Write the global settings dicts to the settings snapshot.
+
+        commanders: the commanders for all settings files read.
+        unit_d:     the g.app.config.unitTestDict entries they set.
+        '''
+        lm = self
+        gc = g.app.config
+        if gc.atCommonButtonsList or gc.atCommonCommandsList:
+            # These lists contain positions in the settings files.
+            return
+        # @<file> nodes in the settings files may read external files.
+        externals, env_names = [], set()
+        for c in commanders:
+            for p in c.all_unique_positions():
+                if p.isAnyAtFileNode():
+                    path = g.fullPath(c, p)
+                    stamp, s = lm.computeSettingsFileStamp(path)
+                    externals.append((path, stamp),)
+                    if s:
+                        env_names.update(lm.findIfEnvNames(s))
+        if theme_path:
+            theme, s = lm.computeSettingsFileStamp(theme_path)
+            if not theme:
+                return
+            theme_env = lm.computeSettingsEnvironment(lm.findIfEnvNames(s))
+        else:
+            theme, theme_env = None, None
+        d = {
+            'bindings': lm.globalBindingsDict,
+            'config': dict([(ivar, getattr(gc, ivar))
+                for ivar in lm.settingsSnapshotConfigIvars if hasattr(gc, ivar)]),
+            'externals': externals,
+            'externals_env': lm.computeSettingsEnvironment(env_names),
+            'key': key,
+            'settings': lm.globalSettingsDict,
+            'theme': theme,
+            'theme_env': theme_env,
+            'unitTestDict': unit_d,
+        }
+        path = lm.computeSettingsSnapshotPath()
+        tmp_path = path + '.tmp'
+        try:
+            s = pickle.dumps(d, pickle.HIGHEST_PROTOCOL)
+            directory = g.os_path_dirname(path)
+            if not g.os_path_exists(directory):
+                os.makedirs(directory)
+            with open(tmp_path, 'wb') as f:
+                f.write(s)
+            if g.os_path_exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except Exception:
+            # Settings that can not be pickled disable the snapshot.
+            if g.os_path_exists(tmp_path):
+                os.remove(tmp_path)
     #@+node:ekr.20120214165710.10838: *4* LM.traceSettingsDict
     def traceSettingsDict(self, d, verbose=False):
         if verbose:
@@ -2785,6 +3128,7 @@ class LoadManager(object):
         add_bool('--trace-ipython', 'trace ipython bridge')
         add_bool('--trace-keys',    'trace key events')
         add_bool('--trace-plugins', 'trace imports of plugins')
+        add_bool('--trace-read',    'trace parallel reading of external files')
         add_other('--trace-setting', 'trace where named setting is set', m="NAME")
         add_bool('--trace-shutdown', 'trace shutdown logic')
         add_bool('--trace-themes',  'trace theme init logic')
@@ -2912,6 +3256,7 @@ class LoadManager(object):
             ('keys', options.trace_keys), # New
             ('ipython', options.trace_ipython), # New
             ('plugins', options.trace_plugins),
+            ('read', options.trace_read), # New.
             ('shutdown', options.trace_shutdown),
             ('themes', options.trace_themes),
         )
@@ -3128,9 +3473,9 @@ class LoadManager(object):
     def loadLocalFile(self, fn, gui, old_c):
         '''Completely read a file, creating the corresonding outline.
 
-        1. If fn is an existing .leo file (possibly zipped), read it twice:
-        the first time with a NullGui to discover settings,
-        the second time with the requested gui to create the outline.
+        1. If fn is an existing .leo file (possibly zipped), read it once
+        with a NullGui to discover settings, then create the outline in the
+        requested gui from the vnodes created by the pre-read.
 
         2. If fn is an external file:
         get settings from the leoSettings.leo and myLeoSetting.leo, then
@@ -3155,7 +3500,7 @@ class LoadManager(object):
         # Otherwise, get settings from leoSettings.leo, myLeoSettings.leo, or default settings.
         previousSettings = lm.getPreviousSettings(fn)
         # Step 2: open the outline in the requested gui.
-        # For .leo files (and zipped .leo file) this opens the file a second time.
+        # For .leo files (and zipped .leo file) this reuses the pre-read outline.
         c = lm.openFileByName(fn, gui, old_c, previousSettings)
         return c
     #@+node:ekr.20120223062418.10394: *5* LM.openFileByName & helpers
@@ -3196,6 +3541,10 @@ class LoadManager(object):
         g.doHook("open1", old_c=None, c=c, new_c=c, fileName=fn)
         if theFile:
             readAtFileNodesFlag = bool(previousSettings)
+            if previousSettings:
+                # Use the outline created by the pre-read instead of reading it again.
+                c.fileCommands.preReadCommander = previousSettings.preReadCommander
+                previousSettings.preReadCommander = None
             # The log is not set properly here.
             ok = lm.readOpenedLeoFile(c, fn, readAtFileNodesFlag, theFile)
                 # Call c.fileCommands.openLeoFile to read the .leo file.
@@ -3399,11 +3748,13 @@ class PreviousSettings(object):
     that are computed in the first pass when loading local
     files and passed to the second pass.'''
 
-    def __init__(self, settingsDict, shortcutsDict):
+    def __init__(self, settingsDict, shortcutsDict, preReadCommander=None):
         assert g.isTypedDict(settingsDict)
         assert g.isTypedDictOfLists(shortcutsDict)
         self.settingsDict = settingsDict
         self.shortcutsDict = shortcutsDict
+        self.preReadCommander = preReadCommander
+            # The commander that pre-read the file, or None.
 
     def __repr__(self):
         return '<PreviousSettings\n%s\n%s\n>' % (
@@ -3857,6 +4208,12 @@ def openUrl(event=None):
 def openUrlUnderCursor(event=None):
     '''Open the url under the cursor.'''
     return g.openUrlOnClick(event)
+#@+node:agent.20261019000000.24: *3* print-idle-tasks
+@g.command('print-idle-tasks')
+def print_idle_tasks(event=None):
+    '''Print the time spent by each idle-time task.'''
+    if g.app.idleTimeManager:
+        g.app.idleTimeManager.print_stats()
 #@-others
 #@@language python
 #@@tabwidth -4
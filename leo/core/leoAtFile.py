@@ -11,6 +11,7 @@ import leo.core.leoBeautify as leoBeautify
 import leo.core.leoNodes as leoNodes
 # import glob
 # import importlib
+import multiprocessing
 import os
 import re
 import sys
@@ -123,10 +124,19 @@ class AtFile(object):
         self.canCancelFlag = False
         self.cancelFlag = False
         self.yesToAll = False
+        # **Only** at.readAll manages this dict.
+        self.scannedTrees = {}
+            # Keys are full paths, values are AsyncResults of scanExternalFile.
         # User options: set in reloadSettings.
         self.checkPythonCodeOnWrite = False
         self.runPyFlakesOnWrite = False
         self.underindentEscapeString = '\\-'
+        self.parallelRead = False
+        self.parallelReadProcesses = 0
+        self.cacheFragments = True
+        self.fragmentCache = {}
+            # Keys are vnodes of @<file> nodes, values are fragment dicts.
+            # See at.putFragment.
         self.reloadSettings()
         # Define the dispatch dictionary used by scanText4.
         self.dispatch_dict = self.defineDispatchDict()
@@ -181,6 +191,12 @@ class AtFile(object):
             'run-pyflakes-on-write', default=False)
         self.underindentEscapeString = c.config.getString(
             'underindent-escape-string') or '\\-'
+        self.parallelRead = c.config.getBool(
+            'parallel-read-external-files', default=False)
+        self.parallelReadProcesses = c.config.getInt(
+            'parallel-read-processes') or 0
+        self.cacheFragments = c.config.getBool(
+            'cache-external-file-fragments', default=True)
     #@+node:ekr.20150509194251.1: *4* at.cmd (decorator)
     def cmd(name):
         '''Command decorator for the AtFileCommands class.'''
@@ -302,6 +318,9 @@ class AtFile(object):
         # at.explicitLineEnding # True: an @lineending directive specifies the ending.
             # Set by scanAllDirectives() below.
         at.fileChangedFlag = False # True: the file has actually been updated.
+        at.fragments = None
+            # The fragment dict used by at.putFragment, or None.
+            # Set by at.initFragments.
         at.force_newlines_in_at_nosent_bodies = c.config.getBool(
             'force_newlines_in_at_nosent_bodies')
         # at.language:      set by scanAllDirectives() below.
@@ -498,6 +517,7 @@ class AtFile(object):
         if g.SQLITE and c.sqlite_connection:
             loaded = at.checkExternalFileAgainstDb(root)
             if loaded: return True
+            c.fileCommands.loadLazyTree(root)
             s, loaded, fileKey, force = at._file_bytes, False, None, True
         elif fromString or not g.enableDB:
             s, loaded, fileKey = fromString, False, None
@@ -705,7 +725,7 @@ class AtFile(object):
         except sqlite3.OperationalError:
             hx2 = False
         return hx2 and hx2[0] == hx
-    #@+node:ekr.20041005105605.26: *5* at.readAll
+    #@+node:ekr.20041005105605.26: *5* at.readAll & helpers
     def readAll(self, root, force=False):
         """Scan positions, looking for @<file> nodes to read."""
         at, c = self, self.c
@@ -716,13 +736,38 @@ class AtFile(object):
             # we aren't doing the initial read.
             c.endEditing()
         t1 = time.time()
-        nRead = 0
         p = root.copy()
-        scanned_tnodes = set()
         c.init_error_dialogs()
         after = p.nodeAfterTree() if force else None
+        pool = at.startParallelScan(p, after)
+        try:
+            nRead = at.readAllHelper(p, after, force)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            at.scannedTrees = {}
+        if not g.unitTesting:
+            if nRead:
+                t2 = time.time()
+                g.es('read %s files in %2.2f seconds' % (nRead, t2 - t1))
+                if pool:
+                    g.es('scanned %s files in %s processes: %2.2f seconds total' % (
+                        at.parallelScanCount, at.parallelScanProcesses, at.parallelScanTime))
+            elif force:
+                g.es("no @<file> nodes in the selected tree")
+        if use_tracer: tt.stop()
+        c.raise_error_dialogs()
+    #@+node:agent.20261018090512.16: *6* at.readAllHelper
+    def readAllHelper(self, p, after, force):
+        '''Read all @<file> nodes in p's tree. Return the number of files read.'''
+        at, c = self, self.c
+        nRead = 0
+        scanned_tnodes = set()
         while p and p != after:
-            data = (p.gnx, g.fullPath(c, p))
+            # fullPath is the same for all other nodes visited here,
+            # and computing it would read the body text of all ancestors.
+            data = (p.gnx, g.fullPath(c, p) if p.isAnyAtFileNode() else None)
             #skip clones referring to exactly the same paths.
             if data in scanned_tnodes:
                 p.moveToNodeAfterTree()
@@ -766,14 +811,116 @@ class AtFile(object):
                 p.moveToNodeAfterTree()
             else:
                 p.moveToThreadNext()
-        if not g.unitTesting:
-            if nRead:
-                t2 = time.time()
-                g.es('read %s files in %2.2f seconds' % (nRead, t2 - t1))
-            elif force:
-                g.es("no @<file> nodes in the selected tree")
-        if use_tracer: tt.stop()
-        c.raise_error_dialogs()
+        return nRead
+    #@+node:agent.20261018090512.17: *6* at.startParallelScan
+    def startParallelScan(self, p, after):
+        '''
+        Start scanning all uncached @file and @thin nodes in p's tree in worker
+        processes. Return the pool, or None.
+
+        Only sentinel scanning runs in the workers. at.linkScannedTree links
+        the results into the outline in the main process, so the gnx and
+        clone logic is unchanged. All other @<file> nodes, including @auto
+        and @clean nodes, are read as usual: their importers need a commander.
+        '''
+        at, c = self, self.c
+        at.parallelScanCount, at.parallelScanTime = 0, 0.0
+        if not at.parallelRead or (g.SQLITE and c.sqlite_connection):
+            return None
+        tasks, seen = [], set()
+        p = p.copy()
+        while p and p != after:
+            if p.isAtIgnoreNode():
+                p.moveToNodeAfterTree()
+            elif p.isAtThinFileNode() or p.isAtFileNode():
+                fileName = g.fullPath(c, p)
+                if (
+                    fileName not in seen and g.os_path_exists(fileName) and
+                    not c.cacher.isCached(fileName)
+                ):
+                    seen.add(fileName)
+                    at.scanAllDirectives(p, reading=True)
+                        # Sets at.encoding and at.tab_width.
+                    tasks.append((fileName, at.encoding, at.tab_width))
+                p.moveToNodeAfterTree()
+            elif p.isAnyAtFileNode():
+                p.moveToNodeAfterTree()
+            else:
+                p.moveToThreadNext()
+        n = at.parallelReadProcesses or multiprocessing.cpu_count()
+        n = min(n, len(tasks))
+        if n < 2:
+            return None
+        try:
+            pool = multiprocessing.Pool(processes=n)
+        except Exception:
+            g.es_exception()
+            return None
+        at.parallelScanProcesses = n
+        # Submit the tasks in outline order: at.readAllHelper waits for them in that order.
+        for data in tasks:
+            at.scannedTrees[data[0]] = pool.apply_async(scanExternalFile, data)
+        pool.close()
+        return pool
+    #@+node:agent.20261018090512.18: *6* at.getScannedTree
+    def getScannedTree(self, fileName):
+        '''
+        Return the tree that scanExternalFile computed for fileName, or None if
+        at.scanText4 must scan the file.
+        '''
+        at = self
+        trace = 'read' in g.app.debug
+        result = at.scannedTrees.pop(fileName, None) if fileName else None
+        if not result:
+            return None
+        try:
+            tree = result.get()
+        except Exception:
+            g.es_exception()
+            return None
+        ok = bool(
+            tree and at.readVersion5 and at.thinFile and
+            not at.importing and not at.atShadow and not at.fromString and
+            tree['delims'] == (at.startSentinelComment, at.endSentinelComment) and
+            tree['tab_width'] == at.tab_width and
+            tree['digest'] == hashlib.md5(at._file_bytes).hexdigest())
+        if ok:
+            at.parallelScanCount += 1
+            at.parallelScanTime += tree['time']
+        if trace:
+            if ok:
+                g.trace('%5.3f sec. %s' % (tree['time'], fileName))
+            else:
+                g.trace('not scanned: %s' % fileName)
+        return tree if ok else None
+    #@+node:agent.20261018090512.19: *6* at.linkScannedTree
+    def linkScannedTree(self, root, tree):
+        '''
+        Link the tree computed by scanExternalFile into the outline.
+
+        Like at.scanText4, create or reuse all vnodes, set v.tempBodyList and
+        return the lines following the @-leo sentinel.
+        '''
+        at, c = self, self.c
+        at.initScanText4(root)
+        for data in tree['events']:
+            if data[0] == 'level':
+                at.changeLevel(len(at.thinNodeStack), data[1])
+                continue
+            junk, gnx, headline, level = data
+            if at.v1:
+                # Fix bug 169, as in at.readStartNode.
+                at.v1.fileIndex = gnx
+                at.v1 = None
+            at.vStack.append(at.v)
+            at.indentStack.append(at.indent)
+            at.v = at.createNewThinNode(gnx, headline, level)
+            at.v.setVisited()
+        gnxDict = c.fileCommands.gnxDict
+        for gnx, lines in tree['bodies'].items():
+            v = root.v if gnx is None else gnxDict.get(gnx)
+            v.tempBodyList = lines
+        return tree['lastLines']
     #@+node:ekr.20080801071227.7: *5* at.readAtShadowNodes
     def readAtShadowNodes(self, p):
         '''Read all @shadow nodes in the p's tree.'''
@@ -1028,7 +1175,11 @@ class AtFile(object):
             while root.hasChildren():
                 root.firstChild().doDelete()
         if read_new:
-            lastLines = at.scanText4(fileName, root)
+            tree = at.getScannedTree(fileName)
+            if tree:
+                lastLines = at.linkScannedTree(root, tree)
+            else:
+                lastLines = at.scanText4(fileName, root)
         else:
             firstLines = []; lastLines = []
             if at.atShadow:
@@ -2961,7 +3112,9 @@ class AtFile(object):
         """Write @file nodes in all or part of the outline"""
         trace = False and not g.unitTesting
         at = self; c = at.c
-        if trace: scanAtPathDirectivesCount = c.scanAtPathDirectivesCount
+        if trace:
+            scanAtPathDirectivesCount = c.scanAtPathDirectivesCount
+            hits, misses = c.directivesCacheHits, c.directivesCacheMisses
         writtenFiles = [] # Files that might be written again.
         at.sameFiles = 0
         force = writeAtFileNodesFlag
@@ -3012,6 +3165,7 @@ class AtFile(object):
         at.canCancelFlag = False
         at.cancelFlag = False
         at.yesToAll = False
+        at.pruneFragmentCache()
         # say the command is finished.
         if not g.unitTesting:
             if writeAtFileNodesFlag or writeDirtyAtFileNodesFlag:
@@ -3029,8 +3183,11 @@ class AtFile(object):
         if c.isChanged():
             # Save the outline if only persistence data nodes are dirty.
             self.saveOutlineIfPossible()
-        if trace: g.trace('%s calls to c.scanAtPathDirectives()' % (
-            c.scanAtPathDirectivesCount - scanAtPathDirectivesCount))
+        if trace:
+            g.trace('%s calls to c.scanAtPathDirectives()' % (
+                c.scanAtPathDirectivesCount - scanAtPathDirectivesCount))
+            g.trace('directives cache: %s hits, %s misses' % (
+                c.directivesCacheHits - hits, c.directivesCacheMisses - misses))
     #@+node:ekr.20041005105605.148: *6* at.clearAllOrphanBits
     def clearAllOrphanBits(self, p):
         '''Clear orphan bits for all nodes *except* orphan @file nodes.'''
@@ -3084,6 +3241,7 @@ class AtFile(object):
             writeAtFileNodesFlag or
             p.v in writtenFiles
         ):
+            c.fileCommands.loadLazyTree(p)
             # Tricky: @ignore not recognised in @asis nodes.
             if p.isAtAsisFileNode():
                 at.asisWrite(p, toString=toString)
@@ -3134,6 +3292,28 @@ class AtFile(object):
         except Exception:
             g.es('unexpected exception')
             g.es_exception()
+    #@+node:agent.20261018104512.14: *6* at.pruneFragmentCache
+    def pruneFragmentCache(self):
+        '''
+        Discard the cached fragments of @<file> nodes that have been deleted
+        from the outline or that are no longer @<file> nodes.
+        '''
+        at, c = self, self.c
+
+        def inOutline(v):
+            seen, stack = set([v]), v.parents[:]
+            while stack:
+                v = stack.pop()
+                if v is c.hiddenRootNode:
+                    return True
+                if v not in seen:
+                    seen.add(v)
+                    stack.extend(v.parents)
+            return False
+
+        for v in list(at.fragmentCache):
+            if not v.isAnyAtFileNode() or not inOutline(v):
+                del at.fragmentCache[v]
     #@+node:ekr.20140727075002.18108: *6* at.saveOutlineIfPossible
     def saveOutlineIfPossible(self):
         '''Save the outline if only persistence data nodes are dirty.'''
@@ -3606,6 +3786,7 @@ class AtFile(object):
         at = self
         s = fromString if fromString else root.v.b
         root.clearAllVisitedInTree()
+        at.initFragments(root)
         at.putAtFirstLines(s)
         at.putOpenLeoSentinel("@+leo-ver=5")
         at.putInitialComment()
@@ -3618,6 +3799,47 @@ class AtFile(object):
         at.putAtLastLines(s)
         if not toString:
             at.warnAboutOrphandAndIgnoredNodes()
+        at.finishFragments(root)
+    #@+node:agent.20261018104512.1: *5* at.initFragments
+    def initFragments(self, root):
+        '''
+        Init the ivars used by at.putFragment.
+
+        Fragments are cached only for @file and @thin trees.
+        '''
+        at = self
+        ok = (
+            at.cacheFragments and
+            at.sentinels and
+            not at.toString and
+            not at.atEdit and
+            not at.atShadow and
+            not hasattr(at, 'force_sentinels') and
+            not hasattr(at, 'allow_undefined_refs') and
+            not getattr(at, 'at_shadow_test_hack', False)
+        )
+        at.fragments = {} if ok else None
+        at.oldFragments = at.fragmentCache.pop(root.v, {})
+        at.fragmentHits = at.fragmentMisses = at.fragmentVetoes = 0
+        at.subtreeHashes = {}
+        at.visitedList = []
+            # The vnodes visited by at.putBody, in order.
+    #@+node:agent.20261018104512.2: *5* at.finishFragments
+    def finishFragments(self, root):
+        '''
+        Remember the fragments used to write root.
+        Fragments of deleted nodes are discarded here.
+        '''
+        trace = False and not g.unitTesting
+        at = self
+        if at.fragments is not None and not at.errors:
+            at.fragmentCache[root.v] = at.fragments
+        if trace: g.trace('hits: %s misses: %s vetoes: %s %s' % (
+            at.fragmentHits, at.fragmentMisses, at.fragmentVetoes, root.h))
+        at.fragments = None
+        at.oldFragments = {}
+        at.subtreeHashes = {}
+        at.visitedList = []
     #@+node:ekr.20041005105605.160: *4* Writing 4.x
     #@+node:ekr.20041005105605.161: *5* at.putBody & helpers
     def putBody(self, p, fromString=''):
@@ -3631,6 +3853,8 @@ class AtFile(object):
         p.v.setVisited()
             # Make sure v is never expanded again.
             # Suppress orphans check.
+        if at.fragments is not None:
+            at.visitedList.append(p.v)
         s, trailingNewlineFlag = at.ensureTrailingNewline(s)
         at.raw = False # Bug fix.
         i = 0
@@ -3759,6 +3983,75 @@ class AtFile(object):
             at.putDirective(s, i)
         else:
             at.error('putBody: can not happen: unknown directive kind: %s' % kind)
+    #@+node:agent.20261018104512.3: *5* at.putFragment & helpers
+    def putFragment(self, p):
+        '''
+        Put p's node sentinels and body, including the expansions of @others
+        and section references in p.b. Return True if p.b contains @others.
+
+        Reuse the output of the previous write if neither p's tree nor the
+        state of the writer has changed.
+        '''
+        at = self
+        d = at.fragments
+        if d is None:
+            at.putOpenNodeSentinel(p)
+            at_others_flag = at.putBody(p)
+            at.putCloseNodeSentinel(p)
+            return at_others_flag
+        context = at.fragmentContext(p)
+        key = p.v, context
+        h = at.subtreeHash(p.v)
+        data = d.get(key) or at.oldFragments.get(key)
+        if data and data[0] == h:
+            junk, lines, visited, at_others_flag = data
+            at.outputFile.list.extend(lines)
+            for v in visited:
+                v.setVisited()
+            at.visitedList.extend(visited)
+            at.fragmentHits += 1
+            d[key] = data
+            return at_others_flag
+        # Remember the state of the writer.
+        lines, visited = at.outputFile.list, at.visitedList
+        n1, n2 = len(lines), len(visited)
+        errors, vetoes = at.errors, at.fragmentVetoes
+        # Write the fragment.
+        at.putOpenNodeSentinel(p)
+        at_others_flag = at.putBody(p)
+        at.putCloseNodeSentinel(p)
+        at.fragmentMisses += 1
+        # Cache the fragment only if nothing unusual happened.
+        if (
+            at.errors == errors and
+            at.fragmentVetoes == vetoes and
+            at.fragmentContext(p) == context
+        ):
+            d[key] = h, lines[n1:], visited[n2:], at_others_flag
+        return at_others_flag
+    #@+node:agent.20261018104512.4: *6* at.fragmentContext
+    def fragmentContext(self, p):
+        '''Return a tuple describing all state that affects p's fragment.'''
+        at = self
+        return (
+            p.level() - at.root.level(), at.indent,
+            at.startSentinelComment, at.endSentinelComment,
+            at.language, at.tab_width,
+        )
+    #@+node:agent.20261018104512.5: *6* at.subtreeHash
+    def subtreeHash(self, v):
+        '''
+        Return a hash of the gnx, headline, body and descendants of v.
+
+        This is fast: Python caches the hashes of strings.
+        '''
+        at = self
+        h = at.subtreeHashes.get(v)
+        if h is None:
+            h = hash((v.fileIndex, v._headString, v._bodyString,
+                tuple([at.subtreeHash(child) for child in v.children])))
+            at.subtreeHashes[v] = h
+        return h
     #@+node:ekr.20041005105605.164: *5* writing code lines...
     #@+node:ekr.20041005105605.165: *6* at.@all
     #@+node:ekr.20041005105605.166: *7* at.putAtAllLine
@@ -3836,9 +4129,7 @@ class AtFile(object):
             after = p.nodeAfterTree()
             while p and p != after:
                 if at.validInAtOthers(p):
-                    at.putOpenNodeSentinel(p)
-                    at_others_flag = at.putBody(p)
-                    at.putCloseNodeSentinel(p)
+                    at_others_flag = at.putFragment(p)
                     if at_others_flag:
                         p.moveToNodeAfterTree()
                     else:
@@ -3935,6 +4226,9 @@ class AtFile(object):
         '''Find a reference to name.  Raise an error if not found.'''
         at = self
         ref = g.findReference(name, p)
+        if ref and at.fragments is not None and not p.isAncestorOf(ref):
+            # An @root reference: the fragment depends on nodes outside p's tree.
+            at.fragmentVetoes += 1
         if not ref and not hasattr(at, 'allow_undefined_refs'):
             # Do give this error even if unit testing.
             at.writeError(
@@ -3999,9 +4293,7 @@ class AtFile(object):
         # Never put any @+middle or @-middle sentinels.
         at.indent += delta
         at.putSentinel("@+" + name)
-        at.putOpenNodeSentinel(ref)
-        at.putBody(ref)
-        at.putCloseNodeSentinel(ref)
+        at.putFragment(ref)
         at.putSentinel("@-" + name)
         at.indent -= delta
     #@+node:ekr.20041005105605.180: *5* writing doc lines...
@@ -5249,6 +5541,452 @@ class AtFile(object):
     #@-others
 
 atFile = AtFile # compatibility
+#@+node:agent.20261018090512.1: ** class ThinFileScanner
+class ThinFileScanner(object):
+    '''
+    A commander-independent scanner for external files containing new-style
+    (version 5, thin) sentinels.
+
+    The scanner duplicates the *results* of at.scanText4 without touching any
+    vnode, so that it can run in worker processes. It returns a picklable
+    description of the tree that at.linkScannedTree links into the outline.
+
+    The scanner gives up, returning None, whenever it sees anything unusual:
+    legacy sentinels, the cweb hack, @delims or any read error. at.read then
+    falls back to at.scanText4, which reports errors as usual.
+    '''
+    #@+others
+    #@+node:agent.20261018090512.2: *3* scanner.ctor
+    def __init__(self, fileName, tab_width):
+        '''Ctor for the ThinFileScanner class.'''
+        self.fileName = fileName
+        self.tab_width = tab_width
+        # Set by scanHeader.
+        self.start = None
+        self.end = None
+        # The results.
+        self.bodies = {}
+            # Keys are gnx's (None for the root), values are lists of lines.
+        self.events = []
+            # ('node', gnx, headline, level) or ('level', level).
+        self.lastLines = []
+    #@+node:agent.20261018090512.3: *3* scanner.scan & helpers
+    def scan(self, s):
+        '''
+        Scan s, the unicode contents of the external file.
+
+        Return a dict describing the tree, or None if at.scanText4 must read
+        the file.
+        '''
+        lines = g.splitLines(s)
+        i = self.scanHeader(lines)
+        if i is None:
+            return None
+        if not self.scanLines(lines, i):
+            return None
+        return {
+            'bodies': self.bodies,
+            'delims': (self.start, self.end),
+            'events': self.events,
+            'lastLines': self.lastLines,
+            'tab_width': self.tab_width,
+        }
+    #@+node:agent.20261018090512.4: *4* scanner.scanHeader
+    header_pattern = re.compile(
+        r'(.+)@\+leo(-ver=([0123456789]+))?(-thin)?(-encoding=(.*)(\.))?(.*)')
+        # The same pattern as at.parseLeoSentinel.
+
+    def scanHeader(self, lines):
+        '''
+        Set the comment delims from the @+leo sentinel.
+        Return the index of the line following the sentinel, or None.
+        '''
+        for i, line in enumerate(lines):
+            if line.find('@+leo') > -1:
+                break
+        else:
+            return None
+        m = self.header_pattern.match(line)
+        if not m or not m.group(1) or not m.group(3) or not m.group(4):
+            return None # Not a thin file.
+        if m.group(3) < '5':
+            return None # Old sentinels.
+        self.start, self.end = m.group(1), m.group(8)
+        if self.start.endswith('@'):
+            return None # The cweb hack.
+        return i + 1
+    #@+node:agent.20261018090512.5: *4* scanner.scanLines
+    def scanLines(self, lines, i):
+        '''
+        Scan all lines following the @+leo sentinel, emulating at.scanText4.
+        Return True if all went well.
+        '''
+        dispatch = {
+            'afterref': self.doAfterRef,
+            'directive': self.doDirective,
+            'endAll': self.doEndAll,
+            'endOthers': self.doEndOthers,
+            'endRef': self.doEndRef,
+            'node': self.doNode,
+            'startAll': self.doStartAll,
+            'startAt': self.doStartAt,
+            'startDoc': self.doStartDoc,
+            'startOthers': self.doStartOthers,
+            'startRef': self.doStartRef,
+            'verbatim': self.doVerbatim,
+        }
+        # Emulate the ivars of at.scanText4.
+        self.current = None # The key of at.v. None denotes the root.
+        self.depth = 0 # len(at.thinNodeStack)
+        self.docOut = []
+        self.inCode = True
+        self.indent = 0
+        self.lastRef = self.noRef # The key of at.lastRefNode.
+        self.lines = lines
+        self.raw = False
+        self.seen = set() # The keys of all nodes seen so far.
+        self.stack = [] # Entries are (kind, key, indent, depth).
+        self.index = i
+        while self.index < len(lines):
+            s = lines[self.index]
+            self.index += 1
+            kind, i = self.sentinelKind(s)
+            if kind is None:
+                return False
+            elif kind == 'normal':
+                self.doNormalLine(s)
+            elif kind == 'endLeo':
+                self.lastLines = lines[self.index:]
+                return True
+            elif not dispatch[kind](s, i):
+                return False
+        return False # No @-leo sentinel.
+    #@+node:agent.20261018090512.6: *4* scanner.sentinelKind
+    def sentinelKind(self, s):
+        '''
+        Return (kind, i) where i is the index following the '@' of the
+        sentinel. kind is None for sentinels that only at.scanText4 handles.
+        '''
+        i = g.skip_ws(s, 0)
+        if not g.match(s, i, self.start):
+            return 'normal', 0
+        i += len(self.start)
+        if not g.match(s, i, '@'):
+            return 'normal', 0
+        i += 1
+        if g.match(s, i, '+'):
+            j = g.skip_ws(s, i + 1)
+            if g.match(s, i + 1, 'others'):
+                return 'startOthers', i
+            if g.match(s, j, '<<'):
+                return 'startRef', i
+        elif g.match(s, i, '-'):
+            j = g.skip_ws(s, i + 1)
+            if g.match(s, i + 1, 'others'):
+                return 'endOthers', i
+            if g.match(s, j, '<<'):
+                return 'endRef', i
+        else:
+            j = g.skip_ws(s, i)
+            if j > i:
+                # Legacy sentinels allow whitespace after the '@'.
+                if g.match(s, j, '@+others') or g.match(s, j, '@-others') or g.match(s, j, '<<'):
+                    return None, i
+                return 'normal', 0
+        if g.match(s, i, '<<'):
+            return None, i # A legacy reference.
+        if g.match(s, i, '@'):
+            return 'directive', i
+        j = i + 1 if s[i: i + 1] in ('+', '-') else i
+        key = '@' + s[i: g.skip_c_id(s, j)]
+        if key not in AtFile.sentinelDict:
+            return 'normal', 0
+        kind = self.kindDict.get(key)
+        return kind, i
+
+    kindDict = {
+        '@+all': 'startAll',
+        '@-all': 'endAll',
+        '@+at': 'startAt',
+        '@+doc': 'startDoc',
+        '@-leo': 'endLeo',
+        '@+node': 'node',
+        '@afterref': 'afterref',
+        '@verbatim': 'verbatim',
+    }
+        # All other sentinels in at.sentinelDict must be read by at.scanText4.
+    #@+node:agent.20261018090512.7: *4* scanner.utils
+    noRef = object()
+        # The initial value of self.lastRef. None denotes the root.
+
+    def appendToOut(self, s):
+        '''Emulate at.appendToOut.'''
+        self.bodies.setdefault(self.current, []).append(s)
+
+    def changeLevel(self, level):
+        '''Emulate at.changeLevel, and remember the change for at.linkScannedTree.'''
+        if level <= self.depth:
+            self.depth = level
+        self.events.append(('level', level))
+
+    def flushDocPart(self, massage):
+        '''Append the pending doc part, if any. Return False on errors.'''
+        if self.docOut:
+            s = ''.join(self.docOut)
+            if massage and self.end:
+                # Emulate at.massageAtDocPart.
+                if s.startswith(self.start + '\n') and s.endswith(self.end + '\n'):
+                    s = s[len(self.start) + 1: -(len(self.end) + 1)]
+                else:
+                    return False
+            self.appendToOut(s)
+            self.docOut = []
+        return True
+
+    def lws(self, s):
+        '''Return the regularized leading whitespace of a sentinel line.'''
+        junk, w = g.skip_leading_ws_with_indent(s, 0, self.tab_width)
+        return g.computeLeadingWhitespace(max(0, w - self.indent), self.tab_width)
+
+    def nextLine(self):
+        '''Emulate at.readLine.'''
+        if self.index < len(self.lines):
+            s = self.lines[self.index]
+            self.index += 1
+            return s
+        return ''
+
+    def pop(self, kind):
+        '''Emulate at.popSentinelStack. Return the entry, or None.'''
+        if self.stack and self.stack[-1][0] == kind:
+            return self.stack.pop()
+        return None
+
+    def skipIndent(self, s, width):
+        '''Emulate at.skipIndent.'''
+        i = ws = 0
+        tab_width = abs(self.tab_width)
+        while i < len(s) and ws < width:
+            if s[i] == '\t': ws += (tab_width - (ws % tab_width))
+            elif s[i] == ' ': ws += 1
+            else: break
+            i += 1
+        return i
+
+    def toEnd(self, s, i):
+        '''Emulate at.skipToEndSentinel.'''
+        if self.end:
+            j = s.find(self.end, i)
+            if j > -1:
+                return j
+        return g.skip_to_end_of_line(s, i)
+    #@+node:agent.20261018090512.8: *4* scanner.doNormalLine
+    def doNormalLine(self, s):
+        '''Emulate at.readNormalLine and at.appendToDocPart.'''
+        if self.inCode:
+            if not self.raw:
+                n = g.computeLeadingWhitespaceWidth(s, self.tab_width)
+                if n < self.indent:
+                    if s.strip():
+                        s = r'\\-%s.%s' % (self.indent - n, s.lstrip())
+                    else:
+                        s = '\n' if s.endswith('\n') else ''
+                else:
+                    s = g.removeLeadingWhitespace(s, self.indent, self.tab_width)
+            self.appendToOut(s)
+        else:
+            if self.end:
+                i = self.skipIndent(s, self.indent)
+            else:
+                i = g.skip_ws(s, 0)
+                if g.match(s, i, self.start):
+                    i += len(self.start)
+                    if g.match(s, i, ' '): i += 1
+            self.docOut.append(s[i:])
+    #@+node:agent.20261018090512.9: *4* scanner.doNode
+    def doNode(self, s, i):
+        '''Emulate at.readStartNode for new-style sentinels.'''
+        if not g.match(s, i, '+node:'):
+            return False
+        i += 6
+        j = s.find(':', i)
+        if j == -1 or not g.match(s, j, ': *'):
+            return False
+        gnx = s[i: j]
+        i = j + 3
+        if g.match(s, i, ' '):
+            level = 1; i += 1
+        elif g.match(s, i, '* '):
+            level = 2; i += 2
+        else:
+            j = i
+            while i < len(s) and s[i].isdigit():
+                i += 1
+            if i == j or not g.match(s, i, '* '):
+                return False
+            level = int(s[j: i]); i += 2
+        if self.end:
+            h = s[i: s.rfind(self.end, i)].rstrip()
+        else:
+            h = s[i: -1].rstrip()
+        # Terminate the previous doc part *before* switching nodes.
+        self.flushDocPart(massage=False)
+        self.inCode = True
+        self.raw = False
+        junk, self.indent = g.skip_leading_ws_with_indent(s, 0, self.tab_width)
+        if self.depth == 0:
+            self.depth = 1 # The root: self.current remains None.
+        else:
+            self.depth = min(level, self.depth + 1)
+            self.current = gnx
+            if gnx in self.seen:
+                # at.createV5ThinNode: the last occurrence of a clone wins.
+                self.bodies.pop(gnx, None)
+        self.seen.add(gnx)
+        self.events.append(('node', gnx, h, level))
+        return True
+    #@+node:agent.20261018090512.10: *4* scanner.doStartOthers/Ref/All
+    def doStartOthers(self, s, i):
+        '''Emulate at.readStartOthers.'''
+        self.appendToOut(self.lws(s) + '@others\n')
+        self.stack.append(('others', self.current, self.indent, self.depth))
+        return True
+
+    def doStartRef(self, s, i):
+        '''Emulate at.readRef.'''
+        i += 1 # Skip the '+'.
+        if self.end:
+            line = self.lws(s) + s[i: s.find(self.end, i)] + '\n'
+        else:
+            line = self.lws(s) + s[i:]
+        self.appendToOut(line)
+        self.stack.append(('ref', self.current, self.indent, self.depth))
+        return True
+
+    def doStartAll(self, s, i):
+        '''Emulate at.readStartAll.'''
+        self.appendToOut(self.lws(s) + '@all\n')
+        self.stack.append(('all', self.current, self.indent, self.depth))
+        return True
+    #@+node:agent.20261018090512.11: *4* scanner.doEndOthers/Ref/All
+    def doEndOthers(self, s, i):
+        '''Emulate at.readEndOthers.'''
+        data = self.pop('others')
+        if not data or not self.flushDocPart(massage=True):
+            return False
+        self.inCode = True
+        self.raw = False
+        junk, self.current, self.indent, level = data
+        self.changeLevel(level)
+        return True
+
+    def doEndRef(self, s, i):
+        '''Emulate at.readEndRef.'''
+        data = self.pop('ref')
+        if not data:
+            return False
+        self.flushDocPart(massage=False)
+        self.inCode = True
+        self.raw = False
+        self.lastRef = self.current
+        junk, self.current, self.indent, level = data
+        self.changeLevel(level)
+        return True
+
+    def doEndAll(self, s, i):
+        '''Emulate at.readEndAll.'''
+        data = self.pop('all')
+        if not data:
+            return False
+        self.raw = False
+        junk, self.current, junk, level = data
+        self.changeLevel(level)
+        return True
+    #@+node:agent.20261018090512.12: *4* scanner.doStartAt & doStartDoc
+    def doStartAt(self, s, i):
+        '''Emulate at.readStartAt.'''
+        i += 3
+        self.appendToOut('@' + s[i: self.toEnd(s, i)] + '\n')
+        self.docOut = []
+        self.inCode = False
+        return True
+
+    def doStartDoc(self, s, i):
+        '''Emulate at.readStartDoc.'''
+        i += 4
+        self.appendToOut('@' + s[i: self.toEnd(s, i)] + '\n' + '\n')
+        self.docOut = []
+        self.inCode = False
+        return True
+    #@+node:agent.20261018090512.13: *4* scanner.doDirective
+    def doDirective(self, s, i):
+        '''Emulate at.readDirective.'''
+        if g.match_word(s, i, '@raw'):
+            self.raw = True
+        elif g.match_word(s, i, '@end_raw'):
+            self.raw = False
+        s2 = s[i:]
+        if self.end:
+            k = s.rfind(self.end, i)
+            if k != -1:
+                s2 = s[i: k] + '\n'
+        if s2.startswith('@c') and (
+            g.match_word(s2, 0, '@c') or g.match_word(s2, 0, '@code')
+        ):
+            if not self.flushDocPart(massage=True):
+                return False
+            self.inCode = True
+        self.appendToOut(s2)
+        return True
+    #@+node:agent.20261018090512.14: *4* scanner.doAfterRef & doVerbatim
+    def doAfterRef(self, s, i):
+        '''Emulate at.readAfterRef.'''
+        s = self.nextLine()
+        lines = self.bodies.get(self.current)
+        if self.lastRef is not self.noRef and self.bodies.get(self.lastRef):
+            if not lines:
+                return False # at.readAfterRef would crash.
+            if lines[-1].endswith('\n'):
+                lines[-1] = lines[-1][: -1]
+        self.appendToOut(s)
+        return True
+
+    def doVerbatim(self, s, i):
+        '''Emulate at.readVerbatim.'''
+        s = self.nextLine()
+        self.appendToOut(s[self.skipIndent(s, self.indent):])
+        return True
+    #@-others
+#@+node:agent.20261018090512.15: ** scanExternalFile (runs in worker processes)
+def scanExternalFile(fileName, encoding, tab_width):
+    '''
+    Read and scan the external file with new-style sentinels.
+
+    This function runs in worker processes started by at.startParallelScan,
+    so it must not use g.app or any commander.
+
+    Return a dict describing the tree, or None if at.read must scan the file
+    itself. The 'digest' key allows at.read to verify that it read the same
+    text.
+    '''
+    t1 = time.time()
+    try:
+        with open(fileName, 'rb') as f:
+            s = f.read()
+    except Exception:
+        return None
+    # Emulate at.readFileToUnicode. A wrong guess only causes a fallback.
+    e, s = g.stripBOM(s)
+    if not e:
+        s_temp = g.toUnicode(s, 'ascii', reportErrors=False)
+        m = re.search(r'@\+leo[^\n]*?-encoding=([^,.\n]*)', s_temp)
+        e = m.group(1) if m and g.isValidEncoding(m.group(1)) else encoding
+    s = g.toUnicode(s, encoding=e).replace('\r\n', '\n')
+    d = ThinFileScanner(fileName, tab_width).scan(s)
+    if d:
+        d['digest'] = hashlib.md5(g.toEncodedString(s)).hexdigest()
+        d['time'] = time.time() - t1
+    return d
 #@-others
 #@@language python
 #@@tabwidth -4
@@ -22,10 +22,10 @@ class BackgroundProcessManager(object):
 
     g.app.backgroundProcessManager is the singleton BPM.
 
-    The BPM registers a handler with the IdleTimeManager that checks whether
-    the presently running background process has completed. If so, the handler
-    writes the process's output to the log and starts another background
-    process in the queue.
+    The BPM registers a task with the IdleTimeManager that checks whether
+    the presently running background process has completed. If so, the task
+    writes the process's output to the log, one line at a time, and starts
+    another background process in the queue.
 
     BPM.start_process(c, command, kind, fn=None, shell=False) adds a process to
     the queue that will run the given command.
@@ -60,7 +60,8 @@ class BackgroundProcessManager(object):
             # List of g.Bunches.
         self.pid = None
             # The process id of the running process.
-        g.app.idleTimeManager.add_callback(self.on_idle)
+        g.app.idleTimeManager.add_task(
+            'background-processes', self.on_idle, priority=10)
 
     #@+others
     #@+node:ekr.20161028090624.1: *3* class ProcessData
@@ -145,8 +146,18 @@ class BackgroundProcessManager(object):
         self.put_log('%s finished' % kind)
     #@+node:ekr.20161026193609.4: *3* bpm.on_idle
     def on_idle(self):
-        '''The idle-time callback for leo.commands.checkerCommands.'''
+        '''
+        The idle-time task for leo.commands.checkerCommands.
+        Yield after writing each line of a finished process's output.
+        '''
         # g.trace('(BPM)', 'pid:', self.pid, 'queue:', len(self.process_queue))
+        pid = self.pid
+        if pid and pid.poll() is not None:
+            for s in pid.stdout:
+                if pid is not self.pid:
+                    return # The process was killed.
+                self.put_log(s)
+                yield
         if self.process_queue or self.pid:
             self.check_process()
     #@+node:ekr.20161028095553.1: *3* bpm.put_log
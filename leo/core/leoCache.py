@@ -7,15 +7,18 @@ import sys
 isPython3 = sys.version_info >= (3, 0, 0)
 import leo.core.leoGlobals as g
 import leo.core.leoNodes as leoNodes
+import leo.core.signal_manager as sig
 if isPython3:
     import pickle
 else:
     import cPickle as pickle
 # import glob
+import array
 import fnmatch
 import hashlib
 import os
 import stat
+import struct
 # import time
 import zlib
 import sqlite3
@@ -34,6 +37,8 @@ join = g.os_path_join
 normcase = g.os_path_normcase
 split = g.os_path_split
 SQLITE = True
+CACHE_RECORD_MAGIC = b'LEO\x01'
+    # The first bytes of all records made by cacher.makeCacheRecord.
 #@+others
 #@+node:ekr.20100208062523.5885: ** class Cacher
 class Cacher(object):
@@ -141,6 +146,62 @@ class Cacher(object):
         if trace: g.trace(m.hexdigest())
         return "fcache/" + m.hexdigest()
     #@+node:ekr.20100208082353.5925: *3* cacher.Reading
+    #@+node:agent.20261018101133.1: *4* cacher.createOutlineFromCacheRecord
+    def createOutlineFromCacheRecord(self, root_v, data, fileName):
+        '''
+        Create outline structure from the flat record built by
+        cacher.makeCacheRecord, in a single pass without recursion.
+
+        The results are the same as cacher.createOutlineFromCacheList.
+        '''
+        c = self.c
+        c.cacheListFileName = fileName
+        sig.emit(c, 'tree_changed', root_v)
+            # This method sets headlines, bodies and children directly.
+        gnxDict = c.fileCommands.gnxDict
+        parents, offsets, text = parseCacheRecord(data)
+        root_v._headString = text[offsets[1]: offsets[2]]
+        root_v._bodyString = text[offsets[2]: offsets[3]]
+        vnodes = [root_v]
+        checked = [False]
+            # True: node i already existed. Check it as in checkForChangedNodes.
+        cachedChildren = {}
+            # Keys are the indices of checked nodes.
+            # Values are the gnxs of their children in the cache.
+        for i in range(1, len(parents)):
+            k = 3 * i
+            gnx = text[offsets[k]: offsets[k + 1]]
+            h = text[offsets[k + 1]: offsets[k + 2]]
+            b = text[offsets[k + 2]: offsets[k + 3]]
+            j = parents[i]
+            parent_v = vnodes[j]
+            if checked[j]:
+                cachedChildren[j].append(gnx)
+                v = gnxDict.get(gnx)
+                isClone = v is not None
+                if not isClone:
+                    junk, v = self.fastAddLastChild(fileName, gnx, parent_v)
+            else:
+                isClone, v = self.fastAddLastChild(fileName, gnx, parent_v)
+            if isClone:
+                self.reportIfNodeChanged((h, b, gnx, None), v, fileName, parent_v)
+                cachedChildren[i] = []
+            else:
+                v._headString, v._bodyString = h, b
+            vnodes.append(v)
+            checked.append(isClone)
+        # Like checkForChangedNodes: remove and sort the children of checked nodes.
+        # Handle descendants before their ancestors.
+        for i in sorted(cachedChildren, reverse=True):
+            v, gnxs = vnodes[i], cachedChildren[i]
+            gnxes_in_cache = set(gnxs)
+            for_removal = [(n, child)
+                for n, child in enumerate(v.children)
+                if child.gnx not in gnxes_in_cache]
+            for n, child in reversed(for_removal):
+                child._cutLink(n, v)
+            for n, gnx in enumerate(gnxs):
+                v.children[n] = gnxDict.get(gnx)
     #@+node:ekr.20100208071151.5910: *4* cacher.createOutlineFromCacheList & helpers
     def createOutlineFromCacheList(self, parent_v, aList, fileName, top=True):
         '''
@@ -154,6 +215,8 @@ class Cacher(object):
         if top:
             if trace: g.trace(g.shortFileName(fileName))
             c.cacheListFileName = fileName
+            sig.emit(c, 'tree_changed', parent_v)
+                # This method sets headlines, bodies and children directly.
         if not aList:
             if trace: g.trace('no list')
             return
@@ -381,20 +444,74 @@ class Cacher(object):
         key = self.fileKey(fileName, s, requireEncodedString=True)
             # Fix bug #385: use the full fileName, not root.h.
         ok = self.db and key in self.db
+        if ok:
+            data = self.db.get(key)
+            if not isCacheRecord(data) and not isinstance(data, list):
+                # Not written by this version of Leo. Remove it, so that
+                # cacher.writeFile replaces it.
+                if trace: g.trace('unknown cache entry', key[-6:], sfn)
+                del self.db[key]
+                ok = False
         if ok:
             if trace and showHits: g.trace('cache hit', key[-6:], sfn)
             # Delete the previous tree, regardless of the @<file> type.
             while root.hasChildren():
                 root.firstChild().doDelete()
             # Recreate the file from the cache.
-            aList = self.db.get(key)
-            if trace and showList:
-                g.printList(list(g.flatten_list(aList)))
-            self.createOutlineFromCacheList(root.v, aList, fileName=fileName)
+            if isCacheRecord(data):
+                self.createOutlineFromCacheRecord(root.v, data, fileName=fileName)
+            else:
+                # A list written by Leo 5.7.2 or before.
+                if trace and showList:
+                    g.printList(list(g.flatten_list(data)))
+                self.createOutlineFromCacheList(root.v, data, fileName=fileName)
         elif trace:
             g.trace('cache miss', key[-6:], sfn)
         return s, ok, key
+    #@+node:agent.20261018090512.20: *4* cacher.isCached
+    def isCached(self, fileName):
+        '''Return True if cacher.readFile would find fileName in the cache.'''
+        if not g.enableDB or not self.db:
+            return False
+        s = g.readFileIntoEncodedString(fileName, silent=True)
+        if s is None:
+            return False
+        return self.fileKey(fileName, s, requireEncodedString=True) in self.db
     #@+node:ekr.20100208082353.5927: *3* cacher.Writing
+    #@+node:agent.20261018101133.2: *4* cacher.makeCacheRecord
+    def makeCacheRecord(self, p):
+        '''
+        Return a flat binary record describing p's tree, for use by
+        createOutlineFromCacheRecord.
+
+        The record contains CACHE_RECORD_MAGIC, the number of nodes n, an array
+        of n parent indices (in outline order, -1 for p), an array of 3n+1
+        offsets and a string table holding the gnx, headline and body of each
+        node. Offsets count characters of the *decoded* string table.
+
+        Arrays use the native byte order: caches are never shared between
+        machines.
+        '''
+        # This is called after at.readPostPass, so v.b *is* the body text.
+        parents = array.array('i')
+        offsets = array.array('I', [0])
+        strings = []
+        stack = [(p.v, -1)]
+        while stack:
+            v, parent = stack.pop()
+            n = len(parents)
+            parents.append(parent)
+            for s in (v.gnx, v.h, v.b):
+                strings.append(s)
+                offsets.append(offsets[-1] + len(s))
+            stack.extend([(child, n) for child in reversed(v.children)])
+        return b''.join([
+            CACHE_RECORD_MAGIC,
+            struct.pack('<I', len(parents)),
+            arrayToBytes(parents),
+            arrayToBytes(offsets),
+            g.toEncodedString(''.join(strings)),
+        ])
     #@+node:ekr.20100208071151.5901: *4* cacher.makeCacheList
     def makeCacheList(self, p):
         '''Create a recursive list describing a tree
@@ -445,7 +562,7 @@ class Cacher(object):
             if trace: g.trace('already cached', fileKey)
         else:
             if trace: g.trace('caching ', p.h, fileKey)
-            self.db[fileKey] = self.makeCacheList(p)
+            self.db[fileKey] = self.makeCacheRecord(p)
     #@+node:ekr.20100208065621.5890: *3* cacher.test
     def test(self):
         
@@ -808,6 +925,8 @@ class SqlitePickleShare(object):
 
         def loadz(data):
             if data:
+                if data[: len(CACHE_RECORD_MAGIC)] == CACHE_RECORD_MAGIC:
+                    return bytes(data) # Never pickled or compressed.
                 try:
                     val = pickle.loads(zlib.decompress(data))
                 except (ValueError, TypeError):
@@ -818,6 +937,8 @@ class SqlitePickleShare(object):
                 return None
 
         def dumpz(val):
+            if isCacheRecord(val):
+                return sqlite3.Binary(val)
             try:
                 # use Python 2's highest protocol, 2, if possible
                 data = pickle.dumps(val, protocol=2)
@@ -1011,6 +1132,38 @@ class SqlitePickleShare(object):
         """not used in SqlitePickleShare"""
         pass
     #@-others
+#@+node:agent.20261018101133.3: ** Cache records
+#@+node:agent.20261018101133.4: *3* arrayToBytes
+def arrayToBytes(a):
+    '''Return the contents of array a as bytes.'''
+    return a.tobytes() if isPython3 else a.tostring()
+#@+node:agent.20261018101133.5: *3* isCacheRecord
+def isCacheRecord(data):
+    '''Return True if data was made by cacher.makeCacheRecord.'''
+    return (
+        isinstance(data, bytes) and
+        data[: len(CACHE_RECORD_MAGIC)] == CACHE_RECORD_MAGIC)
+#@+node:agent.20261018101133.6: *3* parseCacheRecord
+def parseCacheRecord(data):
+    '''
+    Return (parents, offsets, text) for the record made by
+    cacher.makeCacheRecord. Only the string table is copied.
+    '''
+    i = len(CACHE_RECORD_MAGIC)
+    n = struct.unpack_from('<I', data, i)[0]
+    view = memoryview(data)
+    parents, offsets = array.array('i'), array.array('I')
+    i += 4
+    j = i + n * parents.itemsize
+    k = j + (3 * n + 1) * offsets.itemsize
+    if isPython3:
+        parents.frombytes(view[i: j])
+        offsets.frombytes(view[j: k])
+    else:
+        parents.fromstring(view[i: j].tobytes())
+        offsets.fromstring(view[j: k].tobytes())
+    text = g.toUnicode(view[k:].tobytes())
+    return parents, offsets, text
 #@-others
 #@@language python
 #@@tabwidth -4
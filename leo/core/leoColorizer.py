@@ -171,7 +171,7 @@ class JEditColorizer(BaseColorizer):
         self.language = 'python' # set by scanLanguageDirectives.
         self.showInvisibles = False
         # Step 2: create the highlighter.
-        if isinstance(widget, QtWidgets.QTextEdit):
+        if QtWidgets and isinstance(widget, QtWidgets.QTextEdit):
             self.highlighter = LeoHighlighter(c,
                 colorizer = self,
                 document = widget.document(),
@@ -187,7 +187,18 @@ class JEditColorizer(BaseColorizer):
         self.hyperCount = 0
         # State dicts, etc.
         self.after_doc_language = None
+        self.charsRegexDict = {}
+            # Keys are (id(d), negate), values are (d, stamp, regex).
+            # Created by jedit.charsRegex.
+        self.compiledRulesDict = {}
+            # Keys are id(rulesDict), values are (rulesDict, stamp, d, skip).
+            # Created by jedit.compileRules.
         self.initialStateNumber = -1
+        self.lineCache = {}
+            # Keys are vnodes, values are g.Bunches describing colorizer state.
+            # Created by jedit.addLineCacheEntry.
+        self.lineCacheEntry = None # The lineCache entry for self.old_v.
+        self.lineCacheList = [] # The keys of lineCache, most recently used last.
         self.old_v = None
         self.nextState = 1 # Dont use 0.
         self.n2languageDict = {-1: c.target_language}
@@ -204,6 +215,7 @@ class JEditColorizer(BaseColorizer):
         # Debugging...
         self.allow_mark_prev = True
         self.n_setTag = 0
+        self.recordedTags = None # A list of (tag, i, j) while colorLine records tags.
         self.tagCount = 0
         self.trace = False
         self.trace_leo_matches = False
@@ -370,6 +382,8 @@ class JEditColorizer(BaseColorizer):
         self.showInvisibles = c.config.getBool("show_invisibles_by_default")
         self.underline_undefined = c.config.getBool("underline_undefined_section_names")
         self.use_hyperlinks = c.config.getBool("use_hyperlinks")
+        self.lineCacheSize = c.config.getInt("colorizer-cache-size") or 0
+        self.clearLineCache()
         # There were in setFontFromConfig.
         self.bold_font = c.config.getFontFromParams(
             "body_text_font_family", "body_text_font_size",
@@ -437,8 +451,10 @@ class JEditColorizer(BaseColorizer):
             # ('<', self.match_image, True),
             ('<', self.match_section_ref, True), # Called **first**.
             # Rules added at back are added in normal order.
-            (' ', self.match_blanks, False),
-            ('\t', self.match_tabs, False),
+            # match_blanks and match_tabs always fail: Qt shows invisibles.
+            # Omitting them allows mainLoop to skip runs of blanks quickly.
+                # (' ', self.match_blanks, False),
+                # ('\t', self.match_tabs, False),
         ]
         if self.c.config.getBool("color_trailing_whitespace"):
             table += [
@@ -624,6 +640,25 @@ class JEditColorizer(BaseColorizer):
         self.restartDict = {}
         self.stateDict = {}
         self.stateNameDict = {}
+        self.lineCacheEntry = self.addLineCacheEntry(v)
+    #@+node:agent.20261018160000.2: *4* jedit.restore_all_state
+    def restore_all_state(self, v):
+        '''
+        Restore all state data for v from the line cache.
+        Return False if the cache contains no usable state for v.
+        '''
+        entry = self.lineCache.get(v)
+        if not entry or entry.language != self.language:
+            return False
+        self.old_v = v
+        self.n2languageDict = entry.n2languageDict
+        self.restartDict = entry.restartDict
+        self.stateDict = entry.stateDict
+        self.stateNameDict = entry.stateNameDict
+        self.nextState = max(list(self.stateDict.keys()) or [0]) + 1
+        self.lineCacheEntry = entry
+        self.touchLineCache(v)
+        return True
     #@+node:ekr.20110605121601.18581: *4* jedit.init_mode & helpers
     def init_mode(self, name):
         '''Name may be a language name or a delegate name.'''
@@ -1206,6 +1241,8 @@ class JEditColorizer(BaseColorizer):
     url_regex_w = re.compile(r"""wais://[^\s'"]+[\w=/]""")
     kinds = '(file|ftp|gopher|http|https|mailto|news|nntp|prospero|telnet|wais)'
     url_regex = re.compile(r"""%s://[^\s'"]+[\w=/]""" % (kinds))
+    # The start of anything that match_unl or match_any_url can match.
+    url_leadin_regex = re.compile(r"[uU][nN][lL]://|(file|ftp|http|https)://")
 
     def match_any_url(self, s, i):
         return self.match_compiled_regexp(s, i, kind='url', regexp=self.url_regex)
@@ -1336,13 +1373,14 @@ class JEditColorizer(BaseColorizer):
             # if trace: g.trace('not at word start',s[i-1])
             return 0
         # Get the word as quickly as possible.
-        j = i; n = len(s)
+        j = i
         chars = self.word_chars
         # 2013/11/04: A kludge just for Haskell:
         if self.language in ('haskell','clojure'):
             chars["'"] = "'"
-        while j < n and s[j] in chars:
-            j += 1
+        m = self.charsRegex(chars, negate=False).match(s, i)
+        if m:
+            j = m.end()
         word = s[i: j]
         # Fix part of #585: A kludge for css.
         if self.language == 'css' and word.endswith(':'):
@@ -1881,10 +1919,14 @@ class JEditColorizer(BaseColorizer):
                     ('%s.%s' % (delegate, tag)), i, j, s2, g.callers(2)))
             self.modeStack.append(self.modeBunch)
             self.init_mode(delegate)
+            d = None
             while 0 <= i < j and i < len(s):
                 progress = i
                 assert j >= 0, j
-                for f in self.rulesDict.get(s[i], []):
+                if d is not self.rulesDict:
+                    d = self.rulesDict
+                    rules, skip = self.compileRules(d)
+                for f in rules.get(s[i], []):
                     n = f(self, s, i)
                     if n is None:
                         g.trace('Can not happen: delegate matcher returns None')
@@ -1910,17 +1952,18 @@ class JEditColorizer(BaseColorizer):
             # Allow UNL's and URL's *everywhere*.
             j = min(j, len(s))
             while i < j:
-                ch = s[i].lower()
-                if ch == 'u':
+                # Find the next possible UNL or URL. Its leadin may extend past j.
+                m = self.url_leadin_regex.search(s, i, j + 7)
+                if not m or m.start() >= j:
+                    break
+                i = m.start()
+                if s[i] in 'uU':
                     n = self.match_unl(s, i)
                     # if n > 0: g.trace('found unl', s[i:i+n])
-                    i += max(1, n)
-                elif ch in 'fh': # file|ftp|http|https
+                else: # file|ftp|http|https
                     n = self.match_any_url(s, i)
                     # if n > 0: g.trace('found url', s[i:i+n])
-                    i += max(1, n)
-                else:
-                    i += 1
+                i += max(1, n)
     #@+node:ekr.20110605121601.18638: *3* jedit.mainLoop
     def mainLoop(self, n, s):
         '''Colorize a *single* line s, starting in state n.'''
@@ -1928,29 +1971,149 @@ class JEditColorizer(BaseColorizer):
         i = f(s) if f else 0
         # g.trace(i, n, repr(s), f)
         # if trace: g.trace('===== %30s %r' % (self.showCurrentState(), s))
+        d = None
         while i < len(s):
             progress = i
-            functions = self.rulesDict.get(s[i], [])
+            if d is not self.rulesDict:
+                d = self.rulesDict
+                rules, skip = self.compileRules(d)
+            functions = rules.get(s[i])
             # g.printList(functions)
-            for f in functions:
-                n = f(self, s, i)
-                if n is None:
-                    g.trace('Can not happen: n is None', repr(f))
-                    break
-                elif n > 0: # Success. The match has already been colored.
-                    # g.trace(n, i, f)
-                    i += n
-                    break
-                elif n < 0: # Total failure.
-                    # g.trace(n, i, f)
-                    i += -n
-                    break
-                else: # Partial failure: Do not break or change i!
-                    pass
+            if not functions:
+                # Skip all following characters that start no rule.
+                i = skip.match(s, i).end()
             else:
-                i += 1
+                for f in functions:
+                    n = f(self, s, i)
+                    if n is None:
+                        g.trace('Can not happen: n is None', repr(f))
+                        break
+                    elif n > 0: # Success. The match has already been colored.
+                        # g.trace(n, i, f)
+                        i += n
+                        break
+                    elif n < 0: # Total failure.
+                        # g.trace(n, i, f)
+                        i += -n
+                        break
+                    else: # Partial failure: Do not break or change i!
+                        pass
+                else:
+                    i += 1
             assert i > progress
         # Don't even *think* about changing state here.
+    #@+node:agent.20261018150000.1: *4* jedit.charsRegex
+    def charsRegex(self, d, negate, stamp=None):
+        '''
+        Return a compiled regex matching a run of characters that are keys of
+        d, or, if negate is True, that are not keys of d. Keys whose values
+        are empty are ignored.
+
+        The result is cached until stamp changes. By default, stamp is the
+        number of keys in d. compileRules passes its own stamp, which also
+        changes when a key's rule list changes from empty to non-empty.
+        '''
+        if stamp is None:
+            stamp = len(d)
+        key = id(d), negate
+        data = self.charsRegexDict.get(key)
+        if data and data[0] is d and data[1] == stamp:
+            return data[2]
+        chars = ''.join([re.escape(ch) for ch in sorted(d) if len(ch) == 1 and d.get(ch)])
+        if negate:
+            pattern = '[^%s]+' % chars if chars else r'[\s\S]+'
+        else:
+            pattern = '[%s]+' % chars if chars else '(?!)'
+        regex = re.compile(pattern, re.UNICODE)
+        self.charsRegexDict[key] = d, stamp, regex
+        return regex
+    #@+node:agent.20261018150000.2: *4* jedit.compileRules & helpers
+    def compileRules(self, rulesDict):
+        '''
+        Return (rules, skip) for rulesDict, the rules of one ruleset.
+
+        rules is equivalent to rulesDict, except that each run of two or more
+        rules that just call match_seq becomes a single rule that tests all
+        their seqs with one regex. skip is a regex matching runs of
+        characters that start no rule.
+
+        The result is cached until the keys of rulesDict or the number of
+        rules for any key changes.
+        '''
+        stamp = tuple(rulesDict), tuple(map(len, rulesDict.values()))
+        data = self.compiledRulesDict.get(id(rulesDict))
+        if data and data[0] is rulesDict and data[1] == stamp:
+            return data[2], data[3]
+        rules = {}
+        for ch, aList in rulesDict.items():
+            rules[ch] = self.compileRuleList(aList)
+        skip = self.charsRegex(rulesDict, negate=True, stamp=stamp)
+        self.compiledRulesDict[id(rulesDict)] = rulesDict, stamp, rules, skip
+        return rules, skip
+    #@+node:agent.20261018150000.5: *5* jedit.compileRuleList
+    def compileRuleList(self, aList):
+        '''Return a list of rules equivalent to aList, the rules for one character.'''
+        result, run = [], []
+        for f in list(aList) + [None]:
+            seq = f and self.seqRuleSeq(f)
+            if seq:
+                run.append((f, seq))
+                continue
+            if len(run) > 1:
+                result.append(self.makeSeqRule(run))
+            else:
+                result.extend([z[0] for z in run])
+            run = []
+            if f:
+                result.append(f)
+        return result
+    #@+node:agent.20261018150000.3: *5* jedit.makeSeqRule
+    def makeSeqRule(self, run):
+        '''
+        Return a rule equivalent to trying all the rules in run in order.
+        run is a list of (rule, seq) tuples.
+        '''
+        rulesDict = {}
+        for f, seq in run:
+            rulesDict.setdefault(seq, f)
+        # Alternatives match in order, so m.group(0) is the first seq that matches.
+        regex = re.compile('|'.join([re.escape(seq) for f, seq in run]))
+
+        def seq_rule(colorer, s, i):
+            m = regex.match(s, i)
+            return rulesDict[m.group(0)](colorer, s, i) if m else 0
+
+        return seq_rule
+    #@+node:agent.20261018150000.4: *5* jedit.seqRuleSeq
+    def seqRuleSeq(self, f):
+        '''
+        Return the seq argument if rule f just calls match_seq(s, i, seq=seq),
+        with no other constraints. Otherwise, return None.
+        '''
+        code = getattr(f, '__code__', None)
+        if not code or code.co_names != ('match_seq',) or code.co_argcount != 3:
+            return None
+
+        class Recorder(object):
+            '''Record the keyword arguments passed to match_seq.'''
+            keys = None
+            def match_seq(self, s, i, **keys):
+                self.keys = keys
+                return 0
+
+        recorder = Recorder()
+        try:
+            f(recorder, '', 0)
+        except Exception:
+            return None
+        keys = recorder.keys or {}
+        if set(keys) - set(['kind', 'seq', 'delegate',
+            'at_line_start', 'at_whitespace_end', 'at_word_start',
+        ]):
+            return None
+        if keys.get('at_line_start') or keys.get('at_whitespace_end') or keys.get('at_word_start'):
+            return None
+        return keys.get('seq') or None
     #@+node:ekr.20110605121601.18640: *3* jedit.recolor (color one line)
     def recolor(self, s):
         '''
@@ -1967,7 +2130,8 @@ class JEditColorizer(BaseColorizer):
         if p.v != self.old_v:
             self.updateSyntaxColorer(p) # Force a full recolor
             assert self.language
-            self.init_all_state(p.v)
+            if not self.restore_all_state(p.v):
+                self.init_all_state(p.v)
             self.init(p)
             if trace: g.trace('New node ==>', self.language, p.h)
         else:
@@ -1983,7 +2147,39 @@ class JEditColorizer(BaseColorizer):
             self.language, self.showState(n), block_n, g.truncate(s, 20)))
         # Always color the line, even if colorizing is disabled.
         if s:
+            self.colorLine(n, s)
+    #@+node:agent.20261018160000.3: *4* jedit.colorLine
+    lineCacheMaxLines = 50000 # The maximum number of lines in one lineCache entry.
+
+    def colorLine(self, n, s):
+        '''
+        Colorize line s, starting in state n.
+
+        Replay the tags and final state of a previous scan of the same line
+        in the same state if the line cache contains them.
+        '''
+        entry = self.lineCacheEntry
+        if not entry or s.startswith('@') or '<<' in s:
+            # Directives have side effects.
+            # The colors of section references depend on the outline.
             self.mainLoop(n, s)
+            return
+        key = (s, n)
+        data = entry.lines.get(key)
+        if data:
+            state, tags = data
+            for tag, i, j in tags:
+                self.setTag(tag, s, i, j)
+            self.setState(state)
+        else:
+            self.recordedTags = tags = []
+            try:
+                self.mainLoop(n, s)
+            finally:
+                self.recordedTags = None
+            if len(entry.lines) >= self.lineCacheMaxLines:
+                entry.lines.clear()
+            entry.lines[key] = (self.currentState(), tuple(tags))
     #@+node:ekr.20170126100139.1: *4* jedit.initBlock0
     def initBlock0 (self):
         '''
@@ -2025,6 +2221,41 @@ class JEditColorizer(BaseColorizer):
             return name
         else:
             return 'no-language'
+    #@+node:agent.20261018160000.4: *3* jedit.line cache
+    #@+node:agent.20261018160000.5: *4* jedit.addLineCacheEntry
+    def addLineCacheEntry(self, v):
+        '''
+        Add an entry for v to the line cache, using the present state dicts.
+        Return the entry, or None if the cache is disabled.
+        '''
+        if self.lineCacheSize <= 0:
+            return None
+        entry = g.Bunch(
+            language=self.language,
+            lines={}, # Keys are (s, n), values are (state, tags).
+            n2languageDict=self.n2languageDict,
+            restartDict=self.restartDict,
+            stateDict=self.stateDict,
+            stateNameDict=self.stateNameDict,
+        )
+        self.lineCache[v] = entry
+        self.touchLineCache(v)
+        return entry
+    #@+node:agent.20261018160000.6: *4* jedit.clearLineCache
+    def clearLineCache(self):
+        '''Clear the line cache, forcing a rescan of all lines.'''
+        self.lineCache = {}
+        self.lineCacheEntry = None
+        self.lineCacheList = []
+    #@+node:agent.20261018160000.7: *4* jedit.touchLineCache
+    def touchLineCache(self, v):
+        '''Make v the most recently used entry, evicting the least recently used.'''
+        aList = self.lineCacheList
+        if v in aList:
+            aList.remove(v)
+        aList.append(v)
+        while len(aList) > self.lineCacheSize:
+            del self.lineCache[aList.pop(0)]
     #@+node:ekr.20170205055743.1: *3* jedit.set_wikiview_patterns
     def set_wikiview_patterns(self, leadins, patterns):
         '''
@@ -2045,6 +2276,7 @@ class JEditColorizer(BaseColorizer):
                     aList.insert(0, wiki_rule)
                     d [ch] = aList
         self.rulesDict = d
+        self.clearLineCache()
         # g.trace('===== f') ; g.printList(d.get('f'))
         # g.trace('===== h') ; g.printList(d.get('h'))
         # g.trace('===== `') ; g.printList(d.get('`'))
@@ -2054,6 +2286,8 @@ class JEditColorizer(BaseColorizer):
         trace = False and not g.unitTesting
         trace_all = True
         self.n_setTag += 1
+        if self.recordedTags is not None:
+            self.recordedTags.append((tag, i, j))
         if i == j:
             if trace: g.trace('empty range')
             return
@@ -130,6 +130,8 @@ class Commands(object):
     def initDebugIvars(self):
         '''Init Commander debugging ivars.'''
         self.command_count = 0
+        self.directivesCacheHits = 0
+        self.directivesCacheMisses = 0
         self.scanAtPathDirectivesCount = 0
         self.trace_focus_count = 0
     #@+node:ekr.20120217070122.10471: *5* c.initDocumentIvars
@@ -748,14 +750,12 @@ class Commands(object):
     def all_nodes(self):
         '''A generator returning all vnodes in the outline, in outline order.'''
         c = self
-        for p in c.all_positions():
-            yield p.v
+        return c.hiddenRootNode.subtree()
 
     def all_unique_nodes(self):
-        '''A generator returning each vnode of the outline.'''
+        '''A generator returning each vnode of the outline, in outline order.'''
         c = self
-        for p in c.all_unique_positions():
-            yield p.v
+        return c.hiddenRootNode.unique_subtree()
 
     # Compatibility with old code...
     all_tnodes_iter = all_nodes
@@ -1184,14 +1184,14 @@ class Commands(object):
     #@+node:ekr.20031218072017.2984: *5* c.clearAllMarked
     def clearAllMarked(self):
         c = self
-        for p in c.all_unique_positions():
-            p.v.clearMarked()
+        for v in c.all_unique_nodes():
+            v.clearMarked()
     #@+node:ekr.20031218072017.2985: *5* c.clearAllVisited
     def clearAllVisited(self):
         c = self
-        for p in c.all_unique_positions():
-            p.v.clearVisited()
-            p.v.clearWriteBit()
+        for v in c.all_unique_nodes():
+            v.clearVisited()
+            v.clearWriteBit()
     #@+node:ekr.20060906211138: *5* c.clearMarked
     def clearMarked(self, p):
         c = self
@@ -3317,8 +3317,8 @@ class Commands(object):
     #@+node:ekr.20031218072017.2981: *6* c.canUnmarkAll
     def canUnmarkAll(self):
         c = self
-        for p in c.all_unique_positions():
-            if p.isMarked():
+        for v in c.all_unique_nodes():
+            if v.isMarked():
                 return True
         return False
     #@+node:ekr.20040323172420: *6* Slow routines: no longer used
@@ -9,6 +9,7 @@ import leo.core.leoGlobals as g
 from leo.plugins.mod_scripting import build_rclick_tree
 import os
 import sys
+import time
 # from copy import deepcopy
 #@-<< imports >>
 #@+<< class ParserBaseClass >>
@@ -34,8 +35,16 @@ class ParserBaseClass(object):
         'popup',
         'settings', 'shortcuts',
         ]
+    # Kinds whose handlers enable or disable the entire subtree.
+    # The scan stage evaluates these immediately.
+    filter_types = ['ifenv', 'ifhostname', 'ifplatform', 'ignore']
+    # Kinds whose handlers consume the entire subtree.
+    subtree_types = ['outlinedata']
     # Keys are settings names, values are (type,value) tuples.
     settingsDict = {}
+    # Keys are stripped shortcut lines, values are tuples.
+    # Shared by all parsers: the parse does not depend on the settings file.
+    shortcutLineCache = {}
     #@-<< ParserBaseClass data >>
     #@+others
     #@+node:ekr.20041119204700: *3*  ctor (ParserBaseClass)
@@ -84,6 +93,10 @@ class ParserBaseClass(object):
             'strings':      self.doStrings,
         }
         self.debug_count = 0
+        self.unl = None
+            # The UNL of the setting being converted, computed by the scan.
+        self.stats = {}
+            # Statistics and per-stage times of the last traverse.
     #@+node:ekr.20080514084054.4: *3* computeModeName (ParserBaseClass)
     def computeModeName(self, name):
         s = name.strip().lower()
@@ -856,17 +869,38 @@ class ParserBaseClass(object):
         settingName ! paneName = shortcut
         command-name --> mode-name = binding
         command-name --> same = binding
+
+        Return (name, bi). The parse of each line is cached in
+        shortcutLineCache, but each call returns a new g.BindingInfo.
+        '''
+        d = self.shortcutLineCache
+        data = d.get(s)
+        if data is None:
+            data = d[s] = self.scanShortcutLine(s)
+        entryCommandName, name, nextMode, pane, stroke = data
+        if entryCommandName is not None:
+            return None, g.BindingInfo('*entry-command*', commandName=entryCommandName)
+        if not stroke:
+            return name, None
+        bi = g.BindingInfo(
+            kind=kind,
+            nextMode=nextMode,
+            pane=pane,
+            stroke=stroke)
+        return name, bi
+    #@+node:agent.20261019000000.1: *5* scanShortcutLine (ParserBaseClass)
+    def scanShortcutLine(self, s):
+        '''
+        Scan a shortcut line.
+        Return (entryCommandName, name, nextMode, pane, stroke).
         '''
-        trace = False and not g.unitTesting and kind == '*mode-setting*'
-        # c = self.c
         name = val = nextMode = None; nextMode = 'none'
         i = g.skip_ws(s, 0)
         if g.match(s, i, '-->'): # New in 4.4.1 b1: allow mode-entry commands.
             j = g.skip_ws(s, i + 3)
             i = g.skip_id(s, j, '-')
             entryCommandName = s[j: i]
-            if trace: g.trace('-->', entryCommandName)
-            return None, g.BindingInfo('*entry-command*', commandName=entryCommandName)
+            return entryCommandName, None, None, None, None
         j = i
         i = g.skip_id(s, j, '-@') # #718.
         name = s[j: i]
@@ -876,8 +910,7 @@ class ParserBaseClass(object):
                 name = name[len(tag):]
                 break
         if not name:
-            if trace: g.trace('no name', repr(s))
-            return None, None
+            return None, None, None, None, None
         # New in Leo 4.4b2.
         i = g.skip_ws(s, i)
         if g.match(s, i, '->'): # New in 4.4: allow pane-specific shortcuts.
@@ -901,15 +934,8 @@ class ParserBaseClass(object):
             i = val.find('#')
             if i > 0 and val[i - 1] in (' ', '\t'):
                 val = val[: i].strip()
-        if not val:
-            return name, None
         stroke = g.KeyStroke(binding=val) if val else None
-        bi = g.BindingInfo(
-            kind=kind,
-            nextMode=nextMode,
-            pane=pane,
-            stroke=stroke)
-        return name, bi
+        return None, name, nextMode, pane, stroke
     #@+node:ekr.20041120094940.9: *3* set (ParserBaseClass)
     def set(self, p, kind, name, val):
         """Init the setting for name to val."""
@@ -934,11 +960,21 @@ class ParserBaseClass(object):
             if c.os_path_finalize(c.mFileName) != c.os_path_finalize(path):
                 g.es("over-riding setting:", name, "from", path)
         # Important: we can't use c here: it may be destroyed!
+        unl = self.unl
+        if unl is None:
+            unl = p and p.get_UNL(with_proto=True)
         d[key] = g.GeneralSetting(kind, path=c.mFileName, val=val, tag='setting',
-            unl=(p and p.get_UNL(with_proto=True)))
+            unl=unl)
     #@+node:ekr.20041119204700.1: *3* traverse (ParserBaseClass)
     def traverse(self, theme=False):
-        '''Traverse the entire settings tree.'''
+        '''
+        Traverse the entire settings tree in two stages:
+
+        1. scanSettingsTree creates a flat table of all settings.
+        2. convertSettings converts the table to settings and shortcuts.
+
+        self.stats contains the time taken by each stage.
+        '''
         trace = False and not g.unitTesting
         c = self.c
         self.settingsDict = g.TypedDict(
@@ -949,6 +985,7 @@ class ParserBaseClass(object):
             name='shortcutsDict for %s' % (c.shortFileName()),
             keyType=type('s'),
             valType=g.BindingInfo)
+        self.stats = {}
         # This must be called after the outline has been inited.
         p = c.config.settingsRoot(theme=theme)
         if not p:
@@ -957,22 +994,85 @@ class ParserBaseClass(object):
             if trace:
                 g.es_debug('no settings tree for %s' % (c.shortFileName()))
             return self.shortcutsDict, self.settingsDict
+        t1 = time.time()
+        table = self.scanSettingsTree(p)
+        t2 = time.time()
+        self.convertSettings(table)
+        t3 = time.time()
+        self.stats['scan'] = t2 - t1
+        self.stats['convert'] = t3 - t2
+        if trace:
+            g.trace('%s: %s nodes, %s settings, scan: %5.3f sec., convert: %5.3f sec.' % (
+                c.shortFileName(), self.stats['nodes'], len(table), t2 - t1, t3 - t2))
+        # Return the raw dict, unmerged.
+        return self.shortcutsDict, self.settingsDict
+    #@+node:agent.20261019000000.2: *4* scanSettingsTree (ParserBaseClass)
+    def scanSettingsTree(self, root):
+        '''
+        Scan the settings tree whose root is root, evaluating @if* and
+        @ignore nodes as we go.
+
+        Return a list of (p, f, kind, name, val, unl) tuples, in outline
+        order, where f is the handler that will convert the setting.
+        '''
+        table = []
+        n = 0
+        # Compute UNLs incrementally: p.get_UNL is much too slow.
+        # stack[i] is [unl, headline counts] for the ancestor at depth i.
+        root_level = root.level()
+        stack = []
+        p = root.copy()
         after = p.nodeAfterTree()
         while p and p != after:
-            result = self.visitNode(p)
-            if result == "skip":
-                # g.warning('skipping settings in',p.h)
+            n += 1
+            depth = p.level() - root_level
+            h = p.h
+            if depth == 0:
+                unl = p.get_UNL(with_proto=True)
+            else:
+                del stack[depth:]
+                parent_unl, counts = stack[-1]
+                count = counts.get(h, 0)
+                counts[h] = count + 1
+                # Must match p.get_UNL(with_proto=True).
+                s = '%s:%s' % (h.replace('-->', '--%3E'), p._childIndex)
+                if count:
+                    s = '%s,%s' % (s, count)
+                unl = parent_unl + '-->' + s.replace(' ', '%20')
+            stack.append([unl, {}])
+            data = self.scanNode(p) if h.startswith('@') else None
+            if data == 'skip':
                 p.moveToNodeAfterTree()
+            elif data:
+                f, kind, name, val = data
+                table.append((p.copy(), f, kind, name, val, unl))
+                if kind in self.subtree_types:
+                    p.moveToNodeAfterTree()
+                else:
+                    p.moveToThreadNext()
             else:
                 p.moveToThreadNext()
-        # Return the raw dict, unmerged.
-        return self.shortcutsDict, self.settingsDict
+        self.stats['nodes'] = n
+        self.stats['settings'] = len(table)
+        return table
+    #@+node:agent.20261019000000.3: *4* convertSettings (ParserBaseClass)
+    def convertSettings(self, table):
+        '''Convert the table created by scanSettingsTree.'''
+        try:
+            for p, f, kind, name, val, unl in table:
+                self.unl = unl
+                try:
+                    f(p, kind, name, val)
+                except Exception:
+                    g.es_exception()
+        finally:
+            self.unl = None
     #@+node:ekr.20041120094940.10: *3* valueError
     def valueError(self, p, kind, name, val):
         """Give an error: val is not valid for kind."""
         self.error("%s is not a valid %s for %s" % (val, kind, name))
-    #@+node:ekr.20041119204700.3: *3* visitNode (must be overwritten in subclasses)
-    def visitNode(self, p):
+    #@+node:ekr.20041119204700.3: *3* scanNode (must be overwritten in subclasses)
+    def scanNode(self, p):
         self.oops()
     #@-others
 #@-<< class ParserBaseClass >>
@@ -1989,13 +2089,14 @@ class SettingsTreeParser(ParserBaseClass):
     def __init__(self, c, localFlag=True):
         # Init the base class.
         ParserBaseClass.__init__(self, c, localFlag)
-    #@+node:ekr.20041119204714: *3* visitNode (SettingsTreeParser)
-    def visitNode(self, p):
-        """Init any settings found in node p."""
-        # g.trace(p.h)
-        p = p.copy()
-            # Bug fix 2011/11/24
-            # Ensure inner traversals don't change callers's p.
+    #@+node:ekr.20041119204714: *3* scanNode (SettingsTreeParser)
+    def scanNode(self, p):
+        """
+        Scan node p, an @ node in an @settings tree.
+
+        Return 'skip' if p's subtree should be ignored, None if p contains
+        no setting, or (f, kind, name, val) where f is the handler for p.
+        """
         munge = g.app.config.munge
         kind, name, val = self.parseHeadline(p.h)
         kind = munge(kind)
@@ -2009,17 +2110,19 @@ class SettingsTreeParser(ParserBaseClass):
             pass
         elif kind == "settings":
             pass
-        # elif kind in self.basic_types and val in (u'None',u'none','None','none','',None):
         elif kind in self.basic_types and isNone:
             # None is valid for all basic types.
-            self.set(p, kind, name, None)
+            return self.set, kind, name, None
+        elif kind in self.filter_types:
+            f = self.dispatchDict.get(kind)
+            try:
+                return f(p.copy(), kind, name, val)
+            except Exception:
+                g.es_exception()
         elif kind in self.control_types or kind in self.basic_types:
             f = self.dispatchDict.get(kind)
             if f:
-                try:
-                    return f(p, kind, name, val)
-                except Exception:
-                    g.es_exception()
+                return f, kind, name, val
             else:
                 g.pr("*** no handler", kind)
         return None
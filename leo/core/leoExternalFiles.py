@@ -3,9 +3,12 @@
 #@+node:ekr.20160306114544.1: * @file leoExternalFiles.py
 #@@first
 import leo.core.leoGlobals as g
+import errno
 import getpass
 import os
+import struct
 import subprocess
+import sys
 import tempfile
 import time
 #@+others
@@ -35,6 +38,117 @@ class ExternalFile(object):
         '''Return True if the external file still exists.'''
         return g.os_path_exists(self.path)
     #@-others
+#@+node:agent.20261018200000.1: ** class InotifyWatcher
+class InotifyWatcher(object):
+    '''
+    A class that watches directories for changed files using Linux's
+    inotify API, called through ctypes.
+
+    The ctor raises OSError if inotify is not available.
+    '''
+    # Constants from <sys/inotify.h>.
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    # Events that may change a file's contents or modification time.
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        '''Ctor for InotifyWatcher class.'''
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify requires Linux')
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.encoding = sys.getfilesystemencoding() or 'utf-8'
+        self.fd = fd
+        self.libc = libc
+        self.dirs_d = {}
+            # Keys are directories, values are watch descriptors.
+        self.wd_d = {}
+            # Keys are watch descriptors, values are lists of directories.
+            # Several paths may name the same directory.
+
+    def __repr__(self):
+        return '<InotifyWatcher: fd: %s dirs: %s>' % (self.fd, len(self.dirs_d))
+
+    __str__ = __repr__
+
+    #@+others
+    #@+node:agent.20261018200000.2: *3* watcher.close
+    def close(self):
+        '''Stop watching all directories.'''
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.dirs_d, self.wd_d = {}, {}
+    #@+node:agent.20261018200000.3: *3* watcher.forget
+    def forget(self, wd):
+        '''Forget the directories of a watch that the kernel has removed.'''
+        for directory in self.wd_d.pop(wd, []):
+            self.dirs_d.pop(directory, None)
+    #@+node:agent.20261018200000.4: *3* watcher.read_events
+    def read_events(self):
+        '''
+        Return the set of paths in watched directories that have changed
+        since the last call.
+
+        Return None if the kernel's event queue overflowed, so that events
+        may have been lost.
+        '''
+        paths, overflow = set(), False
+        while self.fd is not None:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            i = 0
+            while i + 16 <= len(data):
+                wd, mask, cookie, n = struct.unpack_from('iIII', data, i)
+                name = data[i + 16: i + 16 + n].rstrip(b'\0')
+                i += 16 + n
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                elif mask & self.IN_IGNORED:
+                    self.forget(wd)
+                elif name:
+                    name = g.toUnicode(name, self.encoding)
+                    for directory in self.wd_d.get(wd, []):
+                        paths.add(os.path.join(directory, name))
+        return None if overflow else paths
+    #@+node:agent.20261018200000.5: *3* watcher.watch_dirs
+    def watch_dirs(self, dirs):
+        '''
+        Watch exactly the given directories.
+        Directories that do not exist are ignored.
+        '''
+        for directory in list(self.dirs_d):
+            if directory not in dirs:
+                wd = self.dirs_d.pop(directory)
+                aList = self.wd_d.get(wd, [])
+                if directory in aList:
+                    aList.remove(directory)
+                if not aList:
+                    self.wd_d.pop(wd, None)
+                    self.libc.inotify_rm_watch(self.fd, wd)
+        for directory in dirs:
+            if directory not in self.dirs_d:
+                path = g.toEncodedString(directory, self.encoding)
+                wd = self.libc.inotify_add_watch(self.fd, path, self.mask)
+                if wd >= 0:
+                    self.dirs_d[directory] = wd
+                    self.wd_d.setdefault(wd, []).append(directory)
+    #@-others
 #@+node:ekr.20150405073203.1: ** class ExternalFilesController
 class ExternalFilesController(object):
     '''
@@ -73,9 +187,19 @@ class ExternalFilesController(object):
             # Keys are full paths, values are modification times.
             # DO NOT alter directly, use set_time(path) and
             # get_time(path), see set_time() for notes.
+        self.watched_d = {}
+            # Keys are commanders.
+            # Values are dicts: keys are full paths, values are lists of positions.
+        self.watched_time_d = {}
+            # Keys are commanders, values are the times of the last indexing.
+        self.pending_d = {}
+            # Keys are commanders, values are sets of watched paths
+            # that have had inotify events but have not yet been checked.
+        self.watcher = None
+            # An InotifyWatcher, False if inotify is not available.
         self.yesno_all_time = 0  # previous yes/no to all answer, time of answer
         self.yesno_all_answer = None  # answer, 'yes-all', or 'no-all'
-        g.app.idleTimeManager.add_callback(self.on_idle)
+        g.app.idleTimeManager.add_task('external-files', self.on_idle)
     #@+node:ekr.20150405105938.1: *3* efc.entries
     #@+node:ekr.20150405194745.1: *4* efc.check_overwrite (called from c.checkTimeStamp)
     def check_overwrite(self, c, path):
@@ -140,8 +264,12 @@ class ExternalFilesController(object):
 
     def on_idle(self):
         '''
-        Check for changed open-with files and all external files in commanders
-        for which @bool check_for_changed_external_file is True.
+        The idle-time task that checks for changed open-with files and all
+        external files in commanders for which
+        @bool check_for_changed_external_file is True.
+
+        Yield after checking each file, so that the IdleTimeManager can
+        spread one pass over several idle times.
         '''
         trace = False and not g.unitTesting and ((self.on_idle_count % 5) == 0)
         trace_idle = True
@@ -149,37 +277,31 @@ class ExternalFilesController(object):
             return
         t1 = time.time()
         self.on_idle_count += 1
-        if 1:
-            # Fix #262: Improve performance of check_for_changed_external_files.
-            if self.unchecked_files:
-                # Check all external files.
-                for ef in self.unchecked_files:
-                    if trace: g.trace('check', ef.shortFileName())
-                    self.idle_check_open_with_file(ef)
-                self.unchecked_files = []
-            elif self.unchecked_commanders:
-                # Check the next commander for which
-                # @bool check_for_changed_external_file is True.
-                c = self.unchecked_commanders.pop()
-                if trace: g.trace('check', c.shortFileName())
-                self.idle_check_commander(c)
-            else:
-                # Add all commanders for which
-                # @bool check_for_changed_external_file is True.
-                self.unchecked_commanders = [
-                    z for z in g.app.commanders() if self.is_enabled(z)
-                ]
-                self.unchecked_files = [z for z in self.files if z.exists()]
+        # Fix #262: Improve performance of check_for_changed_external_files.
+        # Check all open-with files.
+        self.unchecked_files = [z for z in self.files if z.exists()]
+        while self.unchecked_files:
+            ef = self.unchecked_files.pop(0)
+            if trace: g.trace('check', ef.shortFileName())
+            self.idle_check_open_with_file(ef)
+            yield
+        if self.get_watcher():
+            # Check only the external files that have had inotify events.
+            for z in self.idle_check_watched_files():
+                yield
         else:
-            # First, check all existing open-with files.
-            for ef in self.files: # A list of ExternalFile instances.
-                if ef.exists():
-                    self.idle_check_open_with_file(ef)
-            # Next, check all commanders for which
+            # Check all commanders for which
             # @bool check_for_changed_external_file is True.
-            for c in g.app.commanders():
-                if self.is_enabled(c):
-                    self.idle_check_commander(c)
+            self.unchecked_commanders = [
+                z for z in g.app.commanders() if self.is_enabled(z)
+            ]
+            while self.unchecked_commanders:
+                c = self.unchecked_commanders.pop(0)
+                if c not in g.app.commanders():
+                    continue
+                if trace: g.trace('check', c.shortFileName())
+                for z in self.idle_check_commander(c):
+                    yield
         if trace and trace_idle:
             t2 = time.time()
             n1 = len([z for z in self.files if z.exists()])
@@ -190,7 +312,7 @@ class ExternalFilesController(object):
     def idle_check_commander(self, c):
         '''
         Check all external files corresponding to @<file> nodes in c for
-        changes.
+        changes. Yield after checking each file.
         '''
         trace = False and not g.unitTesting
         if trace: g.trace('checking', c.shortFileName())
@@ -202,6 +324,10 @@ class ExternalFilesController(object):
             elif p.isAnyAtFileNode():
                 seen.add(p.v)
                 self.idle_check_at_file_node(c, p)
+                yield
+                # The outline may have changed, or c may have been closed.
+                if c not in g.app.commanders() or not c.positionExists(p):
+                    return
                 p.moveToNodeAfterTree()
             else:
                 p.moveToThreadNext()
@@ -217,6 +343,116 @@ class ExternalFilesController(object):
             # Always update the path & time to prevent future warnings.
             self.set_time(path)
             self.checksum_d[path] = self.checksum(path)
+    #@+node:agent.20261018200000.6: *5* efc.idle_check_watched_files & helpers
+    reindex_interval = 10.0
+        # Seconds between re-computing the paths of @<file> nodes.
+
+    def idle_check_watched_files(self):
+        '''
+        Check the @<file> nodes whose external files have had inotify events
+        in all commanders for which @bool check_for_changed_external_files
+        is True. Yield after checking each file.
+        '''
+        trace = False and not g.unitTesting
+        commanders = [z for z in g.app.commanders() if self.is_enabled(z)]
+        for c in list(self.watched_d):
+            if c not in commanders:
+                del self.watched_d[c]
+                del self.watched_time_d[c]
+                self.pending_d.pop(c, None)
+        # Index new commanders, and re-index others now and then,
+        # so that new, renamed and moved @<file> nodes are watched.
+        t = time.time()
+        new_nodes = []
+        for c in commanders:
+            if t - self.watched_time_d.get(c, 0) > self.reindex_interval:
+                new_nodes.extend(self.index_commander(c))
+        for z in self.check_new_nodes(new_nodes):
+            yield
+        paths = self.watcher.read_events()
+        if trace and paths: g.trace(sorted(paths))
+        if paths is None:
+            # Events were lost: check all files.
+            for c in commanders:
+                if c in g.app.commanders():
+                    for z in self.idle_check_commander(c):
+                        yield
+            return
+        # A path stays pending until all its @<file> nodes have been checked.
+        for path in paths:
+            for c in commanders:
+                if path in self.watched_d.get(c, {}):
+                    self.pending_d.setdefault(c, set()).add(path)
+        for c in commanders:
+            for path in sorted(self.pending_d.get(c, [])):
+                if c in g.app.commanders():
+                    for z in self.check_watched_path(c, path):
+                        yield
+    #@+node:agent.20261018200000.11: *6* efc.check_new_nodes
+    def check_new_nodes(self, new_nodes):
+        '''
+        Watch the directories of all watched files, then check the @<file>
+        nodes in new_nodes, a list of (c, p). Yield after checking each node.
+        '''
+        self.watcher.watch_dirs(set(
+            os.path.dirname(path)
+                for d in self.watched_d.values()
+                    for path in d))
+        # Check newly watched files after watching their directories.
+        for c, p in new_nodes:
+            if c in g.app.commanders() and c.positionExists(p):
+                self.idle_check_at_file_node(c, p)
+                yield
+    #@+node:agent.20261018200000.12: *6* efc.check_watched_path
+    def check_watched_path(self, c, path):
+        '''
+        Check all @<file> nodes of c whose external file is path.
+        Yield after checking each node.
+        '''
+        aList = self.watched_d.get(c, {}).get(path, [])
+        if not all(c.positionExists(p) for p in aList):
+            # The outline has changed. Re-index c now: path is already
+            # indexed, so the next scheduled re-index would not check it.
+            for z in self.check_new_nodes(self.index_commander(c)):
+                yield
+            if c not in g.app.commanders():
+                return
+            aList = self.watched_d[c].get(path, [])
+        for p in aList:
+            if c not in g.app.commanders():
+                return
+            if not c.positionExists(p):
+                # Leave path pending. c will be re-indexed on the next pass.
+                return
+            self.idle_check_at_file_node(c, p)
+            yield
+        self.pending_d.get(c, set()).discard(path)
+    #@+node:agent.20261018200000.7: *6* efc.index_commander
+    def index_commander(self, c):
+        '''
+        Recompute self.watched_d[c] for all @<file> nodes in c.
+        Return a list of (c, p) for nodes whose paths were not already
+        watched.
+        '''
+        old_d = self.watched_d.get(c, {})
+        d, result = {}, []
+        p = c.rootPosition()
+        seen = set()
+        while p:
+            if p.v in seen:
+                p.moveToNodeAfterTree()
+            elif p.isAnyAtFileNode():
+                seen.add(p.v)
+                path = g.fullPath(c, p)
+                d.setdefault(path, []).append(p.copy())
+                if path not in old_d:
+                    result.append((c, p.copy()))
+                p.moveToNodeAfterTree()
+            else:
+                p.moveToThreadNext()
+        self.watched_d[c] = d
+        self.watched_time_d[c] = time.time()
+        return result
     #@+node:ekr.20150407124259.1: *5* efc.idle_check_open_with_file & helper
     def idle_check_open_with_file(self, ef):
         '''Update the open-with node given by ef.'''
@@ -316,6 +552,8 @@ class ExternalFilesController(object):
         for ef in self.files[:]:
             self.destroy_external_file(ef)
         self.files = []
+        if self.watcher:
+            self.watcher.close()
     #@+node:ekr.20150405110219.1: *3* efc.utilities
     # pylint: disable=no-value-for-parameter
     #@+node:ekr.20150405200212.1: *4* efc.ask
@@ -452,6 +690,25 @@ class ExternalFilesController(object):
     def get_mtime(self, path):
         '''Return the modification time for the path.'''
         return g.os_path_getmtime(path)
+    #@+node:agent.20261018200000.8: *4* efc.get_watcher
+    def get_watcher(self):
+        '''
+        Return the InotifyWatcher used to check @<file> nodes, or None to
+        use the polling code.
+
+        Use inotify if it is available, unless
+        @bool check-for-changed-external-files-with-inotify is False.
+        '''
+        if self.watcher is None:
+            self.watcher = False
+            if g.app.config.getBool(
+                'check-for-changed-external-files-with-inotify', default=True
+            ):
+                try:
+                    self.watcher = InotifyWatcher()
+                except Exception:
+                    pass # Use the polling code.
+        return self.watcher or None
     #@+node:ekr.20150405122428.1: *4* efc.get_time
     def get_time(self, path):
         '''
@@ -23,14 +23,19 @@ import tempfile
 import zipfile
 try:
     # IronPython has problems with this.
+    import xml.parsers.expat
     import xml.sax
     import xml.sax.saxutils
+    import xml.sax.xmlreader
 except Exception:
     pass
 import sqlite3
 import hashlib
+import uuid
 from contextlib import contextmanager
 PRIVAREA = '---begin-private-area---'
+NOT_LOADED = object()
+    # The body and ua of LazyVNodes in fc.sqliteRows.
 #@-<< imports >>
 #@+others
 #@+node:ekr.20060918164811: ** Exception classes
@@ -90,6 +95,8 @@ if sys.platform != 'cli':
             # Global attributes of the .leo file...
             # self.body_outline_ratio = '0.5'
             self.global_window_position = {}
+            self.globalsAttrs = None # For fc.savePreReadData.
+            self.winPosAttrs = None # For fc.savePreReadData.
             self.encoding = 'utf-8'
             # Semantics...
             self.content = None
@@ -307,6 +314,7 @@ if sys.platform != 'cli':
             c = self.c
             if self.inClipboard:
                 return
+            self.globalsAttrs = attrs.copy()
             if trace: g.trace(c.mFileName)
             use_db = g.enableDB and c.mFileName
             if use_db:
@@ -327,6 +335,7 @@ if sys.platform != 'cli':
                     pass
         #@+node:ekr.20060919110638.38: *4* sax.startWinPos
         def startWinPos(self, attrs):
+            self.winPosAttrs = attrs.copy()
             self.global_window_position = self.getWindowPositionAttributes(attrs)
         #@+node:ekr.20060919110638.39: *4* sax.startLeoHeader
         def startLeoHeader(self, unused_attrs):
@@ -456,6 +465,222 @@ if sys.platform != 'cli':
             g.pr('children:', g.listToString(self.children))
             g.pr('attrs:', list(self.attributes.values()))
         #@-others
+#@+node:agent.20261018121500.1: ** class FastLeoReader
+if sys.platform != 'cli':
+
+    class FastLeoReader(object):
+        '''
+        Read a .leo file in one pass with expat, creating vnodes directly.
+
+        Unlike SaxContentHandler, this class creates no SaxNodeClass objects.
+        A SaxContentHandler handles all elements other than <v>, <vh> and <t>.
+        '''
+        #@+others
+        #@+node:agent.20261018121500.2: *3*  fast.__init__
+        def __init__(self, c, fileName, silent, inClipboard):
+            '''Ctor for FastLeoReader class.'''
+            self.c = c
+            self.at = c.atFileCommands
+            self.fc = c.fileCommands
+            self.fileName = fileName
+            self.handler = SaxContentHandler(c, fileName, silent, inClipboard)
+                # Handles <globals>, <vnodes>, etc. and processing instructions.
+            self.content = None
+                # A list of strings while reading <vh> or <t> elements.
+            self.createdDict = {}
+                # Keys are vnodes created by this reader. Values are True.
+            self.elementStack = []
+            self.errors = 0
+            self.oldBodies = {}
+                # Keys are existing vnodes whose body text this reader changed.
+                # Values are their original body text.
+            self.skip = 0
+                # > 0: Within the descendants of a clone.
+            self.stack = []
+                # Entries are [v, children, headline] for open <v> elements.
+                # stack[0] is the entry for c.hiddenRootNode.
+            self.tnxDict = {}
+                # Keys are tnx's (strings).
+                # Values are vnodes, or None for clones that were skipped.
+            self.vnode = None
+                # The vnode for the present <t> element.
+        #@+node:agent.20261018121500.3: *3* fast.error
+        def error(self, message):
+            g.pr('\n\nXML error: %s\n' % (message))
+            self.errors += 1
+        #@+node:agent.20261018121500.4: *3* fast.parse
+        def parse(self, s):
+            '''
+            Parse s, a bytes-like or string object.
+            Return the first top-level vnode, or None.
+            '''
+            c = self.c
+            try:
+                parser = xml.parsers.expat.ParserCreate()
+                parser.buffer_text = True
+                parser.StartElementHandler = self.startElement
+                parser.EndElementHandler = self.endElement
+                parser.CharacterDataHandler = self.characters
+                parser.ProcessingInstructionHandler = self.handler.processingInstruction
+                parser.Parse(s, True)
+            except Exception:
+                self.rollback()
+                raise
+            if not self.stack:
+                return None
+            parent_v, children, junk = self.stack[0]
+            assert parent_v == c.hiddenRootNode
+            parent_v.children = children
+            for child in children:
+                child.parents.append(parent_v)
+            return children[0] if children else None
+        #@+node:agent.20261018184000.1: *3* fast.rollback
+        def rollback(self):
+            '''
+            Undo all changes to existing vnodes and forget all created vnodes.
+            Afterwards, the outline is as it was before the read.
+            '''
+            gnxDict = self.fc.gnxDict
+            for v, b in self.oldBodies.items():
+                v.setBodyString(b)
+            for v in self.createdDict:
+                for child in v.children:
+                    if child not in self.createdDict:
+                        # An existing clone: unlink the created parent.
+                        child.parents = [z for z in child.parents if z is not v]
+                if gnxDict.get(v.fileIndex) is v:
+                    del gnxDict[v.fileIndex]
+        #@+node:agent.20261018121500.5: *3* fast.characters
+        def characters(self, content):
+            '''Handle character data.'''
+            if self.content is not None:
+                self.content.append(content.replace('\r', ''))
+            elif self.skip:
+                pass # Ignore the headlines of the descendants of clones.
+            elif content.strip():
+                elementName = self.elementStack[-1] if self.elementStack else '<no element name>'
+                g.pr('unexpected content:', elementName, repr(content))
+        #@+node:agent.20261018121500.6: *3* fast.startElement & helpers
+        def startElement(self, name, attrs):
+            '''Handle the start of any xml element.'''
+            name = name.lower()
+            self.elementStack.append(name)
+            if name == 'v':
+                self.startVnode(attrs)
+            elif name == 'vh':
+                if not self.skip:
+                    self.content = []
+            elif name == 't':
+                self.startTnode(attrs)
+            elif name == 'globals':
+                self.handler.startGlobals(self.saxAttrs(attrs))
+            elif name == 'global_window_position':
+                self.handler.startWinPos(self.saxAttrs(attrs))
+            elif name == 'vnodes':
+                self.handler.startVnodes(self.saxAttrs(attrs))
+            elif name not in self.handler.dispatchDict:
+                g.trace('unknown start element', name)
+        #@+node:agent.20261018121500.7: *4* fast.saxAttrs
+        def saxAttrs(self, attrs):
+            '''Convert an expat attributes dict to a sax Attributes object.'''
+            return xml.sax.xmlreader.AttributesImpl(attrs)
+        #@+node:agent.20261018121500.8: *4* fast.startTnode
+        def startTnode(self, attrs):
+            '''Handle the start of a <t> element.'''
+            self.content = []
+            self.vnode = None
+            if 'tnodes' not in self.elementStack:
+                self.error('<t> outside <tnodes>')
+            tx = attrs.get('tx')
+            if tx not in self.tnxDict:
+                self.error('Bad leo file: no node for <t tx=%s>' % (tx))
+                return
+            v = self.tnxDict.get(tx)
+            if v and v in self.createdDict:
+                self.vnode = v
+                # The tnode attributes replace the vnode's unknown attributes.
+                d = dict([(key, val) for key, val in attrs.items() if key != 'tx'])
+                self.fc.handleTnodeSaxAttributes(g.Bunch(tnodeAttributes=d), v)
+            elif v:
+                self.vnode = v
+        #@+node:agent.20261018121500.9: *4* fast.startVnode
+        # The native attributes of <v> elements are a, t, vtag, tnodeList,
+        # marks, expanded and descendentTnodeUnknownAttributes.
+
+        def startVnode(self, attrs):
+            '''Handle the start of a <v> element.'''
+            c, fc = self.c, self.fc
+            tnx = attrs.get('t')
+            if self.skip:
+                # Like fc.createSaxChildren, ignore the descendants of clones.
+                self.skip += 1
+                if tnx not in self.tnxDict:
+                    self.tnxDict[tnx] = None
+                return
+            if 'vnodes' not in self.elementStack:
+                self.error('<v> outside <vnodes>')
+            if not self.stack:
+                self.stack.append([c.hiddenRootNode, [], None])
+            v = fc.gnxDict.get(tnx)
+            if v:
+                # A clone. Don't look at the children.
+                self.skip = 1
+            else:
+                # Fix #158: Corrupt .leo files cause Leo to hang.
+                # Explicitly test against None: tnx could be 0.
+                if tnx is None:
+                    gnx = None
+                else:
+                    gnx = g.toUnicode(fc.canonicalTnodeIndex(tnx))
+                v = leoNodes.VNode(context=c, gnx=gnx)
+                self.at.bodySetInited(v)
+                self.createdDict[v] = True
+                d = dict([(key, val) for key, val in attrs.items() if key != 't'])
+                fc.handleVnodeSaxAttributes(g.Bunch(attributes=d), v)
+            if tnx is not None:
+                self.tnxDict[tnx] = v
+            self.stack[-1][1].append(v)
+            if not self.skip:
+                self.stack.append([v, [], ''])
+        #@+node:agent.20261018121500.10: *3* fast.endElement & helpers
+        def endElement(self, name):
+            '''Handle the end of any xml element.'''
+            name = name.lower()
+            if name == 'v':
+                self.endVnode()
+            elif name == 'vh':
+                if self.content is not None:
+                    self.stack[-1][2] = ''.join(self.content)
+                    self.content = None
+            elif name == 't':
+                self.endTnode()
+            name2 = self.elementStack.pop()
+            assert name == name2
+        #@+node:agent.20261018121500.11: *4* fast.endTnode
+        def endTnode(self):
+            '''Handle the end of a <t> element.'''
+            v, s = self.vnode, ''.join(self.content)
+            if v in self.createdDict:
+                v.setBodyString(s)
+            elif v and v.b != s:
+                # Like fc.updateSaxClone.
+                if v not in self.oldBodies:
+                    self.oldBodies[v] = v.b
+                v.setBodyString(s)
+                self.at.bodySetInited(v)
+            self.content = self.vnode = None
+        #@+node:agent.20261018121500.12: *4* fast.endVnode
+        def endVnode(self):
+            '''Handle the end of a <v> element.'''
+            if self.skip:
+                self.skip -= 1
+                return
+            v, children, h = self.stack.pop()
+            v.setHeadString(h)
+            v.children = children
+            for child in children:
+                child.parents.append(v)
+        #@-others
 #@+node:ekr.20160514120347.1: ** class FileCommands
 class FileCommands(object):
     """A class creating the FileCommands subcommander."""
@@ -480,6 +705,13 @@ class FileCommands(object):
             'expanded', 'marks', 't', 'tnodeList',
             # 'vtag',
         )
+        self.lazyConnection = None
+            # The connection from which fc.loadLazyVnodes reads.
+            # Not an ivar of fc.initIvars: LazyVNodes may outlive a read.
+        self.lazyCount = 0
+            # The number of LazyVNodes that have not been loaded.
+        self.lazyIgnoreSet = set()
+            # The gnx's of LazyVNodes whose body text contains "@ignore".
         self.initIvars()
     #@+node:ekr.20090218115025.5: *4* fc.initIvars
     def initIvars(self):
@@ -500,13 +732,34 @@ class FileCommands(object):
         self.descendentTnodeUaDictList = []
         self.descendentVnodeUaDictList = []
         self.ratio = 0.5
+        self.useFastReader = c.config.getBool('fast-leo-reader', default=True)
+            # True: fc.readSaxFile uses fc.readFastFile.
         self.currentVnode = None
+        self.preReadCommander = None
+            # The commander that pre-read the file being opened, or None.
+            # Set by LM.openFileByName, used by fc.adoptPreReadOutline.
+        self.preReadData = None
+            # A g.Bunch created by fc.savePreReadData.
+        self.saxHandler = None
+            # The SaxContentHandler used by the last read.
         # For writing...
         self.read_only = False
         self.rootPosition = None
         self.outputFile = None
         self.openDirectory = None
         self.putCount = 0
+        self.sqliteFileName = None
+            # The .db file to which fc.sqliteRows refers.
+        self.sqliteHashes = {}
+            # Keys are paths of external files.
+            # Values are ((mtime, size), md5) computed by fc.exportHashesToSqlite.
+        self.sqliteRows = None
+            # Keys are gnx's, values are the rows of the vnodes table
+            # last read from or written to fc.sqliteFileName.
+        self.sqliteSaveId = None
+            # The save_id entry of the extra_infos table for fc.sqliteRows.
+        self.sqliteTopLevel = None
+            # The gnx's of the top-level rows, in order, for fc.sqliteRows.
         self.toString = False
         self.usingClipboard = False
         self.currentPosition = None
@@ -610,6 +863,8 @@ class FileCommands(object):
                 silent=True, # don't tell about stylesheet elements.
                 inClipboard=True, reassignIndices=reassignIndices, s=s)
             if not v:
+                if reassignIndices:
+                    self.gnxDict = oldGnxDict
                 return g.es("the clipboard is not valid ", color="blue")
         finally:
             self.usingClipboard = False
@@ -755,13 +1010,19 @@ class FileCommands(object):
         c, fc = self.c, self
         try:
             ok = True
-            v = fc.readSaxFile(
-                theFile,
-                fileName,
-                silent,
-                inClipboard=False,
-                reassignIndices=False,
-            )
+            if fc.adoptPreReadOutline(fileName, silent):
+                children = c.hiddenRootNode.children
+                v = children[0] if children else None
+            else:
+                v = fc.readSaxFile(
+                    theFile,
+                    fileName,
+                    silent,
+                    inClipboard=False,
+                    reassignIndices=False,
+                )
+                if g.app.preReadFlag and not fileName.endswith('.db'):
+                    fc.savePreReadData(fileName)
             if v:
                 # readSaxFile sets c.hiddenRootNode.
                 pass
@@ -779,6 +1040,81 @@ class FileCommands(object):
                 c.alert(fc.mFileName + " is not a valid Leo file: " + str(message))
             ok = False
         return ok
+    #@+node:agent.20261018180000.1: *7* fc.adoptPreReadOutline
+    def adoptPreReadOutline(self, fileName, silent):
+        '''
+        Move the outline created by fc.preReadCommander, the commander that
+        pre-read fileName with a null gui, into this commander.
+
+        Return False if there is no such outline or if the file has changed.
+        '''
+        c, fc = self.c, self
+        c0, fc.preReadCommander = fc.preReadCommander, None
+        data = c0 and c0.fileCommands.preReadData
+        if not data or data.fileName != fileName:
+            return False
+        if not data.stamp or data.stamp != fc.getPreReadStamp(fileName):
+            return False
+        c0.fileCommands.preReadData = None
+        # Link the top-level vnodes to c.hiddenRootNode.
+        root0, root = c0.hiddenRootNode, c.hiddenRootNode
+        root.children, root0.children = root0.children, []
+        for v in root.children:
+            v.parents = [root if z is root0 else z for z in v.parents]
+        # Make c the context of all vnodes.
+        stack = list(root.children)
+        while stack:
+            v = stack.pop()
+            if v.context is not c:
+                v.context = c
+                fc.gnxDict[v.gnx] = v
+                stack.extend(v.children)
+        if hasattr(c0, 'bodyInitedDict'):
+            c.bodyInitedDict = c0.bodyInitedDict
+        # Restore the ivars set while reading.
+        fc.currentVnode = data.currentVnode
+        fc.descendentExpandedList = data.descendentExpandedList
+        fc.descendentMarksList = data.descendentMarksList
+        fc.descendentTnodeUaDictList = data.descendentTnodeUaDictList
+        fc.descendentVnodeUaDictList = data.descendentVnodeUaDictList
+        if data.stylesheet is not None:
+            c.frame.stylesheet = data.stylesheet
+        # Set the window geometry, as reading the <vnodes> element does.
+        # Compute the geometry and ratios for c, not c0.
+        handler = SaxContentHandler(c, fileName, silent, inClipboard=False)
+        if data.globalsAttrs is not None:
+            handler.startGlobals(data.globalsAttrs)
+        if data.winPosAttrs is not None:
+            handler.startWinPos(data.winPosAttrs)
+        handler.startVnodes(None)
+        return True
+    #@+node:agent.20261018180000.2: *7* fc.getPreReadStamp
+    def getPreReadStamp(self, fileName):
+        '''Return (mtime, size) for fileName, or None.'''
+        try:
+            return os.path.getmtime(fileName), os.path.getsize(fileName)
+        except Exception:
+            return None
+    #@+node:agent.20261018180000.3: *7* fc.savePreReadData
+    def savePreReadData(self, fileName):
+        '''
+        Save the data fc.adoptPreReadOutline needs to move the outline just
+        read into another commander.
+        '''
+        c, fc = self.c, self
+        handler = fc.saxHandler
+        fc.preReadData = g.Bunch(
+            currentVnode=fc.currentVnode,
+            descendentExpandedList=fc.descendentExpandedList,
+            descendentMarksList=fc.descendentMarksList,
+            descendentTnodeUaDictList=fc.descendentTnodeUaDictList,
+            descendentVnodeUaDictList=fc.descendentVnodeUaDictList,
+            fileName=fileName,
+            globalsAttrs=handler.globalsAttrs if handler else None,
+            stamp=fc.getPreReadStamp(fileName),
+            stylesheet=getattr(c.frame, 'stylesheet', None),
+            winPosAttrs=handler.winPosAttrs if handler else None,
+        )
     #@+node:ekr.20100205060712.8314: *6* fc.handleNodeConflicts
     def handleNodeConflicts(self):
         '''Create a 'Recovered Nodes' node for each entry in c.nodeConflictList.'''
@@ -1405,6 +1741,7 @@ class FileCommands(object):
                     # Hopefully the parser can figure out the encoding from the <?xml> element.
             # It's very hard to do anything meaningful wih an exception.
             handler = SaxContentHandler(c, inputFileName, silent, inClipboard)
+            self.saxHandler = handler
             parser.setContentHandler(handler)
             parser.parse(theFile) # expat does not support parseString
             # g.trace('parsing done')
@@ -1414,14 +1751,44 @@ class FileCommands(object):
             g.es_exception()
             sax_node = None
         return sax_node
+    #@+node:agent.20261018121500.13: *5* fc.readFastFile
+    def readFastFile(self, theFile, fileName, silent, inClipboard, s=None):
+        '''
+        Read the entire .leo file in one pass using a FastLeoReader.
+        Return the first top-level vnode, or None.
+        '''
+        c = self.c
+        if not theFile and not s:
+            return None
+        try:
+            if theFile:
+                # Use the open binary file, opened by the caller.
+                s = theFile.read()
+            elif g.isUnicode(s):
+                s = g.toEncodedString(s, 'utf-8')
+            s = self.cleanSaxInputString(s)
+            reader = FastLeoReader(c, fileName, silent, inClipboard)
+            self.saxHandler = reader.handler
+            v = reader.parse(s)
+        except Exception:
+            g.error('error parsing', fileName)
+            g.es_exception()
+            v = None
+        return v
     #@+node:ekr.20060919110638.3: *5* fc.readSaxFile
     def readSaxFile(self, theFile, fileName, silent, inClipboard, reassignIndices, s=None):
-        '''Read the entire .leo file using the sax parser.'''
+        '''
+        Read the entire .leo file using fc.readFastFile or the sax parser.
+        @bool fast-leo-reader = False selects the sax parser.
+        '''
         dump = False and not g.unitTesting
         fc = self; c = fc.c
 
         if fileName.endswith('.db'):
             return fc.retrieveVnodesFromDb(theFile) or fc.initNewDb(theFile)
+        if fc.useFastReader:
+            return fc.readFastFile(theFile, fileName,
+                silent=silent, inClipboard=inClipboard, s=s)
         #
         # Pass one: create the intermediate nodes.
         saxRoot = fc.parse_leo_file(theFile, fileName,
@@ -1446,24 +1813,24 @@ class FileCommands(object):
         '''
         trace = False and not g.unitTesting
         c = self.c
-        for p in c.all_unique_positions():
-            if hasattr(p.v, 'tempTnodeList'):
-                # g.trace(p.v.headString())
+        for v in c.all_unique_nodes():
+            if hasattr(v, 'tempTnodeList'):
+                # g.trace(v.headString())
                 result = []
-                for tnx in p.v.tempTnodeList:
+                for tnx in v.tempTnodeList:
                     index = self.canonicalTnodeIndex(tnx)
                     # new gnxs:
                     index = g.toUnicode(index)
-                    v = self.gnxDict.get(index)
-                    if v:
-                        if trace: g.trace(tnx, v)
-                        result.append(v)
+                    v2 = self.gnxDict.get(index)
+                    if v2:
+                        if trace: g.trace(tnx, v2)
+                        result.append(v2)
                     else:
                         g.trace('*** No VNode for %s' % tnx)
                 if result:
-                    p.v.tnodeList = result
-                    # g.trace('*** tnodeList for',p.h,result)
-                delattr(p.v, 'tempTnodeList')
+                    v.tnodeList = result
+                    # g.trace('*** tnodeList for',v.h,result)
+                delattr(v, 'tempTnodeList')
     #@+node:ekr.20080805132422.3: *5* fc.resolveArchivedPosition
     def resolveArchivedPosition(self, archivedPosition, root_v):
         '''
@@ -1503,17 +1870,30 @@ class FileCommands(object):
            method follows behavior of readSaxFile.'''
 
         fc = self; c = fc.c
-        sql = '''select gnx, head, 
-             body,
-             children,
-             parents,
-             iconVal,
-             statusBits,
-             ua from vnodes'''
+        lazy = c.config.getBool('sqlite-lazy-bodies', default=False)
+        if lazy:
+            # Read body text and uA's only when needed.
+            sql = '''select gnx, head,
+                 children,
+                 parents,
+                 iconVal,
+                 statusBits from vnodes'''
+        else:
+            sql = '''select gnx, head, 
+                 body,
+                 children,
+                 parents,
+                 iconVal,
+                 statusBits,
+                 ua from vnodes'''
         vnodes = []
+        rows = {}
         try:
 
             for row in conn.execute(sql):
+                if lazy:
+                    row = row[:2] + (NOT_LOADED,) + row[2:] + (NOT_LOADED,)
+                rows[row[0]] = row
                 (gnx,
                     h,
                     b,
@@ -1522,18 +1902,17 @@ class FileCommands(object):
                     iconVal,
                     statusBits,
                     ua) = row
-                try:
-                    ua = pickle.loads(g.toEncodedString(ua))
-                except ValueError:
-                    ua = None
                 v = leoNodes.VNode(context=c, gnx=gnx)
                 v._headString = h
-                v._bodyString = b
                 v.children = children.split()
                 v.parents = parents.split()
                 v.iconVal = iconVal
                 v.statusBits = statusBits
-                v.u = ua
+                if lazy:
+                    v.__class__ = leoNodes.LazyVNode
+                else:
+                    v._bodyString = b
+                    v.u = fc.unpickleUa(ua)
                 vnodes.append(v)
 
         except sqlite3.Error as er:
@@ -1555,12 +1934,90 @@ class FileCommands(object):
             v.children = [findNode(x) for x in v.children]
             v.parents = [findNode(x) for x in v.parents]
         c.hiddenRootNode.children = rootChildren
+        fc.setSqliteRows(conn, c.mFileName, rows)
+        if lazy:
+            if fc.lazyConnection:
+                fc.lazyConnection.close()
+            fc.lazyConnection = sqlite3.connect(c.mFileName)
+            fc.lazyCount = len(vnodes)
+            fc.lazyIgnoreSet = set(gnx for gnx, in conn.execute(
+                "select gnx from vnodes where instr(body, '@ignore') > 0"))
         (w, h, x, y, r1, r2, encp) = fc.getWindowGeometryFromDb(conn)
         c.frame.setTopGeometry(w, h, x, y, adjustSize=True)
         c.frame.resizePanesToRatio(r1, r2)
         p = fc.decodePosition(encp)
         c.setCurrentPosition(p)
         return rootChildren[0]
+    #@+node:agent.20261018220000.4: *6* fc.loadLazyTree
+    def loadLazyTree(self, p=None):
+        '''
+        Load all LazyVNodes in p's tree, or in the entire outline if p is
+        None. Call this before searching or writing many nodes.
+        '''
+        fc = self; c = fc.c
+        if fc.lazyCount:
+            if p:
+                fc.loadLazyVnodes(p.v.self_and_unique_subtree())
+            else:
+                fc.loadLazyVnodes(c.all_unique_nodes())
+    #@+node:agent.20261018220000.5: *6* fc.loadLazyVnodes
+    def loadLazyVnodes(self, vnodes):
+        '''
+        Read the body text and uA's of all LazyVNodes in vnodes from
+        fc.lazyConnection, and make them VNodes.
+        '''
+        fc = self
+        d = {}
+        for v in vnodes:
+            if isinstance(v, leoNodes.LazyVNode):
+                d[v.gnx] = v
+        if not d:
+            return
+        gnxs, n = list(d), 500
+        for i in range(0, len(gnxs), n):
+            aList = gnxs[i: i + n]
+            sql = 'select gnx, body, ua from vnodes where gnx in (%s)' % (
+                ','.join('?' * len(aList)))
+            for gnx, b, ua in fc.lazyConnection.execute(sql, aList):
+                row = fc.sqliteRows and fc.sqliteRows.get(gnx)
+                if row and row[2] is NOT_LOADED:
+                    fc.sqliteRows[gnx] = row[:2] + (b,) + row[3:7] + (ua,)
+                v = d.pop(gnx)
+                v.__class__ = leoNodes.VNode
+                v._bodyString = b or g.u('')
+                v.u = fc.unpickleUa(ua)
+                fc.lazyCount -= 1
+        for v in d.values():
+            # Not in the file: another program has changed it.
+            v.__class__ = leoNodes.VNode
+            v._bodyString = g.u('')
+            fc.lazyCount -= 1
+        if fc.lazyCount <= 0:
+            fc.lazyConnection.close()
+            fc.lazyConnection, fc.lazyCount = None, 0
+    #@+node:agent.20261018210000.1: *6* fc.setSqliteRows
+    def setSqliteRows(self, conn, fileName, rows):
+        '''
+        Remember the rows of the vnodes table just read from fileName,
+        so that fc.exportToSqlite can write only changed rows.
+        '''
+        fc = self
+        try:
+            row = conn.execute(
+                "select value from extra_infos where name='save_id'").fetchone()
+        except sqlite3.Error:
+            row = None
+        fc.sqliteFileName = fileName
+        fc.sqliteRows = rows
+        fc.sqliteSaveId = row and row[0]
+        fc.sqliteTopLevel = [v.gnx for v in fc.c.hiddenRootNode.children]
+    #@+node:agent.20261018220000.6: *6* fc.unpickleUa
+    def unpickleUa(self, ua):
+        '''Return the uA dict pickled in the ua column of the vnodes table.'''
+        try:
+            return pickle.loads(g.toEncodedString(ua))
+        except ValueError:
+            return None
     #@+node:vitalije.20170815162307.1: *6* fc.initNewDb
     def initNewDb(self, conn):
         ''' Initializes tables and returns None'''
@@ -1820,9 +2277,8 @@ class FileCommands(object):
         self.put("\t")
     #@+node:ekr.20141020112451.18335: *5* put_tabs
     def put_tabs(self, n):
-        while n > 0:
-            self.put("\t")
-            n -= 1
+        if n > 0:
+            self.put("\t" * n)
     #@+node:ekr.20031218072017.1971: *4* fc.putClipboardHeader
     def putClipboardHeader(self):
         # Put the minimum header for sax.
@@ -1956,15 +2412,18 @@ class FileCommands(object):
             if trace: g.trace(c.shortFileName(), s)
             self.put(s)
             self.put_nl()
-    #@+node:ekr.20031218072017.1577: *5* fc.putTnode
+    #@+node:ekr.20031218072017.1577: *5* fc.putTnode & tnodeString
     def putTnode(self, v):
-        # Call put just once.
+        self.put(self.tnodeString(v))
+
+    def tnodeString(self, v):
+        '''Return the <t> element for v.'''
         gnx = v.fileIndex
         # pylint: disable=consider-using-ternary
         ua = hasattr(v, 'unknownAttributes') and self.putUnknownAttributes(v) or ''
         b = v.b
         body = xml.sax.saxutils.escape(b) if b else ''
-        self.put('<t tx="%s"%s>%s</t>\n' % (gnx, ua, body))
+        return '<t tx="%s"%s>%s</t>\n' % (gnx, ua, body)
     #@+node:ekr.20031218072017.1575: *5* fc.putTnodes
     def putTnodes(self):
         """Puts all tnodes as required for copy or save commands"""
@@ -1976,17 +2435,19 @@ class FileCommands(object):
         '''Put all referenced tnodes.'''
         c = self.c
         if self.usingClipboard: # write the current tree.
-            theIter = self.currentPosition.self_and_subtree()
+            todo = [self.currentPosition.v]
         else: # write everything
-            theIter = c.all_unique_positions()
-        # Populate tnodes
-        tnodes = {}
-        for p in theIter:
-            # Make *sure* the file index has the proper form.
-            # pylint: disable=unbalanced-tuple-unpacking
-            index = p.v.fileIndex
-            tnodes[index] = p.v
-        # Put all tnodes in index order.
+            todo = c.hiddenRootNode.children[:]
+        # Populate tnodes, visiting each vnode once.
+        seen, tnodes = {}, {}
+        while todo:
+            v = todo.pop()
+            if v not in seen:
+                seen[v] = True
+                tnodes[v.fileIndex] = v
+                todo.extend(v.children)
+        # Put all tnodes in index order, with a single call to put.
+        result = []
         for index in sorted(tnodes):
             # g.trace(index)
             v = tnodes.get(index)
@@ -1994,26 +2455,39 @@ class FileCommands(object):
                 # Write only those tnodes whose vnodes were written.
                 # **Note**: @<file> trees are not written unless they contain clones.
                 if v.isWriteBit():
-                    self.putTnode(v)
+                    result.append(self.tnodeString(v))
             else:
                 g.trace('can not happen: no VNode for', repr(index))
                 # This prevents the file from being written.
                 raise BadLeoFile('no VNode for %s' % repr(index))
-    #@+node:ekr.20031218072017.1863: *5* fc.putVnode & helper
+        self.put(''.join(result))
+    #@+node:ekr.20031218072017.1863: *5* fc.putVnode & helpers
     def putVnode(self, p, isIgnore=False):
         """Write a <v> element corresponding to a VNode."""
+        result = []
+        self.putVnodeHelper(p, isIgnore, result)
+        self.put(''.join(result)) # Call put only once.
+    #@+node:agent.20261018130500.3: *6* fc.putVnodeHelper
+    def putVnodeHelper(self, p, isIgnore, result):
+        """Append the strings of p's <v> element to the result list."""
         fc = self
         v = p.v
-        isAuto = p.isAtAutoNode() and p.atAutoNodeName().strip()
-        isEdit = p.isAtEditNode() and p.atEditNodeName().strip() and not p.hasChildren()
-            # 2010/09/02: @edit nodes must not have children.
-            # If they do, the entire tree is written to the outline.
-        isFile = p.isAtFileNode()
-        isShadow = p.isAtShadowFileNode()
-        isThin = p.isAtThinFileNode()
-        isOrphan = p.isOrphan()
-        if not isIgnore:
-            isIgnore = p.isAtIgnoreNode()
+        h = v.h
+        if h.startswith('@'):
+            isAuto = v.isAtAutoNode() and v.atAutoNodeName().strip()
+            isEdit = v.isAtEditNode() and v.atEditNodeName().strip() and not v.children
+                # 2010/09/02: @edit nodes must not have children.
+                # If they do, the entire tree is written to the outline.
+            isFile = v.isAtFileNode()
+            isShadow = v.isAtShadowFileNode()
+            isThin = v.isAtThinFileNode()
+        else:
+            # An optimization: all these nodes start with '@'.
+            isAuto = isEdit = isFile = isShadow = isThin = False
+        isOrphan = v.isOrphan()
+        if not isIgnore and (isAuto or isEdit or isFile or isShadow or isThin or v.children):
+            # An optimization: isIgnore does not matter for other nodes.
+            isIgnore = v.isAtIgnoreNode()
         # 2010/10/22: force writes of orphan @edit, @auto and @shadow trees.
         if isIgnore: forceWrite = True # Always write full @ignore trees.
         elif isAuto: forceWrite = isOrphan # Force write of orphan @auto trees.
@@ -2029,24 +2503,23 @@ class FileCommands(object):
         # Write the node.
         v_head = '<v t="%s"%s>' % (gnx, attrs)
         if gnx in fc.vnodesDict:
-            fc.put(v_head + '</v>\n')
+            result.append(v_head + '</v>\n')
         else:
             fc.vnodesDict[gnx] = True
-            v_head += '<vh>%s</vh>' % (xml.sax.saxutils.escape(p.v.headString() or ''))
+            v_head += '<vh>%s</vh>' % (xml.sax.saxutils.escape(h or ''))
             # New in 4.2: don't write child nodes of @file-thin trees
             # (except when writing to clipboard)
-            if p.hasChildren() and (forceWrite or self.usingClipboard):
-                fc.put('%s\n' % v_head)
+            if v.children and (forceWrite or self.usingClipboard):
+                result.append('%s\n' % v_head)
                 # This optimization eliminates all "recursive" copies.
                 p.moveToFirstChild()
-                while 1:
-                    fc.putVnode(p, isIgnore)
-                    if p.hasNext(): p.moveToNext()
-                    else: break
+                for i in range(len(v.children)):
+                    if i: p.moveToNext()
+                    fc.putVnodeHelper(p, isIgnore, result)
                 p.moveToParent() # Restore p in the caller.
-                fc.put('</v>\n')
+                result.append('</v>\n')
             else:
-                fc.put('%s</v>\n' % v_head) # Call put only once.
+                result.append('%s</v>\n' % v_head)
     #@+node:ekr.20031218072017.1865: *6* fc.compute_attribute_bits
     def compute_attribute_bits(self, forceWrite, p):
         '''Return the initial values of v's attributes.'''
@@ -2093,18 +2566,19 @@ class FileCommands(object):
         """Puts all <v> elements in the order in which they appear in the outline."""
         c = self.c
         c.clearAllVisited()
-        self.put("<vnodes>\n")
         # Make only one copy for all calls.
         self.currentPosition = p or c.p
         self.rootPosition = c.rootPosition()
         self.vnodesDict = {}
+        result = ["<vnodes>\n"]
         if self.usingClipboard:
-            self.putVnode(self.currentPosition) # Write only current tree.
+            self.putVnodeHelper(self.currentPosition, False, result) # Write only current tree.
         else:
             for p in c.rootPosition().self_and_siblings():
                 # New in Leo 4.4.2 b2 An optimization:
-                self.putVnode(p, isIgnore=p.isAtIgnoreNode()) # Write the next top-level node.
-        self.put("</vnodes>\n")
+                self.putVnodeHelper(p, p.isAtIgnoreNode(), result) # Write the next top-level node.
+        result.append("</vnodes>\n")
+        self.put(''.join(result))
     #@+node:ekr.20031218072017.1247: *5* fc.putXMLLine
     def putXMLLine(self):
         '''Put the **properly encoded** <?xml> element.'''
@@ -2150,6 +2624,7 @@ class FileCommands(object):
         if g.SQLITE and fileName and fileName.endswith('.db'):
             return fc.exportToSqlite(fileName)
 
+        fc.loadLazyTree()
         try:
             fc.putCount = 0
             fc.toString = toString
@@ -2317,42 +2792,68 @@ class FileCommands(object):
         theFile.close()
     #@+node:vitalije.20170630172118.1: *5* fc.exportToSqlite
     def exportToSqlite(self, fileName):
-        '''Dump all vnodes to sqlite database. Returns True on success.'''
+        '''
+        Dump all vnodes to sqlite database. Returns True on success.
+
+        Only rows that differ from fc.sqliteRows are written, in a single
+        transaction.
+        '''
         # fc = self
         c = self.c; fc = self
         if c.sqlite_connection is None:
             c.sqlite_connection = sqlite3.connect(fileName, 
                                         isolation_level='DEFERRED')
-        conn = c.sqlite_connection
-        def dump_u(v):
             try:
-                s = pickle.dumps(v.u, protocol=1)
-            except pickle.PicklingError:
-                s = ''
-                g.trace('unpickleable value', repr(v.u))
-            return s
-        dbrow = lambda v:(
-                v.gnx,
-                v.h,
-                v.b,
-                ' '.join(x.gnx for x in v.children),
-                ' '.join(x.gnx for x in v.parents),
-                v.iconVal,
-                v.statusBits,
-                dump_u(v)
-            )
+                c.sqlite_connection.execute('pragma journal_mode=wal')
+            except sqlite3.Error:
+                pass # Use the default journal.
+        conn = c.sqlite_connection
         ok = False
         try:
             fc.prepareDbTables(conn)
             fc.exportDbVersion(conn)
-            fc.exportVnodesToSqlite(conn, (dbrow(v) for v in c.all_unique_nodes()))
+            rows = dict((v.gnx, fc.sqliteRow(v)) for v in c.all_unique_nodes())
+            fc.exportVnodesToSqlite(conn, fileName, rows)
             fc.exportGeomToSqlite(conn)
             fc.exportHashesToSqlite(conn)
             conn.commit()
             ok = True
         except sqlite3.Error as e:
+            conn.rollback()
+            fc.sqliteRows = None
             g.internalError(e)
         return ok
+    #@+node:agent.20261018220000.7: *6* fc.sqliteRow
+    empty_ua = pickle.dumps({}, protocol=1)
+
+    def sqliteRow(self, v):
+        '''
+        Return the row of the vnodes table for v.
+        The body and ua of LazyVNodes are NOT_LOADED.
+        '''
+        lazy = isinstance(v, leoNodes.LazyVNode)
+        if lazy:
+            b = ua = NOT_LOADED
+        else:
+            b = v.b
+            if v.u:
+                try:
+                    ua = pickle.dumps(v.u, protocol=1)
+                except pickle.PicklingError:
+                    ua = ''
+                    g.trace('unpickleable value', repr(v.u))
+            else:
+                ua = self.empty_ua
+        return (
+            v.gnx,
+            v.h,
+            b,
+            ' '.join(x.gnx for x in v.children),
+            ' '.join(x.gnx for x in v.parents),
+            v.iconVal,
+            v.statusBits,
+            ua,
+        )
     #@+node:vitalije.20170705075107.1: *6* fc.decodePosition
     def decodePosition(self, s):
         '''Creates position from its string representation encoded by fc.encodePosition.'''
@@ -2376,7 +2877,6 @@ class FileCommands(object):
         return jn.join(res)
     #@+node:vitalije.20170811130512.1: *6* fc.prepareDbTables
     def prepareDbTables(self, conn):
-        conn.execute('''drop table if exists vnodes;''')
         conn.execute('''
             create table if not exists vnodes(
                 gnx primary key,
@@ -2389,11 +2889,79 @@ class FileCommands(object):
                 ua);''')
         conn.execute('''create table if not exists extra_infos(name primary key, value)''')
     #@+node:vitalije.20170701161851.1: *6* fc.exportVnodesToSqlite
-    def exportVnodesToSqlite(self, conn, rows):
+    def exportVnodesToSqlite(self, conn, fileName, rows):
+        '''
+        Make the vnodes table match rows, a dict whose keys are gnx's and
+        whose values are rows of the table.
+
+        Write all rows unless fc.sqliteRows describes the table. Otherwise
+        update changed rows, insert new rows and delete rows for removed
+        nodes.
+
+        Readers find top-level nodes in the order of their rows, so updates
+        must not move rows. If the top-level nodes change, re-insert all
+        top-level rows in order.
+        '''
+        fc = self
+        top = [v.gnx for v in fc.c.hiddenRootNode.children]
+        old_rows = fc.sqliteRows
+        if old_rows is not None:
+            try:
+                row = conn.execute(
+                    "select value from extra_infos where name='save_id'").fetchone()
+            except sqlite3.Error:
+                row = None
+            if fc.sqliteFileName != fileName or not row or row[0] != fc.sqliteSaveId:
+                # Another program may have changed the table.
+                old_rows = None
+        if old_rows is None:
+            conn.execute('delete from vnodes;')
+            old_rows, old_top = {}, []
+        else:
+            old_top = fc.sqliteTopLevel
+        if top != old_top:
+            conn.executemany('delete from vnodes where gnx=?;',
+                [(gnx,) for gnx in top if gnx in old_rows])
+            old_rows = dict(old_rows)
+            for gnx in top:
+                old_rows.pop(gnx, None)
+        # New rows need the body and ua of LazyVNodes.
+        lazy = [fc.gnxDict.get(gnx) for gnx, row in rows.items()
+            if gnx not in old_rows and row[2] is NOT_LOADED]
+        if lazy:
+            fc.loadLazyVnodes(lazy)
+            for v in lazy:
+                rows[v.gnx] = fc.sqliteRow(v)
+        conn.executemany('delete from vnodes where gnx=?;',
+            [(gnx,) for gnx in old_rows if gnx not in rows])
+        # Insert top-level rows first, in order.
         conn.executemany('''insert into vnodes
             (gnx, head, body, children, parents,
                 iconVal, statusBits, ua)
-            values(?,?,?,?,?,?,?,?);''', rows)
+            values(?,?,?,?,?,?,?,?);''',
+            [rows[gnx] for gnx in top if gnx not in old_rows] +
+            [row for gnx, row in rows.items()
+                if gnx not in old_rows and gnx not in top])
+        changed = [row for gnx, row in rows.items()
+            if gnx in old_rows and old_rows[gnx] != row]
+        conn.executemany('''update vnodes set
+            head=?, body=?, children=?, parents=?,
+                iconVal=?, statusBits=?, ua=?
+            where gnx=?;''',
+            [row[1:] + row[:1] for row in changed if row[2] is not NOT_LOADED])
+        # The body and ua of LazyVNodes have not changed.
+        conn.executemany('''update vnodes set
+            head=?, children=?, parents=?,
+                iconVal=?, statusBits=?
+            where gnx=?;''',
+            [row[1:2] + row[3:7] + row[:1] for row in changed if row[2] is NOT_LOADED])
+        save_id = uuid.uuid4().hex
+        conn.execute("replace into extra_infos(name, value) values('save_id', ?)",
+            (save_id,))
+        fc.sqliteFileName = fileName
+        fc.sqliteRows = rows
+        fc.sqliteSaveId = save_id
+        fc.sqliteTopLevel = top
     #@+node:vitalije.20170701162052.1: *6* fc.exportGeomToSqlite
     def exportGeomToSqlite(self, conn):
         c = self.c
@@ -2416,14 +2984,24 @@ class FileCommands(object):
         conn.execute("replace into extra_infos(name, value) values('dbversion', ?)", ('1.0',))
     #@+node:vitalije.20170701162204.1: *6* fc.exportHashesToSqlite
     def exportHashesToSqlite(self, conn):
-        c = self.c
+        c = self.c; d = self.sqliteHashes
         def md5(x):
+            # Recompute the hash only if the file's mtime or size has changed.
+            try:
+                st = os.stat(x)
+            except Exception:
+                return ''
+            stamp = st.st_mtime, st.st_size
+            data = d.get(x)
+            if data and data[0] == stamp:
+                return data[1]
             try:
                 s = open(x, 'rb').read()
             except Exception:
                 return ''
             s = s.replace(b'\r\n', b'\n')
-            return hashlib.md5(s).hexdigest()
+            d[x] = stamp, hashlib.md5(s).hexdigest()
+            return d[x][1]
         files = set()
 
         p = c.rootPosition()
@@ -2536,13 +3114,17 @@ class FileCommands(object):
     def putDescendentAttributes(self, p):
 
         # Create lists of all tnodes whose vnodes are marked or expanded.
+        # The dicts speed the membership tests.
         marks = []; expanded = []
+        marksDict = {}; expandedDict = {}
         for p in p.subtree():
             v = p.v
-            if p.isMarked() and p.v not in marks:
+            if p.isMarked() and v not in marksDict:
                 marks.append(v)
-            if p.hasChildren() and p.isExpanded() and v not in expanded:
+                marksDict[v] = True
+            if p.hasChildren() and p.isExpanded() and v not in expandedDict:
                 expanded.append(v)
+                expandedDict[v] = True
         result = []
         for theList, tag in ((marks, "marks"), (expanded, "expanded")):
             if theList:
@@ -2,6 +2,8 @@
 #@+node:ekr.20060123151617: * @file leoFind.py
 '''Leo's gui-independent find classes.'''
 import leo.core.leoGlobals as g
+import leo.core.signal_manager as sig
+import bisect
 import keyword
 import re
 import time
@@ -113,6 +115,221 @@ class SearchWidget(object):
     def toPythonIndex(self, i):
         return g.toPythonIndex(self.s, i)
     #@-others
+#@+node:agent.20261018133000.1: ** class SearchIndex
+class SearchIndex(object):
+    '''
+    An inverted index from lower-case words to the vnodes containing them.
+
+    The find-all commands use this index to skip nodes that can not
+    contain the find pattern.
+
+    The index follows changes to the outline through the body_changed,
+    headline_changed and tree_changed signals. Queries re-index only the
+    nodes and trees that have changed since the previous query.
+    '''
+    #@+others
+    #@+node:agent.20261018133000.2: *3* index.__init__
+    def __init__(self, c):
+        '''Ctor for SearchIndex class.'''
+        self.c = c
+        self.changedNodes = set()
+            # Vnodes whose headline or body text has changed.
+        self.changedTrees = set()
+            # Vnodes whose trees have been linked into the outline.
+        self.cutCount = 0
+            # The number of links cut since the last full update.
+        self.nodeDict = {}
+            # Keys are vnodes.
+            # Values are tuples (h, b, words): the indexed strings and their words.
+        self.reversedWords = []
+            # The reversed words of wordDict, sorted.
+        self.sortedWords = []
+            # The keys of wordDict, sorted.
+        self.trigramDict = {}
+            # Keys are trigrams. Values are sets of the words containing them.
+        self.valid = False
+            # True: the index describes the entire outline.
+        self.wordDict = {}
+            # Keys are lower-case words.
+            # Values are sets of vnodes whose headline or body contains the word.
+        self.word_pattern = re.compile(r'\w+', re.UNICODE)
+        sig.connect(c, 'body_changed', self.onNodeChanged)
+        sig.connect(c, 'headline_changed', self.onNodeChanged)
+        sig.connect(c, 'tree_changed', self.onTreeChanged)
+    #@+node:agent.20261018190000.1: *3* index.event handlers
+    def onNodeChanged(self, v):
+        '''Called when v's headline or body text changes.'''
+        self.changedNodes.add(v)
+
+    def onTreeChanged(self, v, cut=False):
+        '''Called when a link to v is added or cut.'''
+        if cut:
+            # Cut trees remain in the index until the next full update.
+            # Undo may restore them without adding links.
+            self.cutCount += 1
+        else:
+            self.changedTrees.add(v)
+    #@+node:agent.20261018133000.3: *3* index.addNode & removeNode
+    def addNode(self, v):
+        '''Add v's headline and body to the index.'''
+        h, b = v.h, v.b
+        words = set(self.word_pattern.findall(h.lower()))
+        words.update(self.word_pattern.findall(b.replace('\r', '').lower()))
+            # search ignores '\r' on Windows.
+        self.nodeDict[v] = h, b, words
+        for word in words:
+            aSet = self.wordDict.get(word)
+            if aSet is None:
+                self.wordDict[word] = set([v])
+                self.addWord(word)
+            else:
+                aSet.add(v)
+
+    def removeNode(self, v):
+        '''Remove v from the index.'''
+        h, b, words = self.nodeDict.pop(v)
+        for word in words:
+            aSet = self.wordDict[word]
+            aSet.discard(v)
+            if not aSet:
+                del self.wordDict[word]
+                self.removeWord(word)
+    #@+node:agent.20261018190000.2: *3* index.addWord & removeWord
+    def addWord(self, word):
+        '''Add a new word to the vocabulary.'''
+        bisect.insort(self.sortedWords, word)
+        bisect.insort(self.reversedWords, word[::-1])
+        for i in range(len(word) - 2):
+            trigram = word[i: i + 3]
+            aSet = self.trigramDict.get(trigram)
+            if aSet is None:
+                self.trigramDict[trigram] = set([word])
+            else:
+                aSet.add(word)
+
+    def removeWord(self, word):
+        '''Remove a word from the vocabulary.'''
+        for aList, s in ((self.sortedWords, word), (self.reversedWords, word[::-1])):
+            i = bisect.bisect_left(aList, s)
+            assert aList[i] == s, (aList[i], s)
+            del aList[i]
+        for i in range(len(word) - 2):
+            trigram = word[i: i + 3]
+            aSet = self.trigramDict.get(trigram)
+            if aSet is not None:
+                aSet.discard(word)
+                if not aSet:
+                    del self.trigramDict[trigram]
+    #@+node:agent.20261018133000.4: *3* index.candidates & helpers
+    def candidates(self, pattern):
+        '''
+        Return the set of vnodes that might contain pattern, ignoring case.
+        Return None if the index can not limit the search.
+        '''
+        s = pattern.lower()
+        result = []
+        for m in self.word_pattern.finditer(s):
+            word = m.group(0)
+            atStart, atEnd = m.start() == 0, m.end() == len(s)
+            if atStart and atEnd:
+                # The word may be part of a longer word.
+                words = self.wordsContaining(word)
+            elif atStart:
+                # The word may be the end of a longer word.
+                words = [z[::-1] for z in self.wordsStartingWith(
+                    self.reversedWords, word[::-1])]
+            elif atEnd:
+                # The word may be the start of a longer word.
+                words = self.wordsStartingWith(self.sortedWords, word)
+            else:
+                # The word is delimited on both sides: it must match a whole word.
+                words = [word] if word in self.wordDict else []
+            if words is None:
+                continue
+            aSet = set()
+            for word2 in words:
+                aSet.update(self.wordDict[word2])
+            result.append(aSet)
+        if not result:
+            return None
+        result.sort(key=len)
+        return result[0].intersection(*result[1:])
+    #@+node:agent.20261018190000.3: *4* index.wordsContaining
+    def wordsContaining(self, word):
+        '''
+        Return the list of all words containing word.
+        Return None if word is too short to look up.
+        '''
+        if len(word) < 3:
+            return None
+        sets = [self.trigramDict.get(word[i: i + 3], set())
+            for i in range(len(word) - 2)]
+        sets.sort(key=len)
+        return [z for z in sets[0].intersection(*sets[1:]) if word in z]
+    #@+node:agent.20261018190000.4: *4* index.wordsStartingWith
+    def wordsStartingWith(self, aList, prefix):
+        '''Return the words in the sorted list aList that start with prefix.'''
+        result = []
+        i = bisect.bisect_left(aList, prefix)
+        while i < len(aList) and aList[i].startswith(prefix):
+            result.append(aList[i])
+            i += 1
+        return result
+    #@+node:agent.20261018133000.5: *3* index.update & helpers
+    def update(self):
+        '''Re-index all changed nodes and trees.'''
+        if not self.valid or self.cutCount > len(self.nodeDict) // 10:
+            self.updateAll()
+            return
+        todo = list(self.changedTrees)
+        seen = set()
+        while todo:
+            v = todo.pop()
+            if v not in seen:
+                seen.add(v)
+                todo.extend(v.children)
+                self.updateNode(v)
+        for v in self.changedNodes:
+            if v not in seen:
+                self.updateNode(v)
+        self.changedNodes.clear()
+        self.changedTrees.clear()
+    #@+node:agent.20261018190000.5: *4* index.updateAll
+    def updateAll(self):
+        '''
+        Re-index all nodes whose headline or body has changed.
+        Forget deleted nodes.
+        '''
+        c, d = self.c, self.nodeDict
+        seen = set()
+        todo = c.hiddenRootNode.children[:]
+        while todo:
+            v = todo.pop()
+            if v not in seen:
+                seen.add(v)
+                todo.extend(v.children)
+                self.updateNode(v)
+        for v in [z for z in d if z not in seen]:
+            self.removeNode(v)
+        self.changedNodes.clear()
+        self.changedTrees.clear()
+        self.cutCount = 0
+        self.valid = True
+    #@+node:agent.20261018190000.6: *4* index.updateNode
+    def updateNode(self, v):
+        '''
+        Index v if its headline or body has changed.
+
+        Checking whether strings have changed is fast because strings
+        are immutable: unchanged nodes still refer to the indexed strings.
+        '''
+        data = self.nodeDict.get(v)
+        if data is None:
+            self.addNode(v)
+        elif data[0] is not v.h or data[1] is not v.b:
+            self.removeNode(v)
+            self.addNode(v)
+    #@-others
 #@+node:ekr.20061212084717: ** class LeoFind (LeoFind.py)
 class LeoFind(object):
     """The base class for Leo's Find commands."""
@@ -170,11 +387,18 @@ class LeoFind(object):
         #
         # Ivars containing internal state...
         self.buttonFlag = False
+        self.candidates = None
+            # None or a set of vnodes that might match during find-all commands.
+            # Set by find.findAll using self.index.
+        self.candidate_trees = None
+            # The candidates and all their ancestors.
         self.changeAllFlag = False
         self.findAllFlag = False
         self.findAllUniqueFlag = False
         self.in_headline = False
             # True: searching headline text.
+        self.index = None
+            # A SearchIndex, created when needed by find.computeCandidates.
         self.match_obj = None
             # The match object returned for regex or find-all-unique-regex searches.
         self.p = None
@@ -183,6 +407,9 @@ class LeoFind(object):
         self.previous_find_pattern = ''
             # The previous find pattern, used to disable auto-setting ignore-case.
         self.unique_matches = set()
+        self.visited_nodes = None
+            # None or the set of vnodes searched so far by a batch command.
+            # Set by find.findAll and find.changeAll when self.unique_nodes is True.
         self.was_in_headline = None
             # Fix bug: https://groups.google.com/d/msg/leo-editor/RAzVPihqmkI/-tgTQw0-LtwJ
         self.onlyPosition = None
@@ -219,6 +446,8 @@ class LeoFind(object):
         c = self.c
         self.ignore_dups = c.config.getBool('find-ignore-duplicates', default=False)
         self.minibuffer_mode = c.config.getBool('minibuffer-find-mode', default=False)
+        self.use_index = c.config.getBool('find-all-use-index', default=False)
+        self.unique_nodes = c.config.getBool('find-all-unique-nodes', default=False)
     #@+node:ekr.20060123065756.1: *3* LeoFind.Buttons (immediate execution)
     #@+node:ekr.20031218072017.3057: *4* find.changeAllButton
     def changeAllButton(self, event=None):
@@ -1440,12 +1669,17 @@ class LeoFind(object):
         # Fix bug 338172: ReplaceAll will not replace newlines
         # indicated as \n in target string.
         self.change_text = self.replaceBackSlashes(self.change_text)
-        while 1:
-            pos1, pos2 = self.findNextMatch()
-            if pos1 is None:
-                break
-            count += 1
-            self.batchChange(pos1, pos2)
+        if self.unique_nodes:
+            self.visited_nodes = set()
+        try:
+            while 1:
+                pos1, pos2 = self.findNextMatch()
+                if pos1 is None:
+                    break
+                count += 1
+                self.batchChange(pos1, pos2)
+        finally:
+            self.visited_nodes = None
         p = c.p
         u.afterChangeGroup(p, undoType, reportFlag=True)
         t2 = time.clock()
@@ -1606,6 +1840,10 @@ class LeoFind(object):
         old_sparse_find = c.sparse_find
         try:
             c.sparse_find = False
+            self.candidates = self.computeCandidates()
+            self.candidate_trees = self.computeCandidateTrees()
+            if self.unique_nodes:
+                self.visited_nodes = set()
             if clone_find:
                 count = self.doCloneFindAll(after, data, flatten, p, undoType)
             else:
@@ -1614,9 +1852,42 @@ class LeoFind(object):
             # c.contractAllHeadlines()
         finally:
             c.sparse_find = old_sparse_find
+            self.candidates = self.candidate_trees = None
+            self.visited_nodes = None
         if count:
             c.redraw()
         g.es("found", count, "matches for", self.find_text)
+    #@+node:agent.20261018133000.6: *5* find.computeCandidates
+    def computeCandidates(self):
+        '''
+        Return the set of vnodes that might match the find pattern, or None
+        if find-all commands must search all nodes.
+
+        Only plain searches use the index, and only when
+        @bool find-all-use-index is True.
+        '''
+        if not self.use_index or self.pattern_match or self.findAllUniqueFlag:
+            return None
+        if not self.index:
+            self.index = SearchIndex(self.c)
+        self.index.update()
+        # Compute the pattern as plainHelper and backwardsHelper do.
+        s = self.find_text
+        if self.ignore_case:
+            s = s.lower()
+        s = self.replaceBackSlashes(s)
+        return self.index.candidates(s)
+    #@+node:agent.20261018133000.8: *5* find.computeCandidateTrees
+    def computeCandidateTrees(self):
+        '''Return the set of all candidates and all their ancestors.'''
+        result = set()
+        todo = list(self.candidates or [])
+        while todo:
+            v = todo.pop()
+            if v not in result:
+                result.add(v)
+                todo.extend(v.parents)
+        return result
     #@+node:ekr.20160422072841.1: *5* find.doCloneFindAll & helpers
     def doCloneFindAll(self, after, data, flatten, p, undoType):
         '''Handle the clone-find-all command, from p to after.'''
@@ -1626,8 +1897,15 @@ class LeoFind(object):
         clones, skip = [], set()
         while p and p != after:
             progress = p.copy()
-            if p.v in skip:
-                p.moveToThreadNext()
+            if self.candidates is not None and p.v not in self.candidate_trees:
+                # An optimization: no node in p's tree can match.
+                p.moveToNodeAfterTree()
+            elif p.v in skip:
+                if self.visited_nodes is None:
+                    p.moveToThreadNext()
+                else:
+                    # p's entire tree has already been handled.
+                    p.moveToNodeAfterTree()
             else:
                 count = self.doCloneFindAllHelper(clones, count, flatten, p, skip)
             assert p != progress
@@ -1692,6 +1970,8 @@ class LeoFind(object):
                 skip.add(p2.v)
             p.moveToNodeAfterTree()
         else:
+            if self.visited_nodes is not None:
+                skip.add(p.v)
             p.moveToThreadNext()
         return count
     #@+node:ekr.20160422073500.1: *5* find.doFindAll & helpers
@@ -1763,6 +2043,8 @@ class LeoFind(object):
     def findNextBatchMatch(self, p):
         '''Find the next batch match at p.'''
         trace = False and not g.unitTesting
+        if self.candidates is not None and p.v not in self.candidates:
+            return False
         table = []
         if self.search_headline:
             table.append(p.h)
@@ -1850,6 +2132,22 @@ class LeoFind(object):
             ok = self.precompilePattern()
             if not ok: return None, None
         while p:
+            if self.visited_nodes is not None and p.v in self.visited_nodes:
+                # A clone of a node that has already been searched.
+                p = self.p = self.nextUnvisitedNode(p)
+                if p:
+                    self.in_headline = self.firstSearchPane()
+                    self.initNextText()
+                continue
+            if self.candidates is not None and p.v not in self.candidates:
+                # An optimization for find-all commands: p can not match.
+                if self.visited_nodes is not None:
+                    self.visited_nodes.add(p.v)
+                p = self.p = self.nextCandidate(p)
+                if p:
+                    self.in_headline = self.firstSearchPane()
+                    self.initNextText()
+                continue
             pos, newpos = self.search()
             if self.errors:
                 g.trace('find errors')
@@ -1874,6 +2172,8 @@ class LeoFind(object):
             else:
                 # Switch to the next/prev node, if possible.
                 attempts += 1
+                if self.visited_nodes is not None:
+                    self.visited_nodes.add(p.v)
                 p = self.p = self.nextNodeAfterFail(p)
                 if p: # Found another node: select the proper pane.
                     self.in_headline = self.firstSearchPane()
@@ -1938,6 +2238,47 @@ class LeoFind(object):
             ins = 0
         if trace and self.in_headline and ins is not None: g.trace(ins, p.h)
         self.init_s_ctrl(s, ins)
+    #@+node:agent.20261018133000.9: *5* find.nextCandidate
+    def nextCandidate(self, p):
+        '''
+        Return the next position after p that is in self.candidates, or None.
+
+        This is equivalent to calling nextNodeAfterFail until it returns a
+        candidate, but it skips trees that contain no candidates.
+        '''
+        p = p.copy()
+        if self.reverse:
+            p.moveToThreadBack()
+            while p and p.v not in self.candidates:
+                p.moveToThreadBack()
+        else:
+            p.moveToThreadNext()
+            while p and p.v not in self.candidates:
+                if p.v in self.candidate_trees:
+                    p.moveToThreadNext()
+                else:
+                    p.moveToNodeAfterTree()
+        if p and self.outsideSearchRange(p):
+            return None
+        return p or None
+    #@+node:agent.20261018140000.1: *5* find.nextUnvisitedNode
+    def nextUnvisitedNode(self, p):
+        '''
+        Return the next position after p that is not in self.visited_nodes,
+        or None.
+
+        p.v has already been searched. When searching forward, so have all
+        p's descendants, so this skips p's entire tree.
+        '''
+        p = p.copy()
+        while p and p.v in self.visited_nodes:
+            if self.reverse:
+                p.moveToThreadBack()
+            else:
+                p.moveToNodeAfterTree()
+        if p and self.outsideSearchRange(p):
+            return None
+        return p or None
     #@+node:ekr.20131123132043.16476: *5* find.nextNodeAfterFail & helper
     def nextNodeAfterFail(self, p):
         '''Return the next node after a failed search or None.'''
@@ -2384,6 +2725,9 @@ class LeoFind(object):
                     p = p.next()
                 p = p.lastNode()
             self.p = p
+        if self.search_body and not self.node_only:
+            # Read the body text of all searched nodes at once.
+            c.fileCommands.loadLazyTree(self.p if self.suboutline_only else None)
         # Set the insert point.
         self.initBatchText()
     #@+node:ekr.20031218072017.3085: *4* find.initBatchText
@@ -2080,7 +2080,7 @@ class NullTree(LeoTree):
         if not w:
             d[p.v] = w = StringTextWrapper(
                 c=self.c,
-                name='head-%d' % (1 + len(list(d.keys()))))
+                name='head-%d' % (1 + len(d)))
             w.setAllText(p.h)
         return w
     #@+node:ekr.20070228164730: *3* NullTree.editLabel
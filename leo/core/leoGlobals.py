@@ -2389,7 +2389,12 @@ lastFunctionsDict = {}
 def clearAllIvars(o):
     """Clear all ivars of o, a member of some class."""
     if o:
-        o.__dict__.clear()
+        for cls in type(o).__mro__:
+            for ivar in cls.__dict__.get('__slots__', ()):
+                if ivar not in ('__dict__', '__weakref__') and hasattr(o, ivar):
+                    delattr(o, ivar)
+        if hasattr(o, '__dict__'):
+            o.__dict__.clear()
 #@+node:ekr.20031218072017.1590: *4* g.collectGarbage
 def collectGarbage():
     try:
@@ -2919,31 +2924,10 @@ def get_directives_dict(p, root=None):
     if trace and verbose: g.trace('*' * 20, p.h)
     if root: root_node = root[0]
     c = p and p.v and p.v.context
-    d = {}
-    # Do this every time so plugins can add directives.
-    pat = g.compute_directives_re()
-    directives_pat = re.compile(pat, re.MULTILINE)
-    # The headline has higher precedence because it is more visible.
-    for kind, s in (('head', p.h), ('body', p.b)):
-        anIter = directives_pat.finditer(s)
-        for m in anIter:
-            word = m.group(1).strip()
-            i = m.start(1)
-            if word in d: continue
-            j = i + len(word)
-            if j < len(s) and s[j] not in ' \t\n':
-                continue
-                    # Not a valid directive: just ignore it.
-                    # A unit test tests that @path:any is invalid.
-            k = g.skip_line(s, j)
-            val = s[j: k].strip()
-            if trace and c and p == c.p:
-                g.trace('%20s %s' % (word, val))
-            if word in ('root-doc', 'root-code'):
-                d['root'] = val # in addition to optioned version
-            d[word] = val
-            # New in Leo 5.7.1: @path is allowed in body text.
-            # This is very useful when doing recursive imports.
+    d = dict(g.scan_directives_dict(p))
+    if trace and c and p == c.p:
+        for word in sorted(d):
+            g.trace('%20s %s' % (word, d.get(word)))
     if root:
         anIter = g_noweb_root.finditer(p.b)
         for m in anIter:
@@ -2960,13 +2944,71 @@ def get_directives_dict(p, root=None):
 def compute_directives_re():
     '''
     Return an re pattern which word matches all Leo directives.
-    Only g.get_directives_dict uses this pattern.
+    Only g.compute_directives_pattern uses this pattern.
     '''
     global globalDirectiveList
     # EKR: 2016/03/30: Use a pattern that guarantees word matches.
     aList = [r'\b%s\b' % (z) for z in globalDirectiveList
                 if z != 'others']
     return "^@(%s)" % "|".join(aList)
+#@+node:agent.20261018190000.1: *4* g.compute_directives_pattern
+g_directives_pattern = None
+g_directives_pattern_key = None
+
+def compute_directives_pattern():
+    """
+    Return the compiled form of g.compute_directives_re().
+
+    Recompile the pattern only when plugins have changed globalDirectiveList.
+    """
+    global g_directives_pattern, g_directives_pattern_key
+    key = tuple(globalDirectiveList)
+    if key != g_directives_pattern_key:
+        g_directives_pattern = re.compile(g.compute_directives_re(), re.MULTILINE)
+        g_directives_pattern_key = key
+    return g_directives_pattern
+#@+node:agent.20261018190000.2: *4* g.scan_directives_dict
+def scan_directives_dict(p):
+    """
+    Return a dict of the directives in p.h and p.b, as g.get_directives_dict
+    does, but without handling the root argument.
+
+    The result is cached in p.v.directivesCache and must not be changed.
+    Cache entries remain valid as long as p.h, p.b and globalDirectiveList
+    are unchanged. Strings are immutable, so the setters need not clear
+    the cache.
+    """
+    v = p.v
+    c = v and v.context
+    h, b = p.h, p.b
+    pat = g.compute_directives_pattern()
+    cache = v and v.directivesCache
+    if cache and cache[0] is h and cache[1] is b and cache[2] is pat:
+        if c: c.directivesCacheHits += 1
+        return cache[3]
+    if c: c.directivesCacheMisses += 1
+    d = {}
+    # The headline has higher precedence because it is more visible.
+    for s in (h, b):
+        for m in pat.finditer(s):
+            word = m.group(1).strip()
+            i = m.start(1)
+            if word in d: continue
+            j = i + len(word)
+            if j < len(s) and s[j] not in ' \t\n':
+                continue
+                    # Not a valid directive: just ignore it.
+                    # A unit test tests that @path:any is invalid.
+            k = g.skip_line(s, j)
+            val = s[j: k].strip()
+            if word in ('root-doc', 'root-code'):
+                d['root'] = val # in addition to optioned version
+            d[word] = val
+            # New in Leo 5.7.1: @path is allowed in body text.
+            # This is very useful when doing recursive imports.
+    if v:
+        v.directivesCache = h, b, pat, d
+    return d
 #@+node:ekr.20080827175609.1: *3* g.get_directives_dict_list (must be fast)
 def get_directives_dict_list(p):
     """Scans p and all its ancestors for directives.
@@ -4555,6 +4597,8 @@ def is_special(s, i, directive):
     assert(directive and directive[0] == '@')
     # 10/23/02: all directives except @others must start the line.
     skip_flag = directive in ("@others", "@all")
+    if s.find(directive, i) == -1:
+        return False, -1 # Fast path: no need to scan the lines.
     while i < len(s):
         if g.match_word(s, i, directive):
             return True, i
@@ -4950,44 +4994,74 @@ def gitHeadPath(path=None):
     # g.trace('exists: %s path: %s' % (exists, head))
     return head if exists else None
 #@+node:ekr.20170414034616.3: *3* g.gitInfo
+gitInfoCache = {}
+    # Keys are path arguments to g.gitInfo.
+    # Values are (stamps, branch, commit). See g.gitInfoStamps.
+gitInfoStats = {'hits': 0, 'misses': 0}
+    # Counts calls to g.gitInfo that did or did not use the cache.
+
 def gitInfo(path=None):
     '''
     Path is a .git/HEAD directory, or None.
 
     Return the branch and commit number or ('', '').
+
+    Results are cached until .git/HEAD or the branch's refs change.
+    '''
+    data = gitInfoCache.get(path)
+    if data:
+        stamps, branch, commit = data
+        if g.gitInfoStamps([z[0] for z in stamps]) == stamps:
+            gitInfoStats['hits'] += 1
+            return branch, commit
+    gitInfoStats['misses'] += 1
+    head = g.gitHeadPath(path)
+    branch, commit, paths = g.gitInfoHelper(head)
+    if head:
+        gitInfoCache[path] = g.gitInfoStamps(paths), branch, commit
+    else:
+        # Don't cache: a .git directory may be created later.
+        gitInfoCache.pop(path, None)
+    return branch, commit
+#@+node:agent.20261018103020.1: *3* g.gitInfoHelper
+def gitInfoHelper(path):
+    '''
+    Path is the path to a .git/HEAD file, or None.
+
+    Return (branch, commit, paths), where branch and commit may be '' and
+    paths lists the files on which the result depends.
     '''
     trace = False and not g.unitTesting
     branch, commit = '', '' # Set defaults.
     # Does path/../ref exist?
-    path = g.gitHeadPath(path)
     if not path or not g.os_path_exists(path):
         if trace: g.trace('no path')
-        return branch, commit
+        return branch, commit, []
     try:
         with open(path) as f:
             s = f.read()
             if not s.startswith('ref'):
                 if trace: g.trace('no ref', branch, commit)
-                return branch, commit
+                return branch, commit, [path]
         # On a proper branch
         pointer = s.split()[1]
         dirs = pointer.split('/')
         branch = dirs[-1]
     except IOError:
         g.trace('can not open:', path)
-        return branch, commit
+        return branch, commit, []
     # Try to get a better commit number.
     git_dir = g.os_path_finalize_join(path, '..')
+    ref_path = g.os_path_finalize_join(git_dir, pointer)
+    packed_path = g.os_path_finalize_join(git_dir, 'packed-refs')
     try:
-        path = g.os_path_finalize_join(git_dir, pointer)
-        with open(path) as f:
+        with open(ref_path) as f:
             s = f.read()
         commit = s.strip()[0: 12]
         # shorten the hash to a unique shortname
     except IOError:
         try:
-            path = g.os_path_finalize_join(git_dir, 'packed-refs')
-            with open(path) as f:
+            with open(packed_path) as f:
                 for line in f:
                     if line.strip().endswith(' '+pointer):
                         commit = line.split()[0][0: 12]
@@ -4995,7 +5069,21 @@ def gitInfo(path=None):
         except IOError:
             pass
     if trace: g.trace('returns:', branch, commit)
-    return branch, commit
+    return branch, commit, [path, ref_path, packed_path]
+#@+node:agent.20261018103020.2: *3* g.gitInfoStamps
+def gitInfoStamps(paths):
+    '''
+    Return a tuple of (path, stamp) pairs, where stamp is (mtime, size),
+    or None if the path does not exist.
+    '''
+    result = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            result.append((path, (st.st_mtime, st.st_size)))
+        except OSError:
+            result.append((path, None))
+    return tuple(result)
 #@+node:ekr.20170414041333.1: *3* g.jsonCommitInfo
 def jsonCommitInfo():
     '''
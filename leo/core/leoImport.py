@@ -162,7 +162,7 @@ class JSON_Import_Helper(object):
         #@+node:ekr.20160504144455.1: *5* json.write
         def write(self, root):
             """Write all the @auto-json node."""
-            nodes = list(set([p.v for p in root.subtree()]))
+            nodes = list(root.v.unique_subtree())
             nodes = [self.vnode_dict(v) for v in nodes]
             d = {
                 'top': self.vnode_dict(root.v),
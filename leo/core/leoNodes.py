@@ -205,6 +205,13 @@ class NodeIndices(object):
 # each ancestor **at the spot in tree traversal. Positions p has a unique set of
 # parents.
 # 
+# Positions represent their stacks as immutable, linked **frames**. p._stack is
+# None for top-level positions. Otherwise it is the frame of p's parent, a tuple
+# (v, childIndex, outer, level), where outer is the frame of v's parent and
+# level is the number of frames. Positions share frames, so p.copy() and the
+# p.moveToX methods never copy stacks. The p.stack property converts frames to
+# and from lists of tuples (v,childIndex).
+# 
 # The p.moveToX methods may return a null (invalid) position p with p.v = None.
 # 
 # The tests "if p" or "if not p" are the _only_ correct way to test whether a
@@ -214,6 +221,9 @@ class NodeIndices(object):
 # Positions should *never* be saved by the ZOBD.
 
 class Position(object):
+    __slots__ = ('_childIndex', '_stack', 'v', '__dict__')
+        # Leo creates many positions. Python creates p.__dict__ only if
+        # scripts or plugins set other ivars.
     #@+others
     #@+node:ekr.20040228094013: *3*  p.ctor & other special methods...
     #@+node:ekr.20080416161551.190: *4*  p.__init__
@@ -225,11 +235,35 @@ class Position(object):
         self.v = v
         # New in Leo 4.5: stack entries are tuples (v,childIndex).
         if stack:
-            self.stack = stack[:] # Creating a copy here is safest and best.
+            self.stack = stack # Creates new frames.
         else:
-            self.stack = []
+            self._stack = None
         g.app.positions += 1
         # self.txtOffset = None # see self.textOffset()
+    #@+node:agent.20261018230000.8: *4*  p.stack property
+    def __get_stack(self):
+        '''
+        Return a new list of tuples (v,childIndex), outermost first.
+        Changing this list does not change p: assign to p.stack instead.
+        '''
+        result = []
+        frame = self._stack
+        while frame:
+            result.append((frame[0], frame[1]),)
+            frame = frame[2]
+        result.reverse()
+        return result
+
+    def __set_stack(self, stack):
+        frame = None
+        for level, data in enumerate(stack):
+            v, childIndex = data
+            frame = (v, childIndex, frame, level + 1)
+        self._stack = frame
+
+    stack = property(
+        __get_stack, __set_stack,
+        doc="Position stack property: a list of tuples (v,childIndex)")
     #@+node:ekr.20080920052058.3: *4* p.__eq__ & __ne__
     def __eq__(self, p2):
         """Return True if two positions are equivalent."""
@@ -240,9 +274,17 @@ class Position(object):
         if p2 is None or p2.v is None:
             return p1.v is None
         elif isinstance(p2, self.__class__):
-            return (p1.v == p2.v and
-                p1._childIndex == p2._childIndex and
-                p1.stack == p2.stack)
+            if p1.v != p2.v or p1._childIndex != p2._childIndex:
+                return False
+            # Compare stacks until they share a frame.
+            frame1, frame2 = p1._stack, p2._stack
+            while frame1 is not frame2:
+                if (frame1 is None or frame2 is None or
+                    frame1[0] != frame2[0] or frame1[1] != frame2[1]
+                ):
+                    return False
+                frame1, frame2 = frame1[2], frame2[2]
+            return True
         else:
             # Do this only after testing for None.
             return NotImplemented
@@ -516,11 +558,7 @@ class Position(object):
     def nodes(self):
         '''Yield p.v and all vnodes in p's subtree.'''
         p = self
-        p = p.copy()
-        after = p.nodeAfterTree()
-        while p and p != after: # bug fix: 2013/10/12
-            yield p.v
-            p.moveToThreadNext()
+        return p.v.self_and_subtree() if p.v else iter([])
     # Compatibility with old code.
 
     tnodes_iter = nodes
@@ -589,11 +627,7 @@ class Position(object):
     def unique_nodes(self):
         '''Yield p.v and all unique vnodes in p's subtree.'''
         p = self
-        seen = set()
-        for p in p.self_and_subtree():
-            if p.v not in seen:
-                seen.add(p.v)
-                yield p.v
+        return p.v.self_and_unique_subtree() if p.v else iter([])
     # Compatibility with old code.
 
     unique_tnodes_iter = unique_nodes
@@ -813,7 +847,7 @@ class Position(object):
 
     def hasParent(self):
         p = self
-        return p.v and p.stack
+        return p.v is not None and p._stack is not None
 
     def hasThreadBack(self):
         p = self
@@ -824,18 +858,14 @@ class Position(object):
         p = self
         if not p.v: return False
         if p.hasChildren() or p.hasNext(): return True
-        n = len(p.stack) - 1
-        while n >= 0:
-            v, childIndex = p.stack[n]
+        frame = p._stack
+        while frame:
+            v, childIndex, frame = frame[0], frame[1], frame[2]
             # See how many children v's parent has.
-            if n == 0:
-                parent_v = v.context.hiddenRootNode
-            else:
-                parent_v, junk = p.stack[n - 1]
+            parent_v = frame[0] if frame else v.context.hiddenRootNode
             if len(parent_v.children) > childIndex + 1:
                 # v has a next sibling.
                 return True
-            n -= 1
         return False
     #@+node:ekr.20060920203352: *4* p.findRootPosition
     def findRootPosition(self):
@@ -850,12 +880,13 @@ class Position(object):
         c = p.v.context
         if not c.positionExists(p2):
             return False
-        for z in p2.stack:
+        frame = p2._stack
+        while frame:
             # 2013/12/25: bug fix: test childIndices.
             # This is required for the new per-position expansion scheme.
-            parent_v, parent_childIndex = z
-            if parent_v == p.v and parent_childIndex == p._childIndex:
+            if frame[0] == p.v and frame[1] == p._childIndex:
                 return True
+            frame = frame[2]
         return False
     #@+node:ekr.20040306215056: *4* p.isCloned
     def isCloned(self):
@@ -899,7 +930,7 @@ class Position(object):
     def level(self):
         '''Return the number of p's parents.'''
         p = self
-        return len(p.stack) if p.v else 0
+        return p._stack[3] if p.v and p._stack else 0
 
     simpleLevel = level
     #@+node:ekr.20111005152227.15566: *4* p.positionAfterDeletedTree
@@ -999,9 +1030,10 @@ class Position(object):
                     p.h, p.stack))
                 return
         # Adjust p's stack.
+        old_stack = p.stack
         stack = []; changed = False; i = 0
-        while i < len(p.stack):
-            v, childIndex = p.stack[i]
+        while i < len(old_stack):
+            v, childIndex = old_stack[i]
             p3 = Position(v=v, childIndex=childIndex, stack=stack[: i])
             while p3:
                 if p2 == p3:
@@ -1025,7 +1057,7 @@ class Position(object):
         parent_v = p_after._parentVnode()
             # Returns None if p.v is None
         # Init the ivars.
-        p.stack = p_after.stack[:]
+        p._stack = p_after._stack
         p._childIndex = p_after._childIndex + 1
         # Set the links.
         child = p.v
@@ -1037,8 +1069,8 @@ class Position(object):
         p = self
         parent_v = parent.v
         # Init the ivars.
-        p.stack = parent.stack[:]
-        p.stack.append((parent_v, parent._childIndex),)
+        frame = parent._stack
+        p._stack = (parent_v, parent._childIndex, frame, frame[3] + 1 if frame else 1)
         p._childIndex = n
         # New in Leo 5.1: ensure that p.gnx is unique in p's ancestors.
         if 0:
@@ -1055,7 +1087,7 @@ class Position(object):
         # if oldRoot: oldRootNode = oldRoot.v
         # else:       oldRootNode = None
         # Init the ivars.
-        p.stack = []
+        p._stack = None
         p._childIndex = 0
         parent_v = hiddenRootNode
         child = p.v
@@ -1068,14 +1100,16 @@ class Position(object):
         Return the hiddenRootNode if there is no other parent.'''
         p = self
         if p.v:
-            data = p.stack and p.stack[-1]
-            if data:
-                v, junk = data
-                return v
-            else:
-                return p.v.context.hiddenRootNode
+            frame = p._stack
+            return frame[0] if frame else p.v.context.hiddenRootNode
         else:
             return None
+    #@+node:agent.20261018230000.7: *4* p._push
+    def _push(self):
+        '''Push a frame for p.v and p._childIndex onto p's stack.'''
+        p = self
+        frame = p._stack
+        p._stack = (p.v, p._childIndex, frame, frame[3] + 1 if frame else 1)
     #@+node:ekr.20131219220412.16582: *4* p._relinkAsCloneOf
     def _relinkAsCloneOf(self, p2):
         '''A low-level method to replace p.v by a p2.v.'''
@@ -1158,7 +1192,7 @@ class Position(object):
         """Move a position to it's first child's position."""
         p = self
         if p.v and p.v.children:
-            p.stack.append((p.v, p._childIndex),)
+            p._push()
             p.v = p.v.children[0]
             p._childIndex = 0
         else:
@@ -1169,7 +1203,7 @@ class Position(object):
         """Move a position to it's last child's position."""
         p = self
         if p.v and p.v.children:
-            p.stack.append((p.v, p._childIndex),)
+            p._push()
             n = len(p.v.children)
             p.v = p.v.children[n - 1]
             p._childIndex = n - 1
@@ -1213,7 +1247,7 @@ class Position(object):
     def moveToNthChild(self, n):
         p = self
         if p.v and len(p.v.children) > n:
-            p.stack.append((p.v, p._childIndex),)
+            p._push()
             p.v = p.v.children[n]
             p._childIndex = n
         else:
@@ -1223,8 +1257,9 @@ class Position(object):
     def moveToParent(self):
         """Move a position to its parent position."""
         p = self
-        if p.v and p.stack:
-            p.v, p._childIndex = p.stack.pop()
+        frame = p._stack
+        if p.v and frame:
+            p.v, p._childIndex, p._stack = frame[0], frame[1], frame[2]
         else:
             p.v = None
         return p
@@ -1396,7 +1431,9 @@ class Position(object):
     #@+node:ekr.20040117171654: *4* p.copy
     def copy(self):
         """"Return an independent copy of a position."""
-        return Position(self.v, self._childIndex, self.stack)
+        p = Position(self.v, self._childIndex)
+        p._stack = self._stack # Frames are immutable.
+        return p
     #@+node:ekr.20040303175026.9: *4* p.copyTreeAfter, copyTreeTo
     # These used by unit tests, by the group_operations plugin,
     # and by the files-compare-leo-files command.
@@ -1820,13 +1857,13 @@ class Position(object):
     # Compatibility routine for scripts.
 
     def clearVisitedInTree(self):
-        for p in self.self_and_subtree():
-            p.clearVisited()
+        for v in self.v.self_and_unique_subtree():
+            v.clearVisited()
     #@+node:ekr.20031218072017.3388: *5* p.clearAllVisitedInTree
     def clearAllVisitedInTree(self):
-        for p in self.self_and_subtree():
-            p.v.clearVisited()
-            p.v.clearWriteBit()
+        for v in self.v.self_and_unique_subtree():
+            v.clearVisited()
+            v.clearWriteBit()
     #@+node:ekr.20040305162628: *4* p.Dirty bits
     #@+node:ekr.20040311113514: *5* p.clearDirty
     def clearDirty(self):
@@ -2002,6 +2039,34 @@ class VNodeBase(object):
     writeBit = 0x400
     orphanBit = 0x800 # True: error in @<file> tree prevented it from being written.
     #@-<< VNode constants >>
+    #@+<< VNode slots >>
+    #@+node:agent.20261018230000.1: *3* << VNode slots >>
+    # Big outlines contain hundreds of thousands of vnodes, so vnodes keep
+    # their essential data in slots. All other ivars, including
+    # v.unknownAttributes and ivars set by plugins, live in v.__dict__,
+    # which Python creates only when first needed. Unset slots raise
+    # AttributeError, so hasattr(v, 'tempRoots') works as before.
+    if not use_zodb:
+        __slots__ = (
+            '_bodyString', '_headString', 'children', 'context',
+            'directivesCache', 'fileIndex', 'iconVal', 'parents', 'statusBits',
+            'tempRoots', # Set when reading most @<file> trees.
+            '__dict__',
+        )
+        # Only ZODB uses v._p_changed. Setting it must not create v.__dict__.
+        _p_changed = property(
+            lambda self: False, lambda self, val: None,
+            doc="VNode _p_changed property: unused without ZODB")
+    # Defaults for rarely-used ivars. Setting them creates v.__dict__.
+    insertSpot = None
+        # Location of previous insert point.
+    scrollBarSpot = None
+        # Previous value of scrollbar position.
+    selectionLength = 0
+        # The length of the selected body text.
+    selectionStart = 0
+        # The start of the selected body text.
+    #@-<< VNode slots >>
     #@+others
     #@+node:ekr.20031218072017.3342: *3* v.Birth & death
     #@+node:ekr.20031218072017.3344: *4* v.__init
@@ -2030,16 +2095,10 @@ class VNodeBase(object):
         self.context = context # The context containing context.hiddenRootNode.
             # Required so we can compute top-level siblings.
             # It is named .context rather than .c to emphasize its limited usage.
-        self.expandedPositions = []
-            # Positions that should be expanded.
-        self.insertSpot = None
-            # Location of previous insert point.
-        self.scrollBarSpot = None
-            # Previous value of scrollbar position.
-        self.selectionLength = 0
-            # The length of the selected body text.
-        self.selectionStart = 0
-            # The start of the selected body text.
+        self.directivesCache = None
+            # (h, b, pattern, dict) computed by g.scan_directives_dict.
+        # The class defines defaults for v.expandedPositions, v.insertSpot,
+        # v.scrollBarSpot, v.selectionLength and v.selectionStart.
         # To make VNode's independent of Leo's core,
         # wrap all calls to the VNode ctor::
         #
@@ -2244,6 +2303,69 @@ class VNodeBase(object):
         for child in v.children:
             v2.children.append(child.copyTree(copyMarked))
         return v2
+    #@+node:agent.20261018230000.10: *3* v.Generators
+    #@+at These generators walk the vnode graph directly. They never create
+    # positions, so they are much faster than the position generators.
+    # 
+    # The subtree generators yield vnodes in outline order. The unique
+    # generators yield each vnode once and skip the subtrees of vnodes they
+    # have already yielded, exactly as c.all_unique_positions does.
+    #@+node:agent.20261018230000.11: *4* v.self_and_subtree & subtree
+    def self_and_subtree(self):
+        '''Yield v and the vnode of every position in v's subtree.'''
+        v = self
+        yield v
+        for v2 in v.subtree():
+            yield v2
+
+    def subtree(self):
+        '''Yield the vnode of every position in v's subtree, but not v.'''
+        v = self
+        stack = list(reversed(v.children))
+        while stack:
+            v = stack.pop()
+            yield v
+            if v.children:
+                stack.extend(reversed(v.children))
+    #@+node:agent.20261018230000.12: *4* v.self_and_unique_subtree & unique_subtree
+    def self_and_unique_subtree(self):
+        '''Yield v and all other unique vnodes in v's subtree.'''
+        v = self
+        yield v
+        for v2 in v.unique_subtree(seen=set([v])):
+            yield v2
+
+    def unique_subtree(self, seen=None):
+        '''
+        Yield all unique vnodes in v's subtree, but not v.
+        seen is a set of vnodes to skip, with their subtrees.
+        '''
+        v = self
+        if seen is None: seen = set()
+        stack = list(reversed(v.children))
+        while stack:
+            v = stack.pop()
+            if v not in seen:
+                seen.add(v)
+                yield v
+                if v.children:
+                    stack.extend(reversed(v.children))
+    #@+node:agent.20261018230000.13: *4* v.unique_ancestors
+    def unique_ancestors(self):
+        '''
+        Yield each vnode that is a parent of v, a parent of such a parent,
+        and so on. Don't yield v or the hidden root vnode.
+        '''
+        v = self
+        hiddenRootNode = v.context.hiddenRootNode
+        seen = set([v, hiddenRootNode])
+        stack = v.parents[:]
+        while stack:
+            v = stack.pop()
+            if v not in seen:
+                seen.add(v)
+                yield v
+                stack.extend(v.parents)
     #@+node:ekr.20031218072017.3359: *3* v.Getters
     #@+node:ekr.20031218072017.3378: *4* v.bodyString
     body_unicode_warning = False
@@ -2364,24 +2486,13 @@ class VNodeBase(object):
         v.statusBits &= ~v.dirtyBit
     #@+node:ekr.20090830051712.6153: *5* v.findAllPotentiallyDirtyNodes
     def findAllPotentiallyDirtyNodes(self):
+        '''Return a list of v and all of v's ancestors.'''
         trace = False and not g.unitTesting
-        v = self; c = v.context
-        # Set the starting nodes.
-        nodes = []
-        newNodes = [v]
-        # Add nodes until no more are added.
-        while newNodes:
-            addedNodes = []
-            nodes.extend(newNodes)
-            for v in newNodes:
-                for v2 in v.parents:
-                    if v2 not in nodes and v2 not in addedNodes:
-                        addedNodes.append(v2)
-            newNodes = addedNodes[:]
-        # Remove the hidden VNode.
-        if c.hiddenRootNode in nodes:
-            if trace: g.trace('removing hidden root', c.hiddenRootNode)
-            nodes.remove(c.hiddenRootNode)
+        v = self
+        if v is v.context.hiddenRootNode:
+            return []
+        nodes = [v]
+        nodes.extend(v.unique_ancestors())
         if trace: g.trace(nodes)
         return nodes
     #@+node:ekr.20090830051712.6157: *5* v.setAllAncestorAtFileNodesDirty
@@ -2563,6 +2674,7 @@ class VNodeBase(object):
                     self.unicode_warning_given = True
                     g.internalError(s)
                     g.es_exception()
+        sig.emit(self.context, 'headline_changed', self)
 
     initBodyString = setBodyString
     initHeadString = setHeadString
@@ -2571,8 +2683,10 @@ class VNodeBase(object):
     #@+node:ekr.20031218072017.3402: *4* v.setSelection
     def setSelection(self, start, length):
         v = self
-        v.selectionStart = start
-        v.selectionLength = length
+        if (start, length) != (v.selectionStart, v.selectionLength):
+            # Don't create v.__dict__ for the usual empty selection.
+            v.selectionStart = start
+            v.selectionLength = length
     #@+node:ville.20120502221057.7498: *4* v.contentModified
     def contentModified(self):
         g.contentModifiedSet.add(self)
@@ -2619,6 +2733,7 @@ class VNodeBase(object):
         # Set zodb changed flags.
         v._p_changed = 1
         parent_v._p_changed = 1
+        sig.emit(v.context, 'tree_changed', v)
         # If v has only one parent, we adjust all
         # the parents links in the descendant tree.
         # This handles clones properly when undoing a delete.
@@ -2649,6 +2764,7 @@ class VNodeBase(object):
             v.parents.remove(parent_v)
         v._p_changed = 1
         parent_v._p_changed = 1
+        sig.emit(v.context, 'tree_changed', v, cut=True)
         # If v has no more parents, we adjust all
         # the parent links in the descendant tree.
         # This handles clones properly when deleting a tree.
@@ -2724,6 +2840,27 @@ class VNodeBase(object):
     gnx = property(
         __get_gnx, # __set_gnx,
         doc="VNode gnx property")
+    #@+node:agent.20261018230000.2: *4* v.expandedPositions property
+    def __get_expandedPositions(self):
+        try:
+            return self._expandedPositions
+        except AttributeError:
+            self._expandedPositions = []
+            return self._expandedPositions
+
+    def __set_expandedPositions(self, aList):
+        if aList:
+            self._expandedPositions = aList
+        else:
+            # Don't keep empty lists for the many contracted nodes.
+            try:
+                del self._expandedPositions
+            except AttributeError:
+                pass
+
+    expandedPositions = property(
+        __get_expandedPositions, __set_expandedPositions,
+        doc="VNode expandedPositions property: positions that should be expanded")
     #@-others
 
 if use_zodb and ZODB:
@@ -2737,6 +2874,55 @@ else:
 vnode = VNode # compatibility.
 
 #@@beautify
+#@+node:agent.20261018220000.1: ** class LazyVNode
+class LazyVNode(VNode):
+    '''
+    A VNode whose body text and uA's have not yet been read from a .db file.
+
+    fc.retrieveVnodesFromDb creates LazyVNodes if @bool sqlite-lazy-bodies
+    is True. The first access to v._bodyString or v.unknownAttributes calls
+    fc.loadLazyVnodes, which reads both and changes v's class to VNode.
+    '''
+    __slots__ = () # Required to change v.__class__.
+    #@+others
+    #@+node:agent.20261018220000.2: *3* LazyVNode._bodyString
+    def __get_bodyString(self):
+        self.context.fileCommands.loadLazyVnodes([self])
+        return self._bodyString
+
+    def __set_bodyString(self, s):
+        self.context.fileCommands.loadLazyVnodes([self])
+        self._bodyString = s
+
+    _bodyString = property(
+        __get_bodyString, __set_bodyString,
+        doc="LazyVNode _bodyString property")
+    #@+node:agent.20261018220000.9: *3* LazyVNode.isAtIgnoreNode
+    def isAtIgnoreNode(self):
+        '''
+        Like v.isAtIgnoreNode, but read the body text only if it contains
+        "@ignore". Outline walks call this for every node.
+        '''
+        if self.gnx in self.context.fileCommands.lazyIgnoreSet:
+            return VNode.isAtIgnoreNode(self)
+        return g.match_word(self._headString, 0, '@ignore')
+    #@+node:agent.20261018220000.3: *3* LazyVNode.unknownAttributes
+    def __get_unknownAttributes(self):
+        self.context.fileCommands.loadLazyVnodes([self])
+        return self.unknownAttributes
+
+    def __set_unknownAttributes(self, val):
+        self.context.fileCommands.loadLazyVnodes([self])
+        self.unknownAttributes = val
+
+    def __del_unknownAttributes(self):
+        self.context.fileCommands.loadLazyVnodes([self])
+        del self.unknownAttributes
+
+    unknownAttributes = property(
+        __get_unknownAttributes, __set_unknownAttributes, __del_unknownAttributes,
+        doc="LazyVNode unknownAttributes property")
+    #@-others
 #@-others
 #@@language python
 #@@tabwidth -4
@@ -2,7 +2,11 @@
 #@+node:ekr.20031218072017.3439: * @file leoPlugins.py
 '''Classes relating to Leo's plugin architecture.'''
 import leo.core.leoGlobals as g
+import ast
+import collections
+import json
 import sys
+import time
 # Define modules that may be enabled by default
 # but that mignt not load because imports may fail.
 optional_modules = [
@@ -263,7 +267,18 @@ class LeoPluginsController(object):
             # The stack of module names.
             # The top is the module being loaded.
         self.signonModule = None # A hack for plugin_signon.
+        self.lazyModules = {}
+            # Keys are names of lazily loaded modules that have not been imported.
+            # Values are dicts returned by PluginScanner.scan.
+        self.scanCache = None
+            # Keys are paths, values are (mtime, dict) tuples. Saved in g.app.db.
+        self.hook_profiling = False
+            # True: record the time taken by each handler.
+        self.hook_stats = {}
+            # Keys are (tag, moduleName, handler name), values are HookStats.
         # Settings.  Set these here in case finishCreate is never called.
+        self.hook_threshold = 0.02
+            # Seconds. Handlers taking longer are flagged as slow.
         self.warn_on_failure = True
         assert(g)
         g.act_on_node = CommandChainDispatcher()
@@ -277,20 +292,36 @@ class LeoPluginsController(object):
         self.warn_on_failure = g.app.config.getBool(
             setting='warn_when_plugins_fail_to_load',
             default=True)
+        threshold = g.app.config.getInt('plugin-hook-latency-threshold')
+        if threshold and threshold > 0:
+            self.hook_threshold = threshold / 1000.0
+        if g.app.config.getBool('profile-plugin-hooks', default=False):
+            self.hook_profiling = True
     #@+node:ekr.20100909065501.5952: *3* plugins.Event handlers
     #@+node:ekr.20161029060545.1: *4* plugins.on_idle
     def on_idle(self):
         '''Call all idle-time hooks.'''
+        for z in self.idle_task():
+            pass
+    #@+node:agent.20261019000000.25: *4* plugins.idle_task
+    def idle_task(self):
+        '''
+        The idle-time task that calls all idle-time hooks.
+        Yield after calling the hooks for each commander.
+        '''
         trace = False and not g.unitTesting
         if g.app.idle_time_hooks_enabled:
-            for frame in g.app.windowList:
+            for frame in g.app.windowList[:]:
                 c = frame.c
+                if frame not in g.app.windowList:
+                    continue
                 # Do NOT compute c.currentPosition.
                 # This would be a MAJOR leak of positions.
                 if trace:
                     g.trace('(leoPlugins.py) calling g.doHook(c=%s)' % (
                         c.shortFileName()))
                 g.doHook("idle", c=c)
+                yield
     #@+node:ekr.20100908125007.6017: *4* plugins.doHandlersForTag & helper
     def doHandlersForTag(self, tag, keywords):
         """
@@ -338,12 +369,15 @@ class LeoPluginsController(object):
                     return None
         # Calls to registerHandler from inside the handler belong to moduleName.
         self.loadingModuleNameStack.append(moduleName)
+        t1 = time.time() if self.hook_profiling else None
         try:
             result = handler(tag, keywords)
         except Exception:
             g.es("hook failed: %s, %s, %s" % (tag, handler, moduleName))
             g.es_exception()
             result = None
+        if t1 is not None and self.hook_profiling:
+            self.recordHookTime(tag, moduleName, handler, time.time() - t1)
         self.loadingModuleNameStack.pop()
         return result
     #@+node:ekr.20100908125007.6018: *4* plugins.doPlugins (g.app.hookFunction)
@@ -362,6 +396,114 @@ class LeoPluginsController(object):
         if tag in ('start1', 'open0'):
             self.loadHandlers(tag, keywords)
         return self.doHandlersForTag(tag, keywords)
+    #@+node:agent.20261019000000.30: *3* plugins.Hook profiling
+    #@+node:agent.20261019000000.31: *4* class HookStats
+    class HookStats(object):
+        '''A class to hold the latencies of one handler for one tag.'''
+
+        max_samples = 1000
+            # The number of recent latencies kept for percentiles.
+
+        def __init__(self, tag, moduleName, name):
+            '''Ctor for the HookStats class.'''
+            self.tag = tag
+            self.moduleName = moduleName
+            self.name = name
+            self.count = 0
+            self.max = 0.0
+            self.samples = collections.deque(maxlen=self.max_samples)
+            self.slow = 0
+                # The number of calls exceeding the latency threshold.
+            self.total = 0.0
+
+        def percentile(self, n):
+            '''Return the n'th percentile of the recent latencies.'''
+            if not self.samples:
+                return 0.0
+            aList = sorted(self.samples)
+            return aList[int(round((len(aList) - 1) * n / 100.0))]
+
+        def __repr__(self):
+            return 'HookStats: %s %s.%s count: %s' % (
+                self.tag, self.moduleName, self.name, self.count)
+
+        __str__ = __repr__
+    #@+node:agent.20261019000000.32: *4* plugins.clearHookProfile
+    def clearHookProfile(self):
+        '''Clear all statistics about handlers.'''
+        self.hook_stats = {}
+    #@+node:agent.20261019000000.33: *4* plugins.getHookProfile
+    def getHookProfile(self):
+        '''
+        Return a list of dicts describing the latencies of all handlers,
+        most expensive first. Times are in milliseconds.
+        '''
+        result = []
+        for stats in sorted(self.hook_stats.values(), key=lambda z: -z.total):
+            result.append({
+                'tag': stats.tag,
+                'module': stats.moduleName,
+                'handler': stats.name,
+                'count': stats.count,
+                'total': 1000 * stats.total,
+                'mean': 1000 * stats.total / stats.count,
+                'max': 1000 * stats.max,
+                'p50': 1000 * stats.percentile(50),
+                'p90': 1000 * stats.percentile(90),
+                'p99': 1000 * stats.percentile(99),
+                'slow': stats.slow,
+            })
+        return result
+    #@+node:agent.20261019000000.34: *4* plugins.printHookProfile
+    def printHookProfile(self, c):
+        '''
+        Print the latencies of all handlers in the Plugins tab.
+        '*' marks handlers that have exceeded the latency threshold.
+        '''
+        tabName = 'Plugins'
+        c.frame.log.selectTab(tabName)
+        data = self.getHookProfile()
+        lines = ['hook profile (msec.)%s, threshold: %s msec.\n' % (
+            '' if self.hook_profiling else ' (not profiling)',
+            int(1000 * self.hook_threshold))]
+        lines.append('%7s %9s %7s %7s %7s %7s %5s  %s\n' % (
+            'count', 'total', 'mean', 'p90', 'p99', 'max', 'slow', 'handler'))
+        for d in data:
+            lines.append('%7s %9.1f %7.2f %7.2f %7.2f %7.2f %5s%s %s %s.%s\n' % (
+                d['count'], d['total'], d['mean'], d['p90'], d['p99'],
+                d['max'], d['slow'], '*' if d['slow'] else ' ',
+                d['tag'], d['module'], d['handler']))
+        g.es('', ''.join(lines), tabName=tabName)
+    #@+node:agent.20261019000000.35: *4* plugins.recordHookTime
+    def recordHookTime(self, tag, moduleName, handler, delta):
+        '''Record the time, in seconds, taken by handler for tag.'''
+        name = getattr(handler, '__name__', None) or repr(handler)
+        obj = getattr(handler, '__self__', None)
+        if obj is not None:
+            name = '%s.%s' % (obj.__class__.__name__, name)
+        key = tag, moduleName, name
+        stats = self.hook_stats.get(key)
+        if not stats:
+            stats = self.hook_stats[key] = self.HookStats(tag, moduleName, name)
+        stats.count += 1
+        stats.max = max(stats.max, delta)
+        stats.samples.append(delta)
+        stats.total += delta
+        if delta > self.hook_threshold:
+            stats.slow += 1
+            if stats.slow == 1:
+                g.es_print('slow hook: %s %s.%s %4.1f msec.' % (
+                    tag, moduleName, name, 1000 * delta))
+    #@+node:agent.20261019000000.36: *4* plugins.writeHookProfile
+    def writeHookProfile(self, fn):
+        '''Write the latencies of all handlers to fn as json.'''
+        d = {
+            'profiling': self.hook_profiling,
+            'threshold': 1000 * self.hook_threshold,
+            'handlers': self.getHookProfile(),
+        }
+        with open(fn, 'w') as f:
+            json.dump(d, f, indent=1, sort_keys=True)
     #@+node:ekr.20100909065501.5950: *3* plugins.Information
     #@+node:ekr.20100908125007.6019: *4* plugins.getHandlersForTag
     def getHandlersForTag(self, tags):
@@ -423,6 +565,8 @@ class LeoPluginsController(object):
         data.append('enabled plugins...\n')
         for z in sorted(self.loadedModules):
             data.append(z)
+        for z in sorted(self.lazyModules):
+            data.append('%s (not yet loaded)' % z)
         lines = ['%s\n' % (s) for s in data]
         g.es('', ''.join(lines), tabName=tabName)
     #@+node:ekr.20100908125007.6027: *4* plugins.printPluginsInfo
@@ -471,8 +615,13 @@ class LeoPluginsController(object):
                 s2 = '@enabled-plugins found in %s' % (
                     g.app.config.enabledPluginsFileName)
                 g.blue(s2)
+        lazy = (
+            g.app.config.getBool('lazy-load-plugins', default=False) and
+            not g.app.unitTesting)
         for plugin in s.splitlines():
             if plugin.strip() and not plugin.lstrip().startswith('#'):
+                if lazy and self.loadLazyStubs(plugin.strip()):
+                    continue
                 self.loadOnePlugin(plugin.strip(), tag=tag)
     #@+node:ekr.20100908125007.6024: *4* plugins.loadOnePlugin
     def loadOnePlugin(self, moduleOrFileName, tag='open0', verbose=False):
@@ -505,6 +654,10 @@ class LeoPluginsController(object):
             module = self.loadedModules.get(moduleName)
             if trace: report('already loaded: %s' % moduleName)
             return module
+        if moduleName in self.lazyModules:
+            # Load the module now, replacing its stubs.
+            if trace: report('loading lazy plugin: %s' % moduleName)
+            self.removeLazyStubs(moduleName)
         assert g.app.loadDir
         moduleName = g.toUnicode(moduleName)
         # This import will typically result in calls to registerHandler.
@@ -577,6 +730,149 @@ class LeoPluginsController(object):
                     if moduleName not in optional_modules:
                         report('can not load enabled plugin: %s' % moduleName)
         return result
+    #@+node:agent.20261019000000.47: *4* plugins.Lazy loading
+    #@+node:agent.20261019000000.48: *5* plugins.loadLazyStubs & helpers
+    startup_hooks = (
+        'after-create-leo-frame', 'after-create-leo-frame2', 'after-redraw-outline',
+        'before-create-leo-frame', 'create-optional-menus', 'idle',
+        'menu1', 'menu2', 'new', 'new2', 'open0', 'open1', 'open2',
+        'select1', 'select2', 'select3', 'start1', 'start2', 'unselect1',
+        'unselect2', 'all',
+    )
+        # Hooks that fire while Leo starts. Lazy loading of plugins that use
+        # these hooks would save nothing.
+
+    def loadLazyStubs(self, moduleOrFileName):
+        '''
+        Register stubs for the commands and hooks of a plugin, so that the
+        plugin is imported only when one of them is first used.
+
+        Return True if the plugin will be loaded lazily.
+        '''
+        trace = 'plugins' in g.app.debug
+        if not g.app.enablePlugins or moduleOrFileName.startswith('@'):
+            return False
+        moduleName = g.toUnicode(self.regularizeName(moduleOrFileName))
+        if moduleName in self.lazyModules:
+            return True
+        if self.isLoaded(moduleName):
+            return False
+        d = self.scanPlugin(moduleName)
+        if not d or any(z in self.startup_hooks for z in d['hooks']):
+            return False
+        for ui in d['ui']:
+            try:
+                g.assertUi(ui)
+            except g.UiTypeException:
+                return True # Importing the plugin would fail.
+        if trace: g.es_print('lazy plugin: %s' % moduleName)
+        self.lazyModules[moduleName] = d
+
+        def lazy_hook(tag, keywords, moduleName=moduleName):
+            return self.doLazyHook(moduleName, tag, keywords)
+
+        lazy_hook.lazy_module = moduleName
+        self.loadingModuleNameStack.append(moduleName)
+        try:
+            for tag in d['hooks']:
+                self.registerOneHandler(tag, lazy_hook)
+        finally:
+            self.loadingModuleNameStack.pop()
+        for commandName, doc in d['commands']:
+            self.registerLazyCommand(moduleName, commandName, doc)
+        return True
+
+    def registerLazyCommand(self, moduleName, commandName, doc):
+        '''Register a stub for a command of a lazily loaded plugin.'''
+
+        def lazy_command(event=None, commandName=commandName):
+            return self.doLazyCommand(moduleName, commandName, event)
+
+        lazy_command.__doc__ = doc
+        lazy_command.lazy_module = moduleName
+        g.command(commandName)(lazy_command)
+    #@+node:agent.20261019000000.49: *5* plugins.doLazyCommand & doLazyHook
+    def doLazyCommand(self, moduleName, commandName, event):
+        '''Load the plugin, then execute its command.'''
+        self.loadOnePlugin(moduleName, tag='open0')
+        func = g.global_commands_dict.get(commandName)
+        if func and getattr(func, 'lazy_module', None) is None:
+            return func(event)
+        g.es_print('%s did not define %s' % (moduleName, commandName))
+        return None
+
+    def doLazyHook(self, moduleName, tag, keywords):
+        '''Load the plugin, then call its handlers for tag.'''
+        self.loadOnePlugin(moduleName, tag='open0')
+        for bunch in self.handlers.get(tag, [])[:]:
+            if bunch.moduleName == moduleName:
+                val = self.callTagHandler(bunch, tag, keywords)
+                if val is not None:
+                    return val
+        return None
+    #@+node:agent.20261019000000.50: *5* plugins.removeLazyStubs
+    def removeLazyStubs(self, moduleName):
+        '''
+        Remove the command and hook stubs of a lazily loaded plugin.
+        Create new handler lists: doHandlersForTag may be iterating
+        over the old lists.
+        '''
+        del self.lazyModules[moduleName]
+
+        def is_stub(func):
+            return getattr(func, 'lazy_module', None) == moduleName
+
+        for tag in list(self.handlers):
+            bunches = self.handlers.get(tag)
+            if any(is_stub(z.fn) for z in bunches):
+                self.handlers[tag] = [z for z in bunches if not is_stub(z.fn)]
+        for commandName, func in list(g.global_commands_dict.items()):
+            if is_stub(func):
+                del g.global_commands_dict[commandName]
+                for c in g.app.commanders():
+                    if is_stub(c.commandsDict.get(commandName)):
+                        del c.commandsDict[commandName]
+    #@+node:agent.20261019000000.51: *5* plugins.scanPlugin
+    def scanPlugin(self, moduleName):
+        '''
+        Return the dict describing the commands and hooks of the plugin,
+        or None. Cache the results in g.app.db.
+        '''
+        path = self.findPluginFile(moduleName)
+        if not path:
+            return None
+        try:
+            mtime = g.os_path_getmtime(path)
+        except OSError:
+            return None
+        db, key = g.app.db, 'lazy-plugins'
+        if self.scanCache is None:
+            self.scanCache = (db.get(key) if db is not None else None) or {}
+        data = self.scanCache.get(path)
+        if data and data[0] == mtime:
+            return data[1]
+        with open(path, 'rb') as f:
+            s = f.read()
+        d = PluginScanner().scan(s)
+        self.scanCache[path] = (mtime, d)
+        if db is not None:
+            db[key] = self.scanCache
+        return d
+
+    def findPluginFile(self, moduleName):
+        '''Return the path to the source of the given plugin, or None.'''
+        tag = 'leo.plugins.'
+        if moduleName.startswith(tag):
+            path = g.os_path_finalize_join(g.app.loadDir, '..', 'plugins',
+                moduleName[len(tag):].replace('.', '/') + '.py')
+            return path if g.os_path_exists(path) else None
+        try:
+            import importlib.util
+            spec = importlib.util.find_spec(moduleName)
+        except Exception:
+            return None
+        path = spec and spec.origin
+        return path if path and path.endswith('.py') else None
     #@+node:ekr.20031218072017.1318: *4* plugins.plugin_signon
     def plugin_signon(self, module_name, verbose=False):
         '''Print the plugin signon.'''
@@ -661,6 +957,169 @@ class LeoPluginsController(object):
         bunches = [bunch for bunch in bunches if bunch and bunch.fn != fn]
         self.handlers[tag] = bunches
     #@-others
+#@+node:agent.20261019000000.40: ** class PluginScanner
+class PluginScanner(object):
+    '''
+    Find the commands and hooks that a plugin provides, without importing
+    the plugin.
+
+    A plugin can be loaded lazily only if importing it and calling its
+    init function can do nothing but define functions and classes,
+    register hooks with literal tags and define commands with @g.command.
+    A plugin can override the scan with a top-level assignment::
+
+        lazy_load = False # Never load this plugin lazily.
+        lazy_load = {'commands': ['my-command'], 'hooks': ['icondclick1']}
+    '''
+
+    init_calls = (
+        'assertUi', 'createDefaultGui', 'createQtGui', 'endswith', 'error',
+        'es', 'es_print', 'getBool', 'getData', 'getInt', 'getString',
+        'guiName', 'hasattr', 'isinstance', 'lower', 'plugin_signon', 'pr',
+        'print', 'startswith', 'trace', 'warning',
+    )
+        # Calls allowed in init functions, besides g.registerHandler.
+    top_level_calls = (
+        'assertUi', 'error', 'es', 'es_exception', 'es_print', 'pr',
+        'print', 'trace', 'warning',
+    )
+        # Calls allowed in top-level statements.
+
+    class Unsafe(Exception):
+        '''The plugin can not be loaded lazily.'''
+        pass
+
+    #@+others
+    #@+node:agent.20261019000000.41: *3* scanner.scan
+    def scan(self, s):
+        '''
+        Scan the source s of a plugin.
+
+        Return a dict with these keys, or None if the plugin must be
+        loaded at startup:
+        'commands': a list of (command name, docstring) tuples.
+        'hooks':    a list of tags.
+        'ui':       a list of arguments to top-level g.assertUi calls.
+        '''
+        self.commands, self.hooks, self.ui = [], [], []
+        self.declared, self.init = None, None
+        try:
+            tree = ast.parse(s)
+            self.scan_statements(tree.body)
+            if self.declared is not None:
+                return self.scan_declaration(self.declared)
+            if self.init:
+                self.scan_init(self.init)
+        except (SyntaxError, ValueError, self.Unsafe):
+            return None
+        if not self.commands and not self.hooks:
+            # Nothing would ever load the plugin.
+            return None
+        return {'commands': self.commands, 'hooks': self.hooks, 'ui': self.ui}
+    #@+node:agent.20261019000000.42: *3* scanner.scan_declaration
+    def scan_declaration(self, d):
+        '''Return the dict describing a lazy_load declaration.'''
+        if not isinstance(d, dict):
+            return None
+        commands = [(name, None) for name in d.get('commands', [])]
+        hooks = list(d.get('hooks', []))
+        if not commands and not hooks:
+            return None
+        return {'commands': commands, 'hooks': hooks, 'ui': self.ui}
+    #@+node:agent.20261019000000.43: *3* scanner.scan_init
+    def scan_init(self, node):
+        '''Scan the plugin's init function.'''
+        for z in ast.walk(node):
+            if isinstance(z, ast.Call):
+                name = self.callee(z)
+                if name == 'registerHandler' and z.args:
+                    tags = self.literal(z.args[0])
+                    if g.isString(tags):
+                        tags = [tags]
+                    if not isinstance(tags, (list, tuple)):
+                        raise self.Unsafe
+                    for tag in tags:
+                        if not g.isString(tag):
+                            raise self.Unsafe
+                        if tag not in self.hooks:
+                            self.hooks.append(tag)
+                elif name not in self.init_calls:
+                    raise self.Unsafe
+            elif isinstance(z, ast.Assign):
+                if not all(isinstance(z2, ast.Name) for z2 in z.targets):
+                    raise self.Unsafe
+            elif isinstance(z, ast.Global):
+                raise self.Unsafe
+    #@+node:agent.20261019000000.44: *3* scanner.scan_statements
+    def scan_statements(self, statements):
+        '''Scan top-level statements.'''
+        for node in statements:
+            if isinstance(node, (ast.ClassDef, ast.Import, ast.ImportFrom, ast.Pass)):
+                pass
+            elif isinstance(node, ast.FunctionDef):
+                self.scan_def(node)
+            elif isinstance(node, ast.Assign):
+                for target in node.targets:
+                    if isinstance(target, ast.Name) and target.id == 'lazy_load':
+                        self.declared = self.literal(node.value)
+                    elif not isinstance(target, (ast.Name, ast.Tuple)):
+                        raise self.Unsafe
+            elif isinstance(node, ast.Expr):
+                if isinstance(node.value, ast.Call):
+                    name = self.callee(node.value)
+                    if name not in self.top_level_calls:
+                        raise self.Unsafe
+                    if name == 'assertUi' and node.value.args:
+                        self.ui.append(self.literal(node.value.args[0]))
+                # Other expressions are docstrings or harmless.
+            elif isinstance(node, ast.If):
+                self.scan_statements(node.body)
+                self.scan_statements(node.orelse)
+            elif hasattr(ast, 'Try') and isinstance(node, ast.Try):
+                self.scan_try(node)
+            elif hasattr(ast, 'TryExcept') and isinstance(node, (ast.TryExcept, ast.TryFinally)):
+                self.scan_try(node)
+            else:
+                raise self.Unsafe
+
+    def scan_try(self, node):
+        for attr in ('body', 'orelse', 'finalbody'):
+            self.scan_statements(getattr(node, attr, []))
+        for handler in getattr(node, 'handlers', []):
+            self.scan_statements(handler.body)
+    #@+node:agent.20261019000000.45: *3* scanner.scan_def
+    def scan_def(self, node):
+        '''Scan a top-level function definition.'''
+        for d in node.decorator_list:
+            if (
+                isinstance(d, ast.Call) and self.callee(d) == 'command' and
+                len(d.args) == 1 and not d.keywords
+            ):
+                name = self.literal(d.args[0])
+                if not g.isString(name):
+                    raise self.Unsafe
+                self.commands.append((name, ast.get_docstring(node)))
+            elif not isinstance(d, ast.Name):
+                raise self.Unsafe
+        if node.name == 'init':
+            self.init = node
+    #@+node:agent.20261019000000.46: *3* scanner.callee & literal
+    def callee(self, node):
+        '''Return the name of the function called by an ast.Call node.'''
+        func = node.func
+        if isinstance(func, ast.Attribute):
+            return func.attr
+        if isinstance(func, ast.Name):
+            return func.id
+        return None
+
+    def literal(self, node):
+        '''Return the value of a literal ast node.'''
+        try:
+            return ast.literal_eval(node)
+        except (SyntaxError, TypeError, ValueError):
+            raise self.Unsafe
+    #@-others
 #@-others
 #@@language python
 #@@tabwidth -4
@@ -44,6 +44,8 @@
 # I first saw this model of unlimited undo in the documentation for Apple's Yellow Box classes.
 #@-<< How Leo implements unlimited undo >>
 import leo.core.leoGlobals as g
+import leo.core.leoNodes as leoNodes
+import sys
 # pylint: disable=unpacking-non-sequence
 #@+others
 #@+node:ekr.20031218072017.3605: ** class Undoer
@@ -62,12 +64,18 @@ class Undoer(object):
         self.granularity = None # Set in reloadSettings.
         # g.trace('Undoer',self.granularity)
         self.max_undo_stack_size = c.config.getInt('max_undo_stack_size') or 0
+        self.max_undo_stack_memory = 1024 * 1024 * (
+            c.config.getInt('max_undo_stack_memory') or 0)
+            # The maximum estimated size of all beads, in bytes.
         # Statistics comparing old and new ways (only if self.debug_Undoer is on).
         self.new_mem = 0
         self.old_mem = 0
         # State ivars...
         self.beads = [] # List of undo nodes.
         self.bead = -1 # Index of the present bead: -1:len(beads)
+        self.beadSizes = {}
+            # Keys are id(bunch), values are (bunch, size) tuples.
+            # A cache for u.getBeadSizes.
         self.undoType = "Can't Undo"
         # These must be set here, _not_ in clearUndoState.
         self.redoMenuLabel = "Can't Redo"
@@ -163,6 +171,28 @@ class Undoer(object):
             u.beads = u.beads[-n:]
             u.bead = n - 1
             # g.trace('bead:',u.bead,'len(u.beads)',len(u.beads),g.callers())
+        if u.max_undo_stack_memory > 0 and u.bead > 0:
+            u.cutStackMemory()
+    #@+node:agent.20261019000000.12: *5* u.cutStackMemory
+    def cutStackMemory(self):
+        '''
+        Discard the oldest beads until the estimated size of all beads is at
+        most u.max_undo_stack_memory. Never discard the present bead or the
+        beads following it.
+        '''
+        u = self
+        # Do nothing if we are in the middle of creating a group.
+        for bunch in u.beads:
+            if getattr(bunch, 'kind', None) == 'beforeGroup':
+                return
+        sizes = u.getBeadSizes()
+        total, n = sum(sizes), 0
+        while total > u.max_undo_stack_memory and n < u.bead:
+            total -= sizes[n]
+            n += 1
+        if n > 0:
+            u.beads = u.beads[n:]
+            u.bead -= n
     #@+node:ekr.20080623083646.10: *4* u.dumpBead
     def dumpBead(self, n):
         u = self
@@ -192,6 +222,69 @@ class Undoer(object):
         bunch = u.beads[n]
         self.setIvarsFromBunch(bunch)
         return bunch
+    #@+node:agent.20261019000000.13: *4* u.getBeadSizes & helper
+    def getBeadSizes(self):
+        '''
+        Return a list of the estimated sizes, in bytes, of all beads.
+
+        Sizes are cached, except for the present and last beads, which may
+        still be changing.
+        '''
+        u = self
+        d, result = {}, []
+        for i, bunch in enumerate(u.beads):
+            data = u.beadSizes.get(id(bunch))
+            if (not data or data[0] is not bunch or
+                i == u.bead or i == len(u.beads) - 1
+            ):
+                data = bunch, u.computeBeadSize(bunch)
+            d[id(bunch)] = data
+            result.append(data[1])
+        u.beadSizes = d
+        return result
+
+    def memoryUsage(self):
+        '''Return the estimated size, in bytes, of the undo stack.'''
+        return sum(self.getBeadSizes())
+    #@+node:agent.20261019000000.14: *5* u.computeBeadSize
+    def computeBeadSize(self, bunch):
+        '''
+        Return the estimated size, in bytes, of the strings, lists, tuples
+        and dicts in bunch, an undo bead, counting shared objects once.
+
+        Strings that are still the headline or body text of a vnode in the
+        bead are shared with the outline, so they are not counted.
+        '''
+        seen, live, strings = set(), set(), {}
+        size = 0
+        todo = [bunch]
+        while todo:
+            obj = todo.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            if g.isString(obj):
+                strings[id(obj)] = sys.getsizeof(obj)
+                continue
+            if isinstance(obj, leoNodes.Position):
+                obj = obj.v
+            if isinstance(obj, leoNodes.VNode):
+                live.add(id(obj._headString))
+                if not isinstance(obj, leoNodes.LazyVNode):
+                    live.add(id(obj._bodyString))
+                continue
+            if isinstance(obj, g.Bunch):
+                obj = obj.__dict__
+            if isinstance(obj, dict):
+                size += sys.getsizeof(obj)
+                todo.extend(obj.values())
+            elif isinstance(obj, (list, tuple)):
+                size += sys.getsizeof(obj)
+                todo.extend(obj)
+        for key, n in strings.items():
+            if key not in live:
+                size += n
+        return size
     #@+node:EKR.20040526150818.1: *4* u.peekBead
     def peekBead(self, n):
         # g.trace(repr(n),g.callers())
@@ -337,11 +430,18 @@ class Undoer(object):
     def restoreTree(self, treeInfo):
         """Use the tree info to restore all VNode data,
         including all links."""
-        u = self
         # This effectively relinks all vnodes.
-        for v, vInfo, tInfo in treeInfo:
-            u.restoreVnodeUndoInfo(vInfo)
-            u.restoreTnodeUndoInfo(tInfo)
+        for data in treeInfo:
+            v, statusBits, parents, children, h, b, uA = data
+            v.statusBits = statusBits
+            # Copy the saved tuples: the tree info must never change.
+            v.children = list(children)
+            v.parents = list(parents)
+            v.h = h
+            v.b = b
+            if uA is not None:
+                v.unknownAttributes = uA
+                v._p_changed = 1
     #@+node:ekr.20050415170737.2: *5* u.restoreVnodeUndoInfo
     def restoreVnodeUndoInfo(self, bunch):
         """Restore all ivars saved in the bunch."""
@@ -364,7 +464,7 @@ class Undoer(object):
             v.unknownAttributes = uA
             v._p_changed = 1
     #@+node:EKR.20040528075307: *4* u.saveTree & helpers
-    def saveTree(self, p, treeInfo=None):
+    def saveTree(self, p, treeInfo=None, base=None):
         """Return a list of tuples with all info needed to handle a general undo operation."""
         # WARNING: read this before doing anything "clever"
         #@+<< about u.saveTree >>
@@ -377,28 +477,32 @@ class Undoer(object):
         # 
         # Instead of creating new nodes, the new code creates all information
         # needed to properly restore the vnodes and tnodes. It creates a list of
-        # tuples, on tuple for each VNode in the tree. Each tuple has the form,
-        # 
-        # (vnodeInfo, tnodeInfo)
-        # 
-        # where vnodeInfo and tnodeInfo are dicts contain all info needed to
-        # recreate the nodes. The v.createUndoInfoDict and t.createUndoInfoDict
-        # methods correspond to the old v.copy and t.copy methods.
+        # tuples, one tuple for each VNode in the tree. See << about base >>.
         # 
         # Aside: Prior to 4.2 Leo used a scheme that was equivalent to the
         # createUndoInfoDict info, but quite a bit uglier.
         #@-<< about u.saveTree >>
-        u = self; topLevel = (treeInfo is None)
-        if topLevel: treeInfo = []
-        # Add info for p.v.  Duplicate tnode info is harmless.
-        data = (p.v, u.createVnodeUndoInfo(p.v), u.createTnodeUndoInfo(p.v))
-        treeInfo.append(data)
-        # Recursively add info for the subtree.
-        child = p.firstChild()
-        while child:
-            self.saveTree(child, treeInfo)
-            child = child.next()
-        # if topLevel: g.trace(treeInfo)
+        #@+<< about base >>
+        #@+node:agent.20261019000000.15: *5* << about base >>
+        #@+at Each entry of the tree info is a tuple:
+        # 
+        #     (v, statusBits, parents, children, headString, bodyString, uA)
+        # 
+        # Entries share all strings with the outline and with other entries, so
+        # unchanged headlines and body text take no extra space.
+        # 
+        # If base is given, saveTree omits entries that are equal to the entries in
+        # base. afterChangeTree uses this to save only the nodes that the command
+        # changed. This is safe because redo always follows the undo that restored
+        # the entire old tree.
+        #@-<< about base >>
+        if treeInfo is None: treeInfo = []
+        old = dict((data[0], data) for data in base) if base else {}
+        for v in p.v.self_and_unique_subtree():
+            data = (v, v.statusBits, tuple(v.parents), tuple(v.children),
+                v.h, v.b, getattr(v, 'unknownAttributes', None))
+            if old.get(v) != data:
+                treeInfo.append(data)
         return treeInfo
     #@+node:ekr.20050415170737.1: *5* u.createVnodeUndoInfo
     def createVnodeUndoInfo(self, v):
@@ -424,6 +528,12 @@ class Undoer(object):
         if hasattr(v, 'unknownAttributes'):
             bunch.unknownAttributes = v.unknownAttributes
         return bunch
+    #@+node:agent.20261019000000.16: *4* u.shareText
+    def shareText(self, s, p):
+        '''Return p.b if it equals s, so that a bead shares p's body text.'''
+        if p and s == p.b:
+            return p.b
+        return s
     #@+node:ekr.20050525151449: *4* u.trace
     def trace(self):
         ivars = ('kind', 'undoType')
@@ -501,6 +611,11 @@ class Undoer(object):
         bunch.newChanged = u.c.isChanged()
         bunch.newDirty = p.isDirty()
         bunch.newHead = p.h
+        # Share unchanged text.
+        if bunch.oldBody == bunch.newBody:
+            bunch.oldBody = bunch.newBody
+        if bunch.oldHead == bunch.newHead:
+            bunch.oldHead = bunch.newHead
         bunch.newMarked = p.isMarked()
         # Bug fix 2017/11/12: don't use ternary operator.
         if w:
@@ -521,8 +636,8 @@ class Undoer(object):
         bunch.redoHelper = u.redoTree
         # Set by beforeChangeTree: changed, oldSel, oldText, oldTree, p
         bunch.newSel = w.getSelectionRange()
-        bunch.newText = w.getAllText()
-        bunch.newTree = u.saveTree(p)
+        bunch.newText = u.shareText(w.getAllText(), c.p)
+        bunch.newTree = u.saveTree(p, base=bunch.oldTree)
         u.pushBead(bunch)
     #@+node:ekr.20050424161505: *5* u.afterClearRecentFiles
     def afterClearRecentFiles(self, bunch):
@@ -801,7 +916,7 @@ class Undoer(object):
         w = c.frame.body.wrapper
         bunch = u.createCommonBunch(p)
         bunch.oldSel = w.getSelectionRange()
-        bunch.oldText = w.getAllText()
+        bunch.oldText = u.shareText(w.getAllText(), c.p)
         bunch.oldTree = u.saveTree(p)
         return bunch
     #@+node:ekr.20050424161505.1: *5* u.beforeClearRecentFiles
@@ -980,36 +1095,17 @@ class Undoer(object):
         #@+at Incremental undo typing is similar to incremental syntax coloring. We compute
         # the number of leading and trailing lines that match, and save both the old and
         # new middle lines. NB: the number of old and new middle lines may be different.
+        # 
+        # When the selections tell where the edit happened, only the lines near the edit
+        # are split and compared. Otherwise, both texts are split and compared in full.
         #@@c
-        old_lines = oldText.split('\n')
-        new_lines = newText.split('\n')
-        new_len = len(new_lines)
-        old_len = len(old_lines)
-        min_len = min(old_len, new_len)
-        i = 0
-        while i < min_len:
-            if old_lines[i] != new_lines[i]:
-                break
-            i += 1
-        leading = i
-        if leading == new_len:
-            # This happens when we remove lines from the end.
-            # The new text is simply the leading lines from the old text.
-            trailing = 0
-        else:
-            i = 0
-            while i < min_len - leading:
-                if old_lines[old_len - i - 1] != new_lines[new_len - i - 1]:
-                    break
-                i += 1
-            trailing = i
-        # NB: the number of old and new middle lines may be different.
-        if trailing == 0:
-            old_middle_lines = old_lines[leading:]
-            new_middle_lines = new_lines[leading:]
+        span = u.computeTypingSpan(oldText, newText, oldSel, newSel)
+        if span:
+            leading, trailing, old_middle_lines, new_middle_lines = \
+                u.diffTypingSpan(oldText, newText, span)
         else:
-            old_middle_lines = old_lines[leading: -trailing]
-            new_middle_lines = new_lines[leading: -trailing]
+            leading, trailing, old_middle_lines, new_middle_lines = \
+                u.diffTypingLines(oldText, newText)
         # Remember how many trailing newlines in the old and new text.
         i = len(oldText) - 1; old_newlines = 0
         while i >= 0 and oldText[i] == '\n':
@@ -1020,6 +1116,7 @@ class Undoer(object):
             new_newlines += 1
             i -= 1
         if trace and verbose:
+            g.pr("span", span)
             g.pr("lead,trail", leading, trailing)
             g.pr("old mid,nls:", len(old_middle_lines), old_newlines, oldText)
             g.pr("new mid,nls:", len(new_middle_lines), new_newlines, newText)
@@ -1205,6 +1302,139 @@ class Undoer(object):
         if u.per_node_undo:
             u.putIvarsToVnode(p)
         return bunch # Never used.
+    #@+node:agent.20261019000000.6: *4* u.computeTypingSpan
+    def computeTypingSpan(self, oldText, newText, oldSel, newSel):
+        '''
+        Use the selection ranges before and after a typing operation to
+        compute the edited span of the text.
+
+        Return (start, oldEnd, newEnd), meaning that newText[start:newEnd]
+        replaced oldText[start:oldEnd], or None if the selections do not
+        bound the edit.
+        '''
+        if not oldSel or not newSel:
+            return None
+        indices = list(oldSel) + list(newSel)
+        for i in indices:
+            if not isinstance(i, int):
+                return None
+        old_len, new_len = len(oldText), len(newText)
+        start = max(0, min(indices))
+        # The length of the unchanged text following the edit.
+        tail = min(old_len - max(oldSel), new_len - max(newSel))
+        oldEnd, newEnd = old_len - tail, new_len - tail
+        if tail < 0 or start > oldEnd or start > newEnd:
+            return None
+        # Check the span: a wrong span would corrupt undo.
+        # Comparing strings is much faster than splitting them.
+        if (oldText[:start] != newText[:start] or
+            oldText[oldEnd:] != newText[newEnd:]
+        ):
+            return None
+        return start, oldEnd, newEnd
+    #@+node:agent.20261019000000.7: *4* u.diffTypingLines
+    def diffTypingLines(self, oldText, newText):
+        '''
+        Compare all lines of oldText and newText.
+
+        Return (leading, trailing, old_middle_lines, new_middle_lines).
+        '''
+        old_lines = oldText.split('\n')
+        new_lines = newText.split('\n')
+        new_len = len(new_lines)
+        old_len = len(old_lines)
+        min_len = min(old_len, new_len)
+        i = 0
+        while i < min_len:
+            if old_lines[i] != new_lines[i]:
+                break
+            i += 1
+        leading = i
+        if leading == new_len:
+            # This happens when we remove lines from the end.
+            # The new text is simply the leading lines from the old text.
+            trailing = 0
+        else:
+            i = 0
+            while i < min_len - leading:
+                if old_lines[old_len - i - 1] != new_lines[new_len - i - 1]:
+                    break
+                i += 1
+            trailing = i
+        # NB: the number of old and new middle lines may be different.
+        if trailing == 0:
+            old_middle_lines = old_lines[leading:]
+            new_middle_lines = new_lines[leading:]
+        else:
+            old_middle_lines = old_lines[leading: -trailing]
+            new_middle_lines = new_lines[leading: -trailing]
+        return leading, trailing, old_middle_lines, new_middle_lines
+    #@+node:agent.20261019000000.8: *4* u.diffTypingSpan
+    def diffTypingSpan(self, oldText, newText, span):
+        '''
+        Compare oldText and newText, given the span computed by
+        u.computeTypingSpan. Only lines near the span are compared.
+
+        Return the same values as u.diffTypingLines.
+        '''
+        start, oldEnd, newEnd = span
+        old_size, new_size = len(oldText), len(newText)
+        # All lines before the line containing start match.
+        # old_i and new_i are the offsets of the first unmatched line.
+        old_i = new_i = oldText.rfind('\n', 0, start) + 1
+        # Count the lines in both texts with a single scan of oldText.
+        leading = oldText.count('\n', 0, old_i)
+        rest = oldText.count('\n', old_i)
+        old_k = oldText.find('\n', oldEnd)
+        if old_k > -1:
+            after = rest - oldText.count('\n', old_i, old_k)
+        old_len = leading + rest + 1
+        new_len = (old_len -
+            oldText.count('\n', start, oldEnd) +
+            newText.count('\n', start, newEnd))
+        min_len = min(old_len, new_len)
+        while leading < min_len:
+            old_j = oldText.find('\n', old_i)
+            if old_j == -1: old_j = old_size
+            new_j = newText.find('\n', new_i)
+            if new_j == -1: new_j = new_size
+            if oldText[old_i: old_j] != newText[new_i: new_j]:
+                break
+            leading += 1
+            old_i, new_i = old_j + 1, new_j + 1
+        # All lines after the line containing oldEnd (newEnd) match.
+        # old_t and new_t are the offsets of the first matched trailing line,
+        # or the text's length + 1 if there are no matched trailing lines.
+        if old_k == -1:
+            trailing = 0
+            old_t, new_t = old_size + 1, new_size + 1
+        else:
+            trailing = after
+            old_t = old_k + 1
+            new_t = newEnd + (old_k - oldEnd) + 1
+        # Leading and trailing lines must not overlap.
+        max_trailing = min_len - leading
+        while trailing > max_trailing:
+            old_t = oldText.find('\n', old_t) + 1 or old_size + 1
+            new_t = newText.find('\n', new_t) + 1 or new_size + 1
+            trailing -= 1
+        while trailing < max_trailing:
+            old_b = oldText.rfind('\n', 0, old_t - 1) + 1
+            new_b = newText.rfind('\n', 0, new_t - 1) + 1
+            if oldText[old_b: old_t - 1] != newText[new_b: new_t - 1]:
+                break
+            trailing += 1
+            old_t, new_t = old_b, new_b
+        # NB: the number of old and new middle lines may be different.
+        if leading + trailing == old_len:
+            old_middle_lines = []
+        else:
+            old_middle_lines = oldText[old_i: old_t - 1].split('\n')
+        if leading + trailing == new_len:
+            new_middle_lines = []
+        else:
+            new_middle_lines = newText[new_i: new_t - 1].split('\n')
+        return leading, trailing, old_middle_lines, new_middle_lines
     #@+node:ekr.20031218072017.2030: *3* u.redo
     @cmd('redo')
     def redo(self, event=None):
@@ -1807,8 +2037,9 @@ class Undoer(object):
             # This is the first time we have undone the operation.
             # Put the new data in the bead.
             bunch = u.beads[u.bead]
-            bunch.newTree = u.saveTree(p.copy())
+            bunch.newTree = u.saveTree(p.copy(), base=old_data)
             u.beads[u.bead] = bunch
+            u.beadSizes.pop(id(bunch), None)
         # Replace data in tree with old data.
         u.restoreTree(old_data)
         c.setBodyString(p, p.b)
@@ -41,9 +41,8 @@ class GnxCache:
     def update_new_cs(self):
         for c in g.app.commanders():
             if c.hash() not in self.cs:
-                for p in c.all_unique_positions():
-                    k = p.gnx
-                    self.ps[k] = c, p.v
+                for v in c.all_unique_nodes():
+                    self.ps[v.gnx] = c, v
                 self.cs.add(c.hash())
         
     def get(self, gnx):
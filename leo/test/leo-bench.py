@@ -0,0 +1,551 @@
+#@+leo-ver=5-thin
+#@+node:agent.20261018104512.6: * @file ../test/leo-bench.py
+'''
+Benchmarks for Leo's core, run with the leoBridge module.
+
+Usage: python leo/test/leo-bench.py [--repeat=n] [name ...]
+
+With no names, run all benchmarks.
+
+**Important**: Leo's core does not use this module in any way.
+'''
+import gc
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+# Make sure the leo package is importable.
+leo_editor_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if leo_editor_dir not in sys.path:
+    sys.path.insert(0, leo_editor_dir)
+import leo.core.leoBridge as leoBridge
+g = None # Set by main.
+#@+others
+#@+node:agent.20261018104512.7: ** Utils
+#@+node:agent.20261018104512.8: *3* best_time
+def best_time(f, repeat):
+    '''Return the smallest time, in seconds, taken by repeat calls to f().'''
+    result = None
+    for i in range(repeat):
+        t1 = time.time()
+        f()
+        t2 = time.time()
+        if result is None or t2 - t1 < result:
+            result = t2 - t1
+    return result
+#@+node:agent.20261018140000.2: *3* init_find
+def init_find(c):
+    '''
+    Prepare c.findCommands for batch commands without a Find tab.
+    Return c.findCommands.
+    '''
+    fc = c.findCommands
+
+    class FindTabManager(object):
+        entry_focus = None
+        def getFindText(self):
+            return fc.find_text
+
+    fc.ftm = FindTabManager()
+    fc.findAllUniqueFlag = fc.node_only = fc.suboutline_only = False
+    fc.ignore_case = fc.mark_finds = fc.pattern_match = fc.reverse = False
+    fc.mark_changes = fc.whole_word = False
+    fc.search_body = fc.search_headline = True
+    fc.buttonFlag, fc.was_in_headline = True, True
+        # Search headlines first, as the Find All button does.
+    return fc
+#@+node:agent.20261018104512.9: *3* make_at_file_tree
+def make_at_file_tree(c, fileName, classes=50, methods=20, lines=20):
+    '''
+    Create an @file node for fileName as the last top-level node of c.
+    The generated file contains about classes * methods * lines lines.
+    Return the position of the @file node.
+    '''
+    root = c.rootPosition()
+    while root.hasNext():
+        root.moveToNext()
+    root = root.insertAfter()
+    root.h = '@file %s' % fileName
+    root.b = '@language python\n@tabwidth -4\n@others\n'
+    for i in range(classes):
+        p = root.insertAsLastChild()
+        p.h = 'class Class%s' % i
+        p.b = 'class Class%s(object):\n    @others\n' % i
+        for j in range(methods):
+            p2 = p.insertAsLastChild()
+            p2.h = 'method%s' % j
+            p2.b = 'def method%s(self):\n%s' % (j, ''.join([
+                '    x%s = %s # %s\n' % (k, k, 'a comment' * 3)
+                    for k in range(lines)]))
+    return root
+#@+node:agent.20261018230000.5: *3* make_deep_outline
+def make_deep_outline(c, n=100000, depth=100, leaves=4):
+    '''
+    Add about n nodes to c, in top-level chains of the given depth.
+    Every node of a chain has the given number of leaf children.
+    '''
+    last = c.rootPosition()
+    while last.hasNext():
+        last.moveToNext()
+    count = 0
+    while count < n:
+        p = last = last.insertAfter()
+        for i in range(depth):
+            p.h = 'level %s' % i
+            for j in range(leaves):
+                child = p.insertAsLastChild()
+                child.h = 'leaf %s' % count
+                count += 1
+            p = p.insertAsNthChild(0)
+            count += 1
+#@+node:agent.20261018130500.1: *3* make_outline
+def make_outline(c, n=100000, width=100):
+    '''
+    Add about n nodes to c, in top-level trees of the given width.
+    Mark every tenth node and expand every parent node.
+    '''
+    last = c.rootPosition()
+    while last.hasNext():
+        last.moveToNext()
+    count = 0
+    while count < n:
+        parent = last = last.insertAfter()
+        parent.h = 'parent %s' % count
+        parent.b = 'body text %s\n' % count
+        parent.expand()
+        count += 1
+        for i in range(min(width, n - count)):
+            p = parent.insertAsLastChild()
+            p.h = 'node %s' % count
+            p.b = 'def spam(self):\n    return "<%s>" & 1\n' % count
+            if count % 10 == 0:
+                p.setMarked()
+            count += 1
+#@+node:agent.20261018104512.10: *3* report
+def report(name, rows):
+    '''Print the results of a benchmark. rows is a list of (label, value).'''
+    print('%s:' % name)
+    for label, value in rows:
+        print('  %-40s %s' % (label, value))
+#@+node:agent.20261018133000.7: ** bench_find
+def bench_find(bridge, repeat):
+    '''
+    Time find-all and clone-find-all in a 100k-node outline,
+    with and without @bool find-all-use-index.
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        c = bridge.createFrame(os.path.join(path, 'bench.leo'))
+        make_outline(c)
+        fc = init_find(c)
+        rows = []
+        for pattern in ('node 4242', '4242', 'no such text'):
+            for kind in ('find-all', 'clone-find-all'):
+                for use_index in (False, True):
+
+                    def find():
+                        fc.find_text = pattern
+                        fc.use_index = use_index
+                        last = c.lastTopLevel()
+                        fc.findAll(clone_find_all=kind == 'clone-find-all')
+                        if c.lastTopLevel() != last:
+                            c.lastTopLevel().doDelete()
+
+                    t = best_time(find, repeat)
+                    rows.append((
+                        '%-14s %-14r index: %-5s' % (kind, pattern, use_index),
+                        '%6.1f msec' % (1000 * t)))
+        n = len(list(c.all_unique_nodes()))
+        report('bench_find: %s nodes' % n, rows)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+#@+node:agent.20261018140000.3: ** bench_find_clones
+def bench_find_clones(bridge, repeat, clones=50):
+    '''
+    Time find-all, clone-find-all and change-all in an outline containing
+    many clones of one 1000-node tree, with and without
+    @bool find-all-unique-nodes.
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        c = bridge.createFrame(os.path.join(path, 'bench.leo'))
+        make_outline(c, n=1000, width=1000)
+        tree = c.lastTopLevel()
+        for i in range(clones):
+            p = c.lastTopLevel().insertAfter()
+            p.h = 'clones %s' % i
+            tree.clone().moveToLastChildOf(p)
+        fc = init_find(c)
+        fc.change_text = 'spam'
+        rows = []
+        for kind in ('find-all', 'clone-find-all', 'change-all'):
+            for unique in (False, True):
+
+                def find():
+                    fc.find_text = 'node 42'
+                    fc.unique_nodes = unique
+                    if kind == 'change-all':
+                        fc.changeAll()
+                        c.undoer.undo()
+                        return
+                    last = c.lastTopLevel()
+                    fc.findAll(clone_find_all=kind == 'clone-find-all')
+                    if c.lastTopLevel() != last:
+                        c.lastTopLevel().doDelete()
+
+                t = best_time(find, repeat)
+                rows.append((
+                    '%-14s unique nodes: %-5s' % (kind, unique),
+                    '%6.1f msec' % (1000 * t)))
+        n = len(list(c.all_unique_nodes()))
+        m = len(list(c.all_positions()))
+        report('bench_find_clones: %s nodes, %s positions' % (n, m), rows)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+#@+node:agent.20261018230000.3: ** bench_memory
+def bench_memory(bridge, repeat, n=500000):
+    '''
+    Measure the memory used by the vnodes of an n-node outline,
+    and by copies of positions in that outline.
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        c = bridge.createFrame(os.path.join(path, 'bench.leo'))
+        tracemalloc.start()
+        make_outline(c, n=n)
+        # The NullTree keeps a headline widget for every vnode.
+        c.frame.tree.editWidgetsDict.clear()
+        vnodes = tracemalloc.get_traced_memory()[0]
+        positions = [p.copy() for p in c.all_positions()]
+        m = len(positions)
+        copies = tracemalloc.get_traced_memory()[0] - vnodes
+        tracemalloc.stop()
+        n = len(list(c.all_unique_nodes()))
+        report('bench_memory: %s nodes' % n, [
+            ('vnodes (with headlines and bodies)', '%6.1f MB, %s bytes/node' % (
+                vnodes / 1e6, vnodes // n)),
+            ('%s p.copy() results' % m, '%6.1f MB, %s bytes/position' % (
+                copies / 1e6, copies // m)),
+        ])
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+#@+node:agent.20261018230000.6: ** bench_positions
+def bench_positions(bridge, repeat):
+    '''
+    Time full-outline traversals of a 100k-node outline whose
+    nodes are up to 100 levels deep.
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        c = bridge.createFrame(os.path.join(path, 'bench.leo'))
+        make_deep_outline(c)
+
+        def thread_next():
+            p = c.rootPosition()
+            while p:
+                p.moveToThreadNext()
+
+        rows = []
+        for label, f in (
+            ('list(c.all_positions())', lambda: list(c.all_positions())),
+            ('list(c.all_unique_positions())', lambda: list(c.all_unique_positions())),
+            ('p.moveToThreadNext()', thread_next),
+        ):
+            gc.collect() # Don't charge f for earlier garbage.
+            rows.append((label, '%6.1f msec' % (1000 * best_time(f, repeat))))
+        n = len(list(c.all_unique_nodes()))
+        depth = 1 + max(p.level() for p in c.all_positions())
+        report('bench_positions: %s nodes, %s levels' % (n, depth), rows)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+#@+node:agent.20261019000000.9: ** bench_typing
+def bench_typing(bridge, repeat, keys=20):
+    '''
+    Time the undo bookkeeping for one keystroke in the middle of bodies
+    of various sizes, with and without the selection ranges.
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        c = bridge.createFrame(os.path.join(path, 'bench.leo'))
+        p, u = c.rootPosition(), c.undoer
+        rows = []
+        for lines in (1000, 10000, 50000):
+            s = ''.join(['line %s of the body text\n' % i for i in range(lines)])
+            i = len(s) // 2
+            # texts[n] is the text after n keystrokes.
+            texts = [s[:i] + 'x' * n + s[i:] for n in range(keys + 1)]
+
+            def typing(sel, texts=texts, i=i):
+                for n in range(keys):
+                    j = i + n
+                    oldSel, newSel = ((j, j), (j + 1, j + 1)) if sel else (None, None)
+                    u.setUndoTypingParams(p, 'Typing', texts[n], texts[n + 1], oldSel, newSel)
+
+            p.b = s
+            for sel in (True, False):
+                u.clearUndoState()
+                gc.collect()
+                t = best_time(lambda: typing(sel), repeat)
+                label = '%s lines, %s' % (lines, 'with selections' if sel else 'no selections')
+                rows.append((label, '%6.3f msec/key' % (1000 * t / keys)))
+        report('bench_typing: undo bookkeeping per keystroke', rows)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+#@+node:agent.20261019000000.17: ** bench_undo_tree
+def bench_undo_tree(bridge, repeat, n=10000):
+    '''
+    Measure the time and memory taken by the undo data for a command
+    that changes the body text of 1% of the nodes in an n-node tree.
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        c = bridge.createFrame(os.path.join(path, 'bench.leo'))
+        make_outline(c, n=n, width=n)
+        u, root = c.undoer, c.rootPosition().next()
+        c.selectPosition(root)
+        m = len(list(root.self_and_subtree()))
+
+        def change():
+            bunch = u.beforeChangeTree(root)
+            for i, p in enumerate(root.subtree()):
+                if i % 100 == 0:
+                    p.v.b = p.b + 'x'
+            u.afterChangeTree(root, 'bench', bunch)
+
+        gc.collect()
+        t = best_time(change, repeat)
+        u.clearUndoState()
+        gc.collect()
+        tracemalloc.start()
+        change()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        rows = [
+            ('before/afterChangeTree', '%6.1f msec' % (1000 * t)),
+            ('memory allocated for one bead', '%6.1f KB' % (size / 1e3)),
+        ]
+        if hasattr(u, 'memoryUsage'):
+            rows.append(('u.memoryUsage()', '%6.1f KB' % (u.memoryUsage() / 1e3)))
+        report('bench_undo_tree: %s nodes in the tree' % m, rows)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+#@+node:agent.20261018130500.2: ** bench_save
+def bench_save(bridge, repeat):
+    '''
+    Time saving a 100k-node outline to a .leo file.
+    The nodes of one tree are children of an @file node.
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        fileName = os.path.join(path, 'bench.leo')
+        c = bridge.createFrame(fileName)
+        fc = c.fileCommands
+        make_outline(c)
+        # @file trees have descendent attributes, but no written children.
+        root = c.lastTopLevel()
+        root.h = '@file %s' % os.path.join(path, 'spam.py')
+        root.contract()
+
+        def put():
+            fc.outputFile = g.FileLikeObject()
+            fc.putLeoFile()
+            fc.outputFile = None
+
+        def save():
+            fc.write_Leo_file(fileName, outlineOnlyFlag=True)
+
+        t1 = best_time(put, repeat)
+        t2 = best_time(save, repeat)
+        n = len(list(c.all_unique_nodes()))
+        report('bench_save: %s nodes, %s bytes' % (n, os.path.getsize(fileName)), [
+            ('fc.putLeoFile', '%6.1f msec' % (1000 * t1)),
+            ('fc.write_Leo_file', '%6.1f msec' % (1000 * t2)),
+        ])
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+#@+node:agent.20261018230000.14: ** bench_vnodes
+def bench_vnodes(bridge, repeat):
+    '''
+    Compare the vnode generators with the equivalent position generators
+    in a 100k-node outline. One node is cloned into every top-level tree.
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        c = bridge.createFrame(os.path.join(path, 'bench.leo'))
+        make_outline(c)
+        tree = c.rootPosition().next()
+        clone = tree.firstChild()
+        for p in tree.following_siblings():
+            clone.clone().moveToFirstChildOf(p)
+        v = clone.v
+        rows = []
+        for label, f in (
+            ('c.all_unique_nodes()', lambda: list(c.all_unique_nodes())),
+            ('p.v for p in c.all_unique_positions()',
+                lambda: [p.v for p in c.all_unique_positions()]),
+            ('c.all_nodes()', lambda: list(c.all_nodes())),
+            ('p.v for p in c.all_positions()',
+                lambda: [p.v for p in c.all_positions()]),
+            ('v.findAllPotentiallyDirtyNodes()', v.findAllPotentiallyDirtyNodes),
+        ):
+            gc.collect()
+            rows.append((label, '%6.1f msec' % (1000 * best_time(f, repeat))))
+        n = len(list(c.all_unique_nodes()))
+        report('bench_vnodes: %s nodes, %s clones' % (n, len(v.parents)), rows)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+#@+node:agent.20261019000000.4: ** bench_settings
+def bench_settings(bridge, repeat):
+    '''
+    Time the two stages of parsing the @settings tree of leoSettings.leo.
+    '''
+    import leo.core.leoConfig as leoConfig
+    fileName = os.path.join(leo_editor_dir, 'leo', 'config', 'leoSettings.leo')
+    c = bridge.openLeoFile(fileName)
+    lm = g.app.loadManager
+    rows = []
+    for label, f in (
+        ('lm.createSettingsDicts', lambda: lm.createSettingsDicts(c, False)),
+    ):
+        gc.collect()
+        rows.append((label, '%6.1f msec' % (1000 * best_time(f, repeat))))
+    stats = {}
+    for i in range(repeat):
+        parser = leoConfig.SettingsTreeParser(c, localFlag=False)
+        parser.traverse()
+        for key in ('scan', 'convert'):
+            stats[key] = min(stats.get(key, parser.stats[key]), parser.stats[key])
+    for key in ('scan', 'convert'):
+        rows.append(('  %s stage' % key, '%6.1f msec' % (1000 * stats[key])))
+    report('bench_settings: %s nodes, %s settings' % (
+        parser.stats['nodes'], parser.stats['settings']), rows)
+    c.close()
+#@+node:agent.20261018104512.11: ** bench_write
+def bench_write(bridge, repeat):
+    '''
+    Compare the latency of writing a large @file tree after a one-line edit,
+    with and without at.putFragment's fragment cache.
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        c = bridge.createFrame(os.path.join(path, 'bench.leo'))
+        at = c.atFileCommands
+        root = make_at_file_tree(c, os.path.join(path, 'big.py'))
+        node = root.lastChild().lastChild()
+        n = [0]
+
+        def edit_and_write():
+            n[0] += 1
+            node.b = node.b + 'y = %s\n' % n[0]
+            at.write(root, kind='@file')
+
+        rows = []
+        for checkPython in (False, True):
+            at.checkPythonCodeOnWrite = checkPython
+            for cacheFragments in (False, True):
+                at.cacheFragments = cacheFragments
+                at.write(root, kind='@file')
+                t = best_time(edit_and_write, repeat)
+                rows.append((
+                    'fragment cache: %-5s check python: %-5s' % (
+                        cacheFragments, checkPython),
+                    '%6.1f msec' % (1000 * t)))
+        lines = len(g.splitLines(at.outputContents))
+        report('bench_write: one-line edit in a %s-line @file' % lines, rows)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+#@+node:agent.20261019000000.53: ** bench_plugins
+typical_plugins = [
+    # The default @enabled-plugins...
+    'plugins_menu', 'free_layout', 'contextmenu', 'leo_to_html', 'livecode',
+    'mod_scripting', 'nav_qt', 'nodetags', 'quicksearch', 'python_terminal',
+    'screen_capture', 'settings_finder', 'stickynotes', 'todo', 'viewrendered',
+    # and other commonly used plugins.
+    'bookmarks', 'FileActions', 'gitarchive', 'leo_to_rtf', 'mime',
+    'mod_autosave', 'mod_timestamp', 'niceNosent', 'nodeActions', 'quickMove',
+    'read_only_nodes', 'screenshots', 'startfile', 'word_count', 'xml_edit',
+]
+
+def bench_plugins(bridge, repeat):
+    '''
+    Find which of 30 typical plugins @bool lazy-load-plugins would load
+    lazily, and time importing each of them in a fresh process.
+    '''
+    import leo.core.leoPlugins as leoPlugins
+    pc = leoPlugins.LeoPluginsController()
+    pc.scanCache = {}
+    names = ['leo.plugins.%s' % z for z in typical_plugins]
+
+    def scan():
+        pc.scanCache = {}
+        return [pc.scanPlugin(z) for z in names]
+
+    rows = [('scan %s plugins (no cache)' % len(names),
+        '%6.1f msec' % (1000 * best_time(scan, repeat)))]
+    rows.append(('scan %s plugins (cached)' % len(names), '%6.1f msec' % (
+        1000 * best_time(lambda: [pc.scanPlugin(z) for z in names], repeat))))
+    code = (
+        'import sys, time; sys.path.insert(0, %r); import leo.core.leoGlobals; '
+        't = time.time(); import %s; print(time.time() - t)')
+    total, lazy = 0.0, 0
+    for name, d in zip(names, scan()):
+        if not d or any(z in pc.startup_hooks for z in d['hooks']):
+            continue
+        lazy += 1
+        try:
+            out = subprocess.check_output(
+                [sys.executable, '-c', code % (leo_editor_dir, name)],
+                stderr=subprocess.STDOUT)
+            t = float(out.splitlines()[-1])
+            total += t
+            result = '%6.1f msec' % (1000 * t)
+        except (subprocess.CalledProcessError, ValueError):
+            result = 'import failed'
+        rows.append(('  %s' % name[len('leo.plugins.'):], result))
+    rows.append(('import time deferred', '%6.1f msec' % (1000 * total)))
+    report('bench_plugins: %s of %s plugins load lazily' % (lazy, len(names)), rows)
+#@+node:agent.20261018104512.12: ** main
+benchmarks = [
+    ('find', bench_find),
+    ('find-clones', bench_find_clones),
+    ('memory', bench_memory),
+    ('plugins', bench_plugins),
+    ('positions', bench_positions),
+    ('save', bench_save),
+    ('settings', bench_settings),
+    ('typing', bench_typing),
+    ('undo-tree', bench_undo_tree),
+    ('vnodes', bench_vnodes),
+    ('write', bench_write),
+]
+
+def main():
+    global g
+    parser = optparse.OptionParser(usage='usage: %prog [--repeat=n] [name ...]')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+        help='number of timed runs (default 5)')
+    options, args = parser.parse_args()
+    names = [name for name, f in benchmarks]
+    for arg in args:
+        if arg not in names:
+            parser.error('unknown benchmark: %s. Use one of: %s' % (
+                arg, ', '.join(names)))
+    bridge = leoBridge.controller(gui='nullGui',
+        loadPlugins=False, readSettings=False,
+        silent=True, verbose=False)
+    g = bridge.globals()
+    g.enableDB = False # Don't use or pollute the user's caches.
+    for name, f in benchmarks:
+        if not args or name in args:
+            f(bridge, max(1, options.repeat))
+#@-others
+if __name__ == '__main__':
+    main()
+#@@language python
+#@@tabwidth -4
+#@@pagewidth 70
+#@-leo